@@ -1,10 +1,81 @@
+import copy
+import functools
+import inspect
+import json
+import os
+import time
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional, Tuple, Type, TypeVar
+from pydantic import BaseModel, ValidationError
 from langfuse.openai import openai
+from openai.types.chat import ChatCompletionMessage
+from core.checkpoints import CHECKPOINTS, message_dict
 from core.logger import setup_logger
+from core.model_routing import MODEL_ROUTER
+from core.prefetch import CALL_TRACES, PREFETCH_ENABLED, PREFETCH_EXECUTOR, Prefetcher
+from core.profiling import PROFILER
+from core.rate_limiter import RATE_LIMITER
+from core.telemetry import TELEMETRY
+from core.tool_memo import ToolCallMemo
+from tools.daemon import TOOL_CLIENT
+from tools.registry import SUBMIT_RESULT_TOOL, TOOL_REGISTRY, ToolCallError
 
 logger = setup_logger(__name__)
 
+T = TypeVar("T")
+
+# Completion tokens assumed for a request until its usage is known
+ESTIMATED_COMPLETION_TOKENS = 1000
+
+if RATE_LIMITER.enabled:
+    # Retries go through the limiter so that it sees every 429; the SDK's own retries would hide them
+    openai.max_retries = 0
+
+
+def _payload_bytes(messages: List[Any]) -> int:
+    """Approximate the request payload size from message contents and tool call arguments."""
+    total = 0
+    for message in messages:
+        if isinstance(message, dict):
+            content, tool_calls = message.get("content"), message.get("tool_calls")
+        else:
+            content, tool_calls = message.content, message.tool_calls
+        if content:
+            total += len(content.encode("utf-8"))
+        for tool_call in tool_calls or ():
+            # Messages restored from a checkpoint carry their tool calls as dicts
+            arguments = tool_call["function"]["arguments"] if isinstance(tool_call, dict) else tool_call.function.arguments
+            total += len(arguments.encode("utf-8"))
+    return total
+
+
+_USAGE_KEYS = ("total_tokens", "prompt_tokens", "completion_tokens", "cached_tokens", "api_calls")
+
+
+def _workbook_version(file_path: str) -> Any:
+    """Identify the version of the workbook a conversation reads, so edited workbooks do not resume stale conversations."""
+    try:
+        stat = os.stat(file_path)
+    except (OSError, TypeError):
+        return file_path
+    return os.path.realpath(file_path), stat.st_mtime_ns, stat.st_size
+
+
+def telemetry_run(method: Callable) -> Callable:
+    """Decorate an agent entry point so its spans are tagged with the agent and sheet name (and the run is profiled if enabled)."""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        sheet_name = signature.bind(self, *args, **kwargs).arguments.get("sheet_name")
+        # Langfuse tracing is sampled per run so that its payload capture stays off the hot path
+        self.trace_langfuse = TELEMETRY.sample_langfuse()
+        with TELEMETRY.context(agent=self.__class__.__name__, sheet_name=sheet_name), \
+                PROFILER.profile_run(self.__class__.__name__, sheet_name):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 class BaseAgent(ABC):
     """Base agent class that provides common functionality for all agents."""
     
@@ -16,17 +87,272 @@ class BaseAgent(ABC):
             "total_tokens": 0,
             "prompt_tokens": 0,
             "completion_tokens": 0,
+            "cached_tokens": 0,
             "api_calls": 0,
-            "model_used": None
+            "model_used": None,
+            "tokens_by_model": {}
         }
         logger.info("%s initialized", self.__class__.__name__)
         self.model = None
+        self.trace_langfuse = True
     
     @abstractmethod
     def get_tools(self) -> List[Any]:
         """Return the list of tools available to this agent."""
         pass
     
+    def get_tool_schemas(self) -> List[Dict[str, Any]]:
+        """Return the precompiled OpenAI tool schemas for this agent's tools."""
+        return TOOL_REGISTRY.schemas(self.get_tools())
+    
+    def _dispatch_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> str:
+        """Run a validated tool call in the tool daemon, or in-process if the daemon is unavailable.
+        
+        A tool that fails (e.g. an unknown sheet or a malformed cell reference) returns the error as
+        the tool message, so the model can correct the call; escalation is kept for invalid results.
+        """
+        start = time.perf_counter()
+        try:
+            content = TOOL_CLIENT.call(tool_name, tool_args) if TOOL_CLIENT.available() else None
+            if content is None:
+                content = str(TOOL_REGISTRY.call(tool_name, tool_args))
+        except Exception as e:
+            logger.warning("Tool call %s failed: %s", tool_name, e)
+            content = "Error: %s" % e
+        PROFILER.record_tool(tool_name, (time.perf_counter() - start) * 1000)
+        return content
+    
+    def execute_tool_call(self, tool_call: Any, excel_file_path: str, memo: Optional[ToolCallMemo] = None,
+                          iteration: int = 0, prefetcher: Optional[Prefetcher] = None) -> str:
+        """Parse, validate and dispatch a single tool call, returning the tool message content.
+        
+        With a memo, a call already answered in this conversation returns a short back-reference
+        instead of running the tool again and repeating its payload. With a prefetcher, a call that
+        was speculatively computed while the LLM was thinking takes that result.
+        """
+        tool_name = tool_call.function.name
+        try:
+            tool_args = TOOL_REGISTRY.parse_arguments(tool_name, tool_call.function.arguments, file_path=excel_file_path)
+        except ToolCallError as e:
+            logger.warning("Rejected tool call %s: %s", tool_name, e)
+            return "Error: %s" % e
+        
+        if prefetcher is not None:
+            prefetcher.observe(tool_name, tool_args)
+        if memo is not None:
+            reference = memo.lookup(tool_name, tool_args)
+            if reference is not None:
+                TELEMETRY.annotate(memo_hit=True)
+                return reference
+        
+        logger.info("Calling tool function: %s with arguments: %s", tool_name, tool_args)
+        prefetched = prefetcher.take(tool_name, tool_args) if prefetcher is not None else None
+        if prefetched is not None:
+            content, saved_ms = prefetched
+            TELEMETRY.annotate(prefetch_hit=True, prefetch_saved_ms=saved_ms)
+        else:
+            content = self._dispatch_tool(tool_name, tool_args)
+        if memo is not None:
+            memo.remember(tool_name, tool_args, tool_call.id, iteration)
+        
+        logger.info("Tool %s returned result: %s...", tool_name, content[:200])
+        return content
+    
+    def run_tool_loop(self, messages: List[Dict[str, Any]], excel_file_path: str, max_iterations: int,
+                      result_model: Optional[Type[BaseModel]] = None) -> Tuple[Any, Optional[BaseModel]]:
+        """Run the LLM/tool-call loop and return the last message and the submitted result, if any.
+        
+        When result_model is given the model is offered a submit_result tool; a submission that
+        validates against result_model ends the loop immediately.
+        
+        Every completed turn is checkpointed; if an earlier process died in the same conversation
+        (same agent, model, workbook version and initial messages), the loop resumes after its last
+        completed turn and its LLM usage is added to the cost tracker.
+        
+        Repeated tool calls are answered with a back-reference to the earlier result, and the loop
+        stops early once EXCEL_AGENT_STALL_TURNS turns in a row only repeated earlier calls.
+        
+        Unless EXCEL_AGENT_PREFETCH=0, the calls that usually follow this turn's calls in earlier
+        runs are computed in the background while the LLM produces its next turn.
+        """
+        tools = self.get_tool_schemas()
+        if result_model is not None:
+            tools = tools + [TOOL_REGISTRY.result_schema(result_model)]
+        allowed_tools = {tool.name for tool in self.get_tools()}
+        result = None
+        iteration = 0
+        message = None
+        memo = ToolCallMemo(stall_limit=int(os.getenv("EXCEL_AGENT_STALL_TURNS", "3")))
+        
+        usage_start = self._usage_snapshot()
+        checkpoint = CHECKPOINTS.conversation(
+            self.__class__.__name__, self.model, _workbook_version(excel_file_path), sorted(allowed_tools),
+            result_model.__name__ if result_model else None, [message_dict(message) for message in messages])
+        state = checkpoint.load() if checkpoint is not None else None
+        if state is not None and state["iteration"]:
+            messages[:] = state["messages"]
+            iteration = state["iteration"]
+            self._add_usage(state["usage"])
+            message = ChatCompletionMessage.model_validate(
+                next(message for message in reversed(messages) if message["role"] == "assistant"))
+            if state["result"] is not None:
+                result = result_model.model_validate(state["result"])
+            logger.info("Resumed %s conversation from checkpoint after iteration %d (%d messages, %d prior API calls)",
+                        self.__class__.__name__, iteration, len(messages), state["usage"]["api_calls"])
+            if result is not None:
+                checkpoint.discard()
+                return message, result
+        elif checkpoint is not None:
+            checkpoint.start(messages)
+        
+        prefetcher = None
+        if PREFETCH_ENABLED:
+            prefetcher = Prefetcher(CALL_TRACES, PREFETCH_EXECUTOR, self._dispatch_tool, excel_file_path, allowed_tools,
+                                    sheet_name=TELEMETRY.current_context().get("sheet_name"))
+        
+        try:
+            while iteration < max_iterations:
+                iteration += 1
+                print("=" * 80)
+                logger.info("LLM iteration %d", iteration)
+            
+                if prefetcher is not None:
+                    prefetcher.schedule(memo)
+                response = self.create_completion(
+                    model=self.model,
+                    messages=messages,
+                    tools=tools,
+                    tool_choice="auto"
+                )
+                received_at = time.perf_counter()
+            
+                message = response.choices[0].message
+
+                if not message.tool_calls:
+                    break
+            
+                messages.append(message)
+                turn_start = len(messages) - 1
+        
+                logger.info("LLM requested %d tool calls", len(message.tool_calls))
+            
+                for tool_call in message.tool_calls:
+                    with TELEMETRY.span("tool", tool_call.function.name, queued_at=received_at) as span:
+                        if result_model is not None and tool_call.function.name == SUBMIT_RESULT_TOOL:
+                            try:
+                                result = result_model.model_validate_json(tool_call.function.arguments)
+                                content = "Result accepted."
+                            except ValidationError as e:
+                                logger.warning("Submitted result failed validation: %s", e)
+                                content = "Error: submitted result failed validation: %s" % e
+                        elif tool_call.function.name in allowed_tools:
+                            content = self.execute_tool_call(tool_call, excel_file_path, memo, iteration, prefetcher)
+                        else:
+                            logger.warning("LLM requested unavailable tool: %s", tool_call.function.name)
+                            content = "Error: Unknown tool: %s" % tool_call.function.name
+                        span.request_bytes = len(tool_call.function.arguments.encode("utf-8"))
+                        span.response_bytes = len(content.encode("utf-8"))
+                
+                    messages.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call.id,
+                        "content": content
+                    })
+            
+                if checkpoint is not None:
+                    checkpoint.append(messages[turn_start:], iteration, self._usage_since(usage_start),
+                                      result.model_dump() if result is not None else None)
+            
+                if result is not None:
+                    logger.info("LLM submitted a valid %s result", result_model.__name__)
+                    break
+            
+                if memo.end_turn():
+                    logger.warning("Stopping after iteration %d: the last %d turns only repeated earlier tool calls (%d duplicates in total)",
+                                   iteration, memo.stalled_turns, memo.hits)
+                    break
+        except Exception:
+            # A conversation that failed (e.g. an attempt abandoned for the escalation model) starts
+            # afresh next time; only a process that died mid-run leaves its checkpoint behind
+            if checkpoint is not None:
+                checkpoint.discard()
+            raise
+        
+        if prefetcher is not None:
+            stats = prefetcher.close()
+            if stats["prefetched"]:
+                logger.info("Prefetch: %d of %d tool calls served from %d prefetches (hit rate %.0f%%, %.0f ms saved, %d unused)",
+                            stats["hits"], stats["hits"] + stats["misses"], stats["prefetched"],
+                            stats["hit_rate"] * 100, stats["saved_ms"], stats["wasted"])
+        if checkpoint is not None:
+            checkpoint.discard()
+        return message, result
+    
+    def request_structured_output(self, messages: List[Dict[str, Any]], final_message: Any, result_model: Type[T]) -> T:
+        """Fallback when no result was submitted: ask for the final answer again with a JSON schema response format."""
+        if final_message is not None and not final_message.tool_calls and final_message.content:
+            messages.append({"role": "assistant", "content": final_message.content})
+        
+        pydantic_schema = result_model.model_json_schema()
+        json_schema = {
+            "name": pydantic_schema['title'],
+            "schema": pydantic_schema
+        }
+        logger.info("No result submitted, requesting structured %s response from LLM", result_model.__name__)
+        final_response = self.create_completion(
+            model=self.model,
+            messages=messages,
+            response_format={"type": "json_schema", "json_schema": json_schema},
+        )
+        
+        response_content = final_response.choices[0].message.content
+        return result_model(**json.loads(response_content))
+    
+    def create_completion(self, **kwargs: Any) -> Any:
+        """Call the chat completions API through the shared rate limiter inside a telemetry span and update the cost tracker."""
+        create = self.client.chat.completions.create
+        if not self.trace_langfuse:
+            # Bypass the Langfuse wrapper for runs that were not sampled
+            create = getattr(create, '__wrapped__', create)
+        
+        with TELEMETRY.span("llm", kwargs.get("model") or self.model) as span:
+            span.request_bytes = _payload_bytes(kwargs.get("messages", []))
+            # Roughly four bytes per prompt token
+            estimated_tokens = span.request_bytes // 4 + (kwargs.get("max_completion_tokens") or ESTIMATED_COMPLETION_TOKENS)
+            response = RATE_LIMITER.call(create, estimated_tokens, **kwargs)
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                span.prompt_tokens = usage.prompt_tokens
+                span.completion_tokens = usage.completion_tokens
+                span.cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+            span.response_bytes = _payload_bytes([response.choices[0].message])
+        
+        # Update cost tracker with response information
+        self.update_cost_tracker(response, model=kwargs.get("model"))
+        return response
+    
+    def run_with_escalation(self, attempt: Callable[[], T], model: str,
+                            is_acceptable: Optional[Callable[[T], bool]] = None) -> T:
+        """Run an attempt with the routed model and retry once with the escalation model if it fails validation or is not acceptable."""
+        escalation_model = MODEL_ROUTER.escalation_model(self.__class__.__name__)
+        self.model = model
+        logger.info("%s routed to model %s", self.__class__.__name__, model)
+        
+        try:
+            result = attempt()
+        except (ValueError, TypeError) as e:
+            # json.JSONDecodeError and pydantic.ValidationError are both ValueErrors
+            if model == escalation_model:
+                raise
+            logger.warning("Output of %s failed validation (%s), escalating to %s", model, e, escalation_model)
+        else:
+            if model == escalation_model or is_acceptable is None or is_acceptable(result):
+                return result
+            logger.warning("Output of %s is ambiguous, escalating to %s", model, escalation_model)
+        
+        self.model = escalation_model
+        return attempt()
+    
     def reduce_messages(self, messages: List[Dict[str, Any]], max_messages: int = 10) -> List[Dict[str, Any]]:
         """Reduce the message list to a maximum number of messages while preserving system and task prompts."""
         if len(messages) <= max_messages:
@@ -64,33 +390,75 @@ class BaseAgent(ABC):
     
     def compute_total_cost(self) -> Dict[str, Any]:
         """Compute and return the total cost incurred by the agent."""
-        pricing = {
-            "o3": {"input": 0.002, "output": 0.008},
-        }
-        
-        model = self.model
-        model_pricing = pricing[self.model]
-        
-        input_cost = (self.cost_tracker["prompt_tokens"] / 1000) * model_pricing["input"]
-        output_cost = (self.cost_tracker["completion_tokens"] / 1000) * model_pricing["output"]
-        total_cost = input_cost + output_cost
+        total_cost = 0.0
+        for model, tokens in self.cost_tracker["tokens_by_model"].items():
+            model_pricing = MODEL_ROUTER.get_pricing(model)
+            if model_pricing is None:
+                logger.warning("No pricing configured for model %s, reporting zero cost", model)
+                continue
+            
+            # Cached prompt tokens are part of prompt_tokens but billed at the discounted rate
+            uncached_tokens = tokens["prompt_tokens"] - tokens["cached_tokens"]
+            input_cost = (uncached_tokens / 1000) * model_pricing["input"] + (tokens["cached_tokens"] / 1000) * model_pricing.get("cached_input", model_pricing["input"])
+            output_cost = (tokens["completion_tokens"] / 1000) * model_pricing["output"]
+            total_cost += input_cost + output_cost
         
+        cached_tokens = self.cost_tracker["cached_tokens"]
         return {
-            "model_used": model,
+            "model_used": self.model,
+            "models": sorted(self.cost_tracker["tokens_by_model"]),
             "api_calls": self.cost_tracker["api_calls"],
             "total_tokens": self.cost_tracker["total_tokens"],
             "prompt_tokens": self.cost_tracker["prompt_tokens"],
             "completion_tokens": self.cost_tracker["completion_tokens"],
+            "cached_tokens": cached_tokens,
             "total_cost_usd": round(total_cost, 6)
         }
     
-    def update_cost_tracker(self, response: Any) -> None:
-        """Update the cost tracker with information from an API response."""
+    def merge_cost_tracker(self, other: "BaseAgent") -> None:
+        """Add the usage recorded by another agent (e.g. a per-region worker) to this agent's cost tracker."""
+        self._add_usage(other.cost_tracker)
+    
+    def _add_usage(self, usage: Dict[str, Any]) -> None:
+        """Add usage counters (a cost tracker or a difference of two) to this agent's cost tracker."""
+        for key in _USAGE_KEYS:
+            self.cost_tracker[key] += usage[key]
+        for model, tokens in usage["tokens_by_model"].items():
+            model_tokens = self.cost_tracker["tokens_by_model"].setdefault(
+                model, {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0})
+            for key, value in tokens.items():
+                model_tokens[key] += value
+        self.cost_tracker["model_used"] = usage["model_used"] or self.cost_tracker["model_used"]
+    
+    def _usage_snapshot(self) -> Dict[str, Any]:
+        return copy.deepcopy(self.cost_tracker)
+    
+    def _usage_since(self, snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the usage added to the cost tracker since the snapshot was taken."""
+        usage = {key: self.cost_tracker[key] - snapshot[key] for key in _USAGE_KEYS}
+        usage["model_used"] = self.cost_tracker["model_used"]
+        usage["tokens_by_model"] = {}
+        for model, tokens in self.cost_tracker["tokens_by_model"].items():
+            before = snapshot["tokens_by_model"].get(model, {})
+            usage["tokens_by_model"][model] = {key: value - before.get(key, 0) for key, value in tokens.items()}
+        return usage
+    
+    def update_cost_tracker(self, response: Any, model: str = None) -> None:
+        """Update the cost tracker with information from an API response made with the given model."""
         if hasattr(response, 'usage'):
             usage = response.usage
+            prompt_details = getattr(usage, 'prompt_tokens_details', None)
+            cached_tokens = getattr(prompt_details, 'cached_tokens', None) or 0
             self.cost_tracker["total_tokens"] += usage.total_tokens
             self.cost_tracker["prompt_tokens"] += usage.prompt_tokens
             self.cost_tracker["completion_tokens"] += usage.completion_tokens
+            self.cost_tracker["cached_tokens"] += cached_tokens
+            
+            model_tokens = self.cost_tracker["tokens_by_model"].setdefault(
+                model or self.model, {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0})
+            model_tokens["prompt_tokens"] += usage.prompt_tokens
+            model_tokens["completion_tokens"] += usage.completion_tokens
+            model_tokens["cached_tokens"] += cached_tokens
         
         if hasattr(response, 'model'):
             self.cost_tracker["model_used"] = response.model
@@ -99,4 +467,4 @@ class BaseAgent(ABC):
         
         # Log current cost after each API call
         current_cost = self.compute_total_cost()
-        logger.info("Current cost for %s: $%s (API calls: %s, tokens: %s)", self.__class__.__name__, current_cost['total_cost_usd'], current_cost['api_calls'], current_cost['total_tokens']) 
\ No newline at end of file
+        logger.info("Current cost for %s: $%s (API calls: %s, tokens: %s, cached tokens: %s)", self.__class__.__name__, current_cost['total_cost_usd'], current_cost['api_calls'], current_cost['total_tokens'], current_cost['cached_tokens']) 
\ No newline at end of file
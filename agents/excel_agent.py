@@ -1,16 +1,36 @@
+import contextvars
 import json
-from agents.base_agent import BaseAgent
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from agents.base_agent import BaseAgent, telemetry_run
+from core.coa_matcher import format_candidates, get_coa_matcher, relevant_items
+from core.encodings import DEFAULT_MAX_TOKENS, cached_compact_encoding
+from core.model_routing import MODEL_ROUTER
+from core.profiling import PROFILER
+from core.regions import SheetRegion, merge_region_mappings, split_sheet_regions
+from core.telemetry import TELEMETRY
+from core.templates import SheetTemplate, apply_rules
+from core.verification import verify_mappings
+from core.workbook_diff import SheetDiff, carry_over_mappings, dirty_regions
 from tools.tools import (
     get_row_values, get_column_values, get_cell_value,
     get_sheet_dimensions,
-    get_range_values, get_max_rows, get_max_columns
+    get_range_values, get_max_rows, get_max_columns,
+    search_workbook, query_sheet, get_cell_contexts
 )
+from tools.snapshot import get_sheet_snapshot
 from core.logger import setup_logger
-from prompts.excel_agent import get_task_prompt
-from pydantic_models.models import SheetCoAMapping
+from prompts.excel_agent import get_task_prompt, get_template_check_prompt
+from pydantic_models.models import SheetCoAMapping, SingleSheetEncoding, TemplateCheck
 
 logger = setup_logger(__name__)
 
+# Share of a template's rules that must apply before its mappings are sent for checking
+MIN_TEMPLATE_COVERAGE = float(os.getenv("EXCEL_AGENT_TEMPLATE_MIN_COVERAGE", "0.6"))
+# Mappings listed in the template check prompt
+_TEMPLATE_CHECK_ENTRIES = 150
+
 class ExcelAgent(BaseAgent):
     """Agent that executes Excel tasks using OpenAI LLM and tool calls."""
     
@@ -20,16 +40,243 @@ class ExcelAgent(BaseAgent):
         self.tools = [
             get_row_values, get_column_values, get_cell_value,
             get_sheet_dimensions, get_range_values,
-            get_max_rows, get_max_columns
+            get_max_rows, get_max_columns, search_workbook, query_sheet, get_cell_contexts
         ]
         logger.info("ExcelAgent initialized")
-        self.model = "o3"
+        self.model = MODEL_ROUTER.model_for(self.__class__.__name__)
     
     def get_tools(self):
         """Return the list of tools available to this agent."""
         return self.tools
     
-    def execute(self, excel_file_path: str, sheet_name: str = None, **prompt_kwargs) -> SheetCoAMapping:
+    @telemetry_run
+    def execute(self, excel_file_path: str, sheet_name: str = None, encoding: Optional[SingleSheetEncoding] = None,
+                **prompt_kwargs) -> SheetCoAMapping:
+        """Execute task on Excel file, routing small sheets to a fast model and escalating when the result is invalid or empty."""
+        sheet_cells = get_sheet_snapshot(excel_file_path, sheet_name).nonempty_cells() if sheet_name else 0
+        model = MODEL_ROUTER.model_for_sheet(self.__class__.__name__, sheet_cells)
+        logger.info("Sheet '%s' has %d non-empty cells", sheet_name, sheet_cells)
+        if sheet_name:
+            prompt_kwargs = self._with_candidates(excel_file_path, sheet_name, prompt_kwargs)
+        prompt_kwargs = self._with_encoding(encoding, prompt_kwargs)
+        return self.run_with_escalation(
+            lambda: self._execute(excel_file_path, sheet_name=sheet_name, **prompt_kwargs),
+            model,
+            is_acceptable=lambda result: bool(result.mappings)
+        )
+    
+    @telemetry_run
+    def execute_by_regions(self, excel_file_path: str, sheet_name: str, encoding: Optional[SingleSheetEncoding] = None,
+                           max_workers: int = None, **prompt_kwargs) -> SheetCoAMapping:
+        """Map a large sheet by splitting it into table regions, mapping the regions concurrently and merging the results."""
+        snapshot = get_sheet_snapshot(excel_file_path, sheet_name)
+        regions = split_sheet_regions(encoding, snapshot)
+        results = self._map_regions(excel_file_path, sheet_name, regions, max_workers, encoding=encoding, **prompt_kwargs)
+        return merge_region_mappings(sheet_name, regions, results)
+    
+    @telemetry_run
+    def execute_incremental(self, excel_file_path: str, sheet_name: str, previous: SheetCoAMapping, diff: SheetDiff,
+                            encoding: Optional[SingleSheetEncoding] = None, max_workers: int = None,
+                            **prompt_kwargs) -> SheetCoAMapping:
+        """Re-map a revised sheet, reusing the previous mappings and sending only the changed regions to the LLM."""
+        if diff.unchanged:
+            logger.info("Sheet '%s' is unchanged, reusing %d prior mappings", sheet_name, len(previous.mappings))
+            return carry_over_mappings(previous, diff)
+        
+        snapshot = get_sheet_snapshot(excel_file_path, sheet_name)
+        regions = dirty_regions(split_sheet_regions(encoding, snapshot), diff, snapshot)
+        results = self._map_regions(excel_file_path, sheet_name, regions, max_workers, encoding=encoding, **prompt_kwargs)
+        return carry_over_mappings(previous, diff, merge_region_mappings(sheet_name, regions, results))
+    
+    @telemetry_run
+    def execute_from_template(self, excel_file_path: str, sheet_name: str, template: SheetTemplate,
+                              coa_items: Optional[List[str]] = None) -> Optional[SheetCoAMapping]:
+        """Map a sheet by applying a learned template's rules, checked against the cells and by one tool-free LLM call.
+        
+        Returns None when too few rules apply or the check rejects the template, so that the sheet
+        is mapped from scratch instead. Rules for CoA items outside the client's list are not applied.
+        """
+        rules = [rule for rule in template.rules if not coa_items or rule.CoA_label in coa_items]
+        snapshot = get_sheet_snapshot(excel_file_path, sheet_name)
+        applied = apply_rules(snapshot, rules)
+        TELEMETRY.annotate(template=template.fingerprint.digest, template_rules=len(template.rules), template_applied=len(applied))
+        if not applied or len(applied) < MIN_TEMPLATE_COVERAGE * len(template.rules):
+            logger.info("Template %s covers only %d of %d mappings of sheet '%s', mapping it from scratch",
+                        template.fingerprint.digest, len(applied), len(template.rules), sheet_name)
+            return None
+        
+        report = verify_mappings(excel_file_path, [mapping for mapping, _ in applied])
+        failing = {issue.index for issue in report.failing}
+        applied = [entry for index, entry in enumerate(applied) if index not in failing]
+        check = self._check_template(sheet_name, template, applied)
+        if check is None or not check.template_fits:
+            logger.info("Template %s rejected for sheet '%s': %s", template.fingerprint.digest, sheet_name,
+                        check.comment if check else "check failed")
+            return None
+        
+        wrong = {cell.replace("$", "").upper() for cell in check.wrong_cells}
+        mappings = [mapping for mapping, _ in applied if mapping.location_in_sheet not in wrong]
+        summary = "Mapped from the template learned on %s!%s: %d of %d rules applied, %d failed verification, %d rejected by the check. %s" % (
+            os.path.basename(template.source.get("workbook", "")), template.source.get("sheet_name"), len(applied) + len(failing),
+            len(template.rules), len(failing), len(applied) - len(mappings), check.comment)
+        logger.info("Sheet '%s' mapped from template %s: %d mappings", sheet_name, template.fingerprint.digest, len(mappings))
+        return SheetCoAMapping(sheet_name=sheet_name, mappings=mappings, analysis_summary=summary)
+    
+    def _check_template(self, sheet_name: str, template: SheetTemplate, applied: list) -> Optional[TemplateCheck]:
+        """Ask the LLM, in one call without tools, whether the transferred mappings fit their rows and periods."""
+        entries = [" | ".join(str(part) for part in (mapping.location_in_sheet, mapping.value, context.label or "", context.period or "",
+                                                     mapping.CoA_label, mapping.timestamp_of_value, mapping.unit))
+                   for mapping, context in applied[:_TEMPLATE_CHECK_ENTRIES]]
+        source = "'%s' of %s" % (template.source.get("sheet_name"), os.path.basename(template.source.get("workbook", "")))
+        self.model = MODEL_ROUTER.model_for(self.__class__.__name__, "template_check")
+        schema = TemplateCheck.model_json_schema()
+        try:
+            response = self.create_completion(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": "You are an expert financial analyst that understands spreadsheets."},
+                    {"role": "user", "content": get_template_check_prompt(sheet_name, source, entries,
+                                                                          max(len(applied) - _TEMPLATE_CHECK_ENTRIES, 0))},
+                ],
+                response_format={"type": "json_schema", "json_schema": {"name": schema["title"], "schema": schema}},
+            )
+            return TemplateCheck(**json.loads(response.choices[0].message.content))
+        except (ValueError, TypeError):
+            logger.exception("Template check of sheet '%s' returned an invalid response", sheet_name)
+            return None
+    
+    @telemetry_run
+    def verify_and_correct(self, excel_file_path: str, result: SheetCoAMapping, correct: bool = True,
+                           **prompt_kwargs) -> SheetCoAMapping:
+        """Check every mapping against the sheet and, if asked, send only the failing entries back to the LLM for correction.
+        
+        Corrections are verified too; failing entries that were not fixed are dropped.
+        """
+        report = verify_mappings(excel_file_path, result.mappings)
+        failing = report.failing
+        if not failing or not correct:
+            return result
+        
+        correction_kwargs = {
+            "correction_task": "A previous pass mapped this sheet, but the entries below do not match the cells they point to. "
+                               "Re-check only these entries with the tools and submit corrected mappings for them (fix the cell "
+                               "reference or the value); leave out any entry that should not be mapped. Do not resubmit other entries.",
+            "entries_to_correct": "".join(
+                "\n  - %s = %s (%s): %s%s" % (issue.location_in_sheet, issue.value, result.mappings[issue.index].CoA_label,
+                                             issue.status, "" if issue.cell_value is None else ", cell holds %s" % issue.cell_value)
+                for issue in failing),
+        }
+        logger.info("Asking for corrections of %d failing mappings in sheet '%s'", len(failing), result.sheet_name)
+        try:
+            corrections = self.run_with_escalation(
+                lambda: self._execute(excel_file_path, sheet_name=result.sheet_name, max_iterations=15, **prompt_kwargs, **correction_kwargs),
+                MODEL_ROUTER.model_for(self.__class__.__name__)
+            ).mappings
+        except Exception:
+            logger.exception("Correcting mappings of sheet '%s' failed", result.sheet_name)
+            corrections = []
+        
+        corrected_report = verify_mappings(excel_file_path, corrections)
+        failing_indexes = {issue.index for issue in failing}
+        kept = [mapping for index, mapping in enumerate(result.mappings) if index not in failing_indexes]
+        locations = {mapping.location_in_sheet.replace("$", "").upper() for mapping in kept}
+        rejected = {issue.index for issue in corrected_report.failing}
+        for index, mapping in enumerate(corrections):
+            location = mapping.location_in_sheet.replace("$", "").upper()
+            if index not in rejected and location not in locations:
+                kept.append(mapping.model_copy(update={"sheet_name": result.sheet_name, "location_in_sheet": location}))
+                locations.add(location)
+        
+        corrected = len(kept) - (len(result.mappings) - len(failing))
+        logger.info("Sheet '%s': %d verified corrections for %d failing mappings", result.sheet_name, corrected, len(failing))
+        return result.model_copy(update={"mappings": kept})
+    
+    def _map_regions(self, excel_file_path: str, sheet_name: str, regions: List[SheetRegion], max_workers: int = None,
+                     **prompt_kwargs) -> List[Optional[SheetCoAMapping]]:
+        """Map regions concurrently with one agent each and fold their costs into this agent."""
+        max_workers = max_workers or int(os.getenv("EXCEL_AGENT_REGION_WORKERS", "4"))
+        
+        # Each region gets its own agent so cost tracking and model routing stay independent;
+        # copying the context keeps the telemetry tags of this run in the worker threads
+        agents = [ExcelAgent() for _ in regions]
+        for agent in agents:
+            agent.trace_langfuse = self.trace_langfuse
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, agent._execute_region,
+                                excel_file_path, sheet_name, region, **prompt_kwargs)
+                for agent, region in zip(agents, regions)
+            ]
+            results = [future.result() for future in futures]
+        
+        for agent in agents:
+            self.merge_cost_tracker(agent)
+        return results
+    
+    def _execute_region(self, excel_file_path: str, sheet_name: str, region: SheetRegion,
+                        encoding: Optional[SingleSheetEncoding] = None, **prompt_kwargs) -> Optional[SheetCoAMapping]:
+        """Map a single region of a sheet; returns None if the region could not be mapped."""
+        region_kwargs = {
+            "region": region.range,
+            "region_header_rows": region.header_range or "None detected",
+            "scope": "Only map values inside the region above. The header rows label the periods of its columns. Other regions of this sheet are mapped separately.",
+        }
+        if region.label_range:
+            region_kwargs["region_row_labels"] = "Columns %s of the same rows (outside the region, read them for context only)" % region.label_range
+        prompt_kwargs = self._with_candidates(excel_file_path, sheet_name, prompt_kwargs, region.min_row, region.max_row)
+        prompt_kwargs = self._with_encoding(encoding, prompt_kwargs, region.min_row, region.max_row)
+        model = MODEL_ROUTER.model_for_sheet(self.__class__.__name__, region.cells)
+        try:
+            # Regions run in worker threads, outside the profile of the run that split the sheet (before Python 3.12)
+            with PROFILER.profile_run(self.__class__.__name__, "%s!%s" % (sheet_name, region.range)):
+                return self.run_with_escalation(
+                    lambda: self._execute(excel_file_path, sheet_name=sheet_name, max_iterations=20, **prompt_kwargs, **region_kwargs),
+                    model,
+                    is_acceptable=lambda result: bool(result.mappings)
+                )
+        except Exception:
+            logger.exception("Mapping region %s of sheet '%s' failed", region.range, sheet_name)
+            return None
+    
+    def _with_candidates(self, excel_file_path: str, sheet_name: str, prompt_kwargs: dict,
+                         min_row: int = 1, max_row: int = None) -> dict:
+        """Add locally ranked CoA candidates for the sheet's labels as hints.
+        
+        The LLM then confirms candidates with the tools instead of discovering them. The client's
+        full CoA list stays in the prompt prefix (so it is cached across sheets and items no label
+        ranked can still be mapped). Without a CoA list, with EXCEL_AGENT_COA_CANDIDATES=0 or when
+        no label has a candidate, the prompt is unchanged.
+        """
+        coa_items = prompt_kwargs.get("coa_items")
+        if not coa_items or os.getenv("EXCEL_AGENT_COA_CANDIDATES", "1") != "1":
+            return prompt_kwargs
+        snapshot = get_sheet_snapshot(excel_file_path, sheet_name)
+        candidates = get_coa_matcher(tuple(coa_items)).candidates_for_sheet(snapshot, min_row, max_row)
+        if not candidates:
+            return prompt_kwargs
+        
+        likely = relevant_items(candidates, coa_items)
+        logger.info("Sheet '%s': %d labels with CoA candidates, %d likely CoA items", sheet_name, len(candidates), len(likely))
+        return dict(
+            prompt_kwargs,
+            candidate_mappings=format_candidates(candidates),
+            likely_coa_items=", ".join(likely),
+            candidate_instructions="The labels above were matched to CoA items offline (label [cells]: item score). Confirm a "
+                                   "candidate by reading the label's row with the tools and map its values; ignore candidates "
+                                   "that do not fit. The candidates are hints only: any item of the full CoA list may be used.",
+        )
+    
+    def _with_encoding(self, encoding: Optional[SingleSheetEncoding], prompt_kwargs: dict,
+                       min_row: int = 1, max_row: int = None) -> dict:
+        """Attach the sheet's encoding to the prompt in compact form, limited to the tables in rows min_row..max_row.
+        
+        The text is kept within EXCEL_AGENT_ENCODING_TOKENS (0 leaves the encoding out).
+        """
+        if encoding is None or DEFAULT_MAX_TOKENS <= 0:
+            return prompt_kwargs
+        return dict(prompt_kwargs, encoded_sheet=cached_compact_encoding(encoding, DEFAULT_MAX_TOKENS, min_row, max_row))
+    
+    def _execute(self, excel_file_path: str, sheet_name: str = None, max_iterations: int = 50, **prompt_kwargs) -> SheetCoAMapping:
         """Execute task on Excel file using LLM and tools."""
         logger.info("Excel file: %s", excel_file_path)
         
@@ -42,100 +289,21 @@ class ExcelAgent(BaseAgent):
             {"role": "system", "content": "You are an expert financial analyst that understands spreadsheets."},
             {"role": "user", "content": task_prompt}
         ]
-        iteration = 0
-        max_iterations = 50
-        
-        # Format tools for OpenAI API
-        tools = []
-        for tool in self.tools:
-            tool_schema = {
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.args_schema.schema() if hasattr(tool, 'args_schema') else {}
-                }
-            }
-            tools.append(tool_schema)
-        
-        while iteration < max_iterations:
-            iteration += 1
-            print("=" * 80)
-            logger.info("LLM iteration %d", iteration)
-            
-            # Reduce messages to prevent context from becoming too long
-            # messages = self.reduce_messages(messages)
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto"
-            )
-            
-            # Update cost tracker with response information
-            self.update_cost_tracker(response)
-            
-            message = response.choices[0].message
-
-            if not message.tool_calls:
-                break
-            
-            messages.append(message)
-        
-            logger.info("LLM requested %d tool calls", len(message.tool_calls))
-            
-            for tool_call in message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = eval(tool_call.function.arguments)
-                tool_args['file_path'] = excel_file_path
-                
-                logger.info("Executing tool: %s with args: %s", tool_name, tool_args)
-                
-                tool_func = next(tool for tool in self.tools if tool.name == tool_name)
-                logger.info("Calling tool function: %s with arguments: %s", tool_name, tool_args)
-                result = tool_func.invoke(tool_args)
-                
-                logger.info("Tool %s returned result: %s...", tool_name, str(result)[:200])
-                
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": str(result)
-                })
+        
+        message, result = self.run_tool_loop(messages, excel_file_path, max_iterations, result_model=SheetCoAMapping)
 
         logger.info("LLM response text: %s", message.content)
         final_cost = self.compute_total_cost()
         logger.info("Task completed. Final cost: $%s (API calls: %s, tokens: %s)", final_cost['total_cost_usd'], final_cost['api_calls'], final_cost['total_tokens'])
         
-        # Write the final response to a file called output.txt
-        if message.content:
+        # Write the final response to a file called output.txt (regions of a sheet run concurrently, so only whole-sheet runs do)
+        if message.content and "region" not in prompt_kwargs:
             with open("output.txt", "w", encoding="utf-8") as f:
                 f.write(message.content)
             logger.info("Final response written to file: output.txt")
 
-        # Get structured response using chat.completions.create with response_format
-        pydantic_schema = SheetCoAMapping.model_json_schema()
-        json_schema = {
-            "name": pydantic_schema['title'],
-            "schema": pydantic_schema
-        }
-        logger.info("JSON schema: %r", json_schema)
-        final_response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            response_format={"type": "json_schema", "json_schema": json_schema},
-        )
-
-        logger.info("Final LLM response object: %r", final_response)
-        
-        # Update cost tracker with final response
-        self.update_cost_tracker(final_response)
-
-        # Parse the JSON response into SheetCoAMapping
-        response_content = final_response.choices[0].message.content
-        parsed_data = json.loads(response_content)
-        parsed_response = SheetCoAMapping(**parsed_data)
+        # Fall back to a separate structured-output call only if no result was submitted
+        parsed_response = result or self.request_structured_output(messages, message, SheetCoAMapping)
         
         logger.info("Successfully parsed response into SheetCoAMapping")
         return parsed_response
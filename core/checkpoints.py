@@ -0,0 +1,104 @@
+import hashlib
+import os
+from typing import Any, Dict, List, Optional, Sequence
+import orjson
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def message_dict(message: Any) -> Dict[str, Any]:
+    """Plain dict form of a chat message (dicts pass through; SDK message objects keep role, content and tool calls)."""
+    if isinstance(message, dict):
+        return message
+    result = {"role": message.role, "content": message.content}
+    if message.tool_calls:
+        result["tool_calls"] = [
+            {"id": tool_call.id, "type": "function",
+             "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments}}
+            for tool_call in message.tool_calls
+        ]
+    return result
+
+
+class ConversationCheckpoint:
+    """Append-only JSONL log of one agent conversation, written after every completed turn.
+
+    The first line holds the initial messages, each further line the messages a turn added, the
+    iteration number, the LLM usage so far and, once submitted, the result. Every line is flushed
+    and fsynced, and a torn last line (the process died mid-write) is ignored on load, so the log
+    always describes the last completed turn.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Return {messages, iteration, usage, result} of the last completed turn, or None if there is no checkpoint."""
+        if not os.path.exists(self.path):
+            return None
+        records = []
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    break
+        if not records:
+            return None
+        state = {"messages": list(records[0]["messages"]), "iteration": 0, "usage": None, "result": None}
+        for record in records[1:]:
+            state["messages"].extend(record["messages"])
+            state.update(iteration=record["iteration"], usage=record["usage"], result=record.get("result"))
+        return state
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.write(orjson.dumps(record, default=str) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, messages: Sequence[Any]) -> None:
+        """Start a new log with the conversation's initial messages."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._append({"messages": [message_dict(message) for message in messages]})
+
+    def append(self, messages: Sequence[Any], iteration: int, usage: Dict[str, Any],
+               result: Optional[Dict[str, Any]] = None) -> None:
+        """Record a completed turn: the messages it added, the iteration number and the usage so far."""
+        self._append({"messages": [message_dict(message) for message in messages], "iteration": iteration,
+                      "usage": usage, "result": result})
+
+    def discard(self) -> None:
+        """Remove the log once the conversation has finished."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class CheckpointStore:
+    """Directory of conversation checkpoints keyed on everything that determines a conversation."""
+
+    def __init__(self, directory: str, enabled: bool = True):
+        self.directory = directory
+        self.enabled = enabled
+
+    def conversation(self, *parts: Any) -> Optional[ConversationCheckpoint]:
+        """Return the checkpoint for the conversation identified by parts, or None if checkpointing is off."""
+        if not self.enabled:
+            return None
+        digest = hashlib.sha256(orjson.dumps(list(parts), default=str)).hexdigest()[:24]
+        return ConversationCheckpoint(os.path.join(self.directory, "%s.jsonl" % digest))
+
+    def pending(self) -> List[str]:
+        """Paths of checkpoints left by conversations that did not finish."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+
+CHECKPOINTS = CheckpointStore(
+    directory=os.getenv("EXCEL_AGENT_CHECKPOINT_DIR", os.path.join(os.getenv("EXCEL_AGENT_TELEMETRY_DIR", "logs"), "checkpoints")),
+    enabled=os.getenv("EXCEL_AGENT_CHECKPOINTS", "1") == "1",
+)
@@ -0,0 +1,196 @@
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from openpyxl.utils import get_column_letter
+from core.logger import setup_logger
+from tools.snapshot import SheetSnapshot
+
+logger = setup_logger(__name__)
+
+_WORD = re.compile(r"[a-z]+")
+
+# Abbreviations used in CoA codes and sheet labels, expanded before matching
+_ABBREVIATIONS = {
+    "exp": "expense", "expenses": "expense", "costs": "cost", "opex": "operating expense",
+    "cogs": "cost of sales", "cos": "cost of sales", "inc": "income", "int": "interest",
+    "direc": "director", "directors": "director", "remu": "remuneration", "amort": "amortisation",
+    "amortization": "amortisation", "depr": "depreciation", "depn": "depreciation", "da": "depreciation amortisation",
+    "intang": "intangible", "util": "utilities", "utility": "utilities", "pref": "preference", "div": "dividend",
+    "exst": "existing", "acct": "account", "accr": "accrued", "accrual": "accrued", "accruals": "accrued",
+    "liab": "liability", "liabilities": "liability", "lt": "long term", "def": "deferred", "earn": "earnings",
+    "equiv": "equivalents", "cf": "cash flow", "haed": "head", "ho": "head office", "capex": "capital expenditure",
+    "fy": "year", "yoy": "year", "no": "number", "qty": "number", "prepayments": "prepaid",
+}
+
+# Accounting synonyms: a label containing the key also counts as containing the value
+_SYNONYMS = {
+    "turnover": "revenue", "sales": "revenue", "income": "revenue", "takings": "revenue",
+    "food": "restaurant food", "drink": "beverage", "drinks": "beverage", "wet": "beverage", "dry": "food",
+    "bar": "beverage", "liquor": "beverage", "wine": "beverage",
+    "wages": "wages staff", "salaries": "wages staff", "salary": "wages staff", "payroll": "wages staff",
+    "staff": "wages", "labour": "wages", "labor": "wages", "personnel": "wages",
+    "rent": "lease rental occupancy", "rental": "lease rent", "lease": "rental rent", "rates": "rates occupancy",
+    "property": "occupancy", "premises": "occupancy", "energy": "utilities", "electricity": "utilities",
+    "gas": "utilities", "insurances": "insurance",
+    "inventory": "stocks", "stock": "stocks", "stocks": "inventory", "debtors": "receivable", "creditors": "payable",
+    "payables": "payable", "trade": "account", "bank": "cash", "cash": "bank",
+    "corporation": "income tax", "paye": "paye ni", "ni": "paye",
+    "loan": "debt", "borrowings": "debt", "debt": "loan", "notes": "note",
+    "fixed": "tangible", "tangible": "fixed", "ppe": "tangible fixed assets",
+    "covers": "covers served", "sites": "unit", "site": "unit", "restaurants": "unit", "units": "unit",
+    "preopening": "pre open", "opening": "open", "maintenance": "maintenance",
+    "headoffice": "head office", "central": "head office", "overhead": "overheads",
+}
+
+_PHRASES = [
+    (re.compile(r"\bcost of (goods sold|sales)\b"), "cogs cost of sales"),
+    (re.compile(r"\bgross (profit|margin)\b"), "gross profit"),
+    (re.compile(r"\bpre[- ]?open(ing)?\b"), "pre open"),
+    (re.compile(r"\bprofit and loss\b|\bp ?& ?l\b"), "profit and loss"),
+    (re.compile(r"\bvalue added tax\b"), "vat"),
+    (re.compile(r"\bnational insurance\b"), "ni paye"),
+]
+
+
+def _is_label(value) -> bool:
+    if isinstance(value, str):
+        return bool(value.strip()) and not value.startswith("=")
+    return False
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase words of a CoA code or label, with abbreviations expanded and synonyms appended."""
+    text = text.replace("_", " ").replace("&", " and ").lower()
+    extra = [replacement for pattern, replacement in _PHRASES if pattern.search(text)]
+    words = []
+    for word in _WORD.findall(text):
+        words.append(_ABBREVIATIONS.get(word, word))
+        if word in _SYNONYMS:
+            extra.append(_SYNONYMS[word])
+    return " ".join(words + extra)
+
+
+def _ngrams(text: str, n: int = 3) -> List[str]:
+    grams = []
+    for word in text.split():
+        padded = " %s " % word
+        grams.extend(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+    return grams
+
+
+@dataclass
+class LabelCandidates:
+    """Ranked CoA candidates for one distinct text label of a sheet."""
+    label: str
+    cells: List[str] = field(default_factory=list)
+    candidates: List[Tuple[str, float]] = field(default_factory=list)
+
+    @property
+    def best_score(self) -> float:
+        return self.candidates[0][1] if self.candidates else 0.0
+
+
+class CoAMatcher:
+    """Ranks CoA items for free-text labels by cosine similarity of character 3-gram TF-IDF vectors.
+
+    Both sides go through normalize_text first, so abbreviations in the codes (EXP, INTANG) and
+    accounting synonyms in the labels (turnover, rent, salaries) meet in the same n-grams.
+    """
+
+    def __init__(self, coa_items: Sequence[str], descriptions: Optional[Dict[str, str]] = None):
+        """Fit the vocabulary and IDF weights on the CoA items (and optional free-text descriptions of them)."""
+        self.items = list(dict.fromkeys(coa_items))
+        descriptions = descriptions or {}
+        documents = [_ngrams(normalize_text("%s %s" % (item, descriptions.get(item, "")))) for item in self.items]
+
+        vocabulary: Dict[str, int] = {}
+        document_frequency: List[int] = []
+        for grams in documents:
+            for gram in set(grams):
+                if gram not in vocabulary:
+                    vocabulary[gram] = len(vocabulary)
+                    document_frequency.append(0)
+                document_frequency[vocabulary[gram]] += 1
+        self.vocabulary = vocabulary
+        self.idf = np.log((1 + len(documents)) / (1 + np.array(document_frequency, dtype=float))) + 1.0
+        # N-grams no CoA item contains still count towards a label's norm
+        self.unseen_idf = float(np.log(1 + len(documents)) + 1.0)
+        self.matrix = np.vstack([self._vector(grams) for grams in documents]) if documents else np.zeros((0, len(vocabulary)))
+
+    def _vector(self, grams: Sequence[str]) -> np.ndarray:
+        vector = np.zeros(len(self.vocabulary))
+        unseen = 0.0
+        for gram in grams:
+            position = self.vocabulary.get(gram)
+            if position is None:
+                unseen += 1.0
+            else:
+                vector[position] += 1.0
+        vector *= self.idf
+        norm = np.sqrt(np.dot(vector, vector) + (unseen * self.unseen_idf) ** 2)
+        return vector / norm if norm else vector
+
+    def rank(self, labels: Sequence[str], top_k: int = 3, min_score: float = 0.3) -> List[List[Tuple[str, float]]]:
+        """Return up to top_k (item, score) pairs scoring at least min_score for each label, best first."""
+        if not labels or not self.items:
+            return [[] for _ in labels]
+        vectors = np.vstack([self._vector(_ngrams(normalize_text(label))) for label in labels])
+        scores = vectors @ self.matrix.T
+        top = np.argsort(-scores, axis=1)[:, :top_k]
+        return [[(self.items[column], round(float(scores[row, column]), 2)) for column in top[row]
+                 if scores[row, column] >= min_score]
+                for row in range(len(labels))]
+
+    def candidates_for_sheet(self, snapshot: SheetSnapshot, min_row: int = 1, max_row: Optional[int] = None,
+                             top_k: int = 3, min_score: float = 0.3, max_labels: int = 60) -> List[LabelCandidates]:
+        """Rank candidates for every distinct text label in the given rows of a sheet.
+
+        Labels are the text cells of the rows (numbers, dates and formulas are skipped); repeated
+        labels are ranked once and list the cells they appear in. Only labels with at least one
+        candidate are returned, the max_labels best-scoring ones in sheet order.
+        """
+        max_row = min(max_row or snapshot.max_row, snapshot.max_row)
+        labels: Dict[str, LabelCandidates] = {}
+        for row_number, row in snapshot.iter_rows():
+            if not min_row <= row_number <= max_row:
+                continue
+            for column, value in enumerate(row, start=1):
+                if not _is_label(value):
+                    continue
+                key = " ".join(value.split())
+                entry = labels.setdefault(key.lower(), LabelCandidates(label=key))
+                entry.cells.append("%s%d" % (get_column_letter(column), row_number))
+
+        entries = list(labels.values())
+        for entry, candidates in zip(entries, self.rank([entry.label for entry in entries], top_k, min_score)):
+            entry.candidates = candidates
+        matched = [entry for entry in entries if entry.candidates]
+        if len(matched) > max_labels:
+            kept = {id(entry) for entry in sorted(matched, key=lambda entry: -entry.best_score)[:max_labels]}
+            matched = [entry for entry in matched if id(entry) in kept]
+        logger.info("Sheet '%s' rows %d-%d: %d of %d distinct labels have CoA candidates",
+                    snapshot.sheet_name, min_row, max_row, len(matched), len(entries))
+        return matched
+
+
+@lru_cache(maxsize=8)
+def get_coa_matcher(coa_items: Tuple[str, ...]) -> CoAMatcher:
+    """Return the matcher for a client's CoA list, fitted once per process."""
+    return CoAMatcher(coa_items)
+
+
+def format_candidates(candidates: Sequence[LabelCandidates], max_cells: int = 3) -> str:
+    """Render candidates as a compact table: one line per label with its cells and scored CoA items."""
+    lines = []
+    for entry in candidates:
+        cells = ", ".join(entry.cells[:max_cells]) + (" +%d" % (len(entry.cells) - max_cells) if len(entry.cells) > max_cells else "")
+        lines.append("\n  - %s [%s]: %s" % (entry.label, cells, ", ".join("%s %.2f" % candidate for candidate in entry.candidates)))
+    return "".join(lines)
+
+
+def relevant_items(candidates: Sequence[LabelCandidates], coa_items: Sequence[str]) -> List[str]:
+    """CoA items that appear among the candidates, in the client's CoA order."""
+    proposed = {item for entry in candidates for item, _ in entry.candidates}
+    return [item for item in dict.fromkeys(coa_items) if item in proposed]
@@ -0,0 +1,128 @@
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+import orjson
+from pydantic import ValidationError
+from core.logger import setup_logger
+from pydantic_models.models import SingleSheetEncoding, TableInfo
+
+logger = setup_logger(__name__)
+
+# Successively terser renderings: characters kept of the sheet/table descriptions and of the
+# column descriptions, and sample values shown per column
+_DETAIL_LEVELS = ((300, 120, 3), (160, 60, 2), (80, 0, 1), (0, 0, 0))
+
+DEFAULT_MAX_TOKENS = int(os.getenv("EXCEL_AGENT_ENCODING_TOKENS", "600"))
+
+
+def _tokens(text: str) -> int:
+    """Rough token count of prompt text (about four characters per token)."""
+    return len(text) // 4
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(str(text).split())
+    if len(text) <= limit:
+        return text
+    return text[:max(limit - 3, 0)].rstrip() + "..."
+
+
+def _samples(values: List[Any], count: int) -> str:
+    # Literal values say more about a column than formula text, so they are shown first
+    values = sorted(values, key=lambda value: isinstance(value, str) and value.startswith("="))
+    return ", ".join(orjson.dumps(_clip(value, 24) if isinstance(value, str) else value, default=str).decode()
+                     for value in values[:count])
+
+
+def _overlaps(table: TableInfo, min_row: int, max_row: Optional[int]) -> bool:
+    return table.boundaries.end_row >= min_row and (max_row is None or table.boundaries.start_row <= max_row)
+
+
+def _render(encoding: SingleSheetEncoding, tables: List[TableInfo], level: Tuple[int, int, int]) -> List[str]:
+    description_chars, column_chars, sample_count = level
+    dimensions = encoding.dimensions
+    line = "Sheet '%s' %s (%d rows x %d columns)" % (encoding.sheet_name, dimensions.range, dimensions.rows, dimensions.columns)
+    if description_chars:
+        line += ": " + _clip(encoding.sheet_description, description_chars)
+    lines = [line]
+    for table in tables:
+        line = "Table '%s' %s" % (table.table_name, table.boundaries.range)
+        if table.row_headers.has_row_headers and table.row_headers.row_header_column:
+            line += ", row labels in column %s" % table.row_headers.row_header_column
+        if description_chars:
+            line += ": " + _clip(table.table_description, description_chars)
+        lines.append(line)
+        for column in table.columns:
+            line = "  %s %s [%s]" % (column.column_letter, _clip(column.column_name, 40), column.data_type)
+            if sample_count and column.sample_values:
+                line += " e.g. " + _samples(column.sample_values, sample_count)
+            if column_chars:
+                line += " - " + _clip(column.column_description, column_chars)
+            lines.append(line)
+    return lines
+
+
+def compact_encoding(encoding: SingleSheetEncoding, max_tokens: int = DEFAULT_MAX_TOKENS,
+                     min_row: int = 1, max_row: Optional[int] = None) -> str:
+    """Render a sheet encoding as terse text of at most about max_tokens tokens.
+
+    Only tables overlapping rows min_row..max_row are included. Descriptions and sample values are
+    shortened and then dropped until the text fits; if even the bare layout does not fit, the
+    remaining column lines are cut off with a note.
+    """
+    tables = [table for table in encoding.tables if _overlaps(table, min_row, max_row)]
+    for level in _DETAIL_LEVELS:
+        lines = _render(encoding, tables, level)
+        if _tokens("\n".join(lines)) <= max_tokens:
+            return "\n".join(lines)
+
+    kept, size = [], 0
+    for line in lines:
+        if (size + len(line) + 1) // 4 > max_tokens:
+            break
+        kept.append(line)
+        size += len(line) + 1
+    kept.append("... (%d more lines omitted; use the tools for the rest of the layout)" % (len(lines) - len(kept)))
+    return "\n".join(kept)
+
+
+@lru_cache(maxsize=128)
+def _load(path: str, mtime_ns: int) -> Optional[SingleSheetEncoding]:
+    try:
+        with open(path, "rb") as f:
+            return SingleSheetEncoding.model_validate(orjson.loads(f.read()))
+    except (orjson.JSONDecodeError, ValidationError) as e:
+        logger.warning("Ignoring unreadable sheet encoding %s: %s", path, e)
+        return None
+
+
+def load_sheet_encoding(encoded_sheets_dir: str, sheet_name: str) -> Optional[SingleSheetEncoding]:
+    """Return the saved encoding of a sheet, or None if there is none; parsed once per file version."""
+    path = os.path.join(encoded_sheets_dir, "%s.json" % sheet_name)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _load(os.path.abspath(path), mtime_ns)
+
+
+# Rendered encodings keyed on the encoding object and the rendering arguments; the object is kept
+# with its text so that its id cannot be reused by another encoding while the entry exists
+_COMPACT_CACHE: Dict[Tuple[int, int, int, Optional[int]], Tuple[SingleSheetEncoding, str]] = {}
+_COMPACT_CACHE_SIZE = 256
+
+
+def cached_compact_encoding(encoding: SingleSheetEncoding, max_tokens: int = DEFAULT_MAX_TOKENS,
+                            min_row: int = 1, max_row: Optional[int] = None) -> str:
+    """compact_encoding, rendered once per encoding, budget and row range."""
+    key = (id(encoding), max_tokens, min_row, max_row)
+    cached = _COMPACT_CACHE.get(key)
+    if cached is not None and cached[0] is encoding:
+        return cached[1]
+    text = compact_encoding(encoding, max_tokens, min_row, max_row)
+    if len(_COMPACT_CACHE) >= _COMPACT_CACHE_SIZE:
+        _COMPACT_CACHE.clear()
+    _COMPACT_CACHE[key] = (encoding, text)
+    logger.info("Compact encoding of sheet '%s': %d tokens (full JSON %d)", encoding.sheet_name, _tokens(text),
+                _tokens(encoding.model_dump_json()))
+    return text
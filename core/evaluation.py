@@ -0,0 +1,264 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+from bisect import bisect_left
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+from core.logger import setup_logger
+from pydantic_models.models import EvaluationReport, GroundTruthList, MatchCounts, SheetCoAMapping
+
+logger = setup_logger(__name__)
+
+_MONTHS = {
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "sept": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+_MONTH_NAME = re.compile(r"^([a-z]{3,9})[\s\-'/.,]*(\d{2}|\d{4})$")
+_YEAR_MONTH_NAME = re.compile(r"^(\d{4})[\s\-/]*([a-z]{3,9})$")
+_ISO_DATE = re.compile(r"^(\d{4})-(\d{1,2})(?:-\d{1,2})?(?:[ t].*)?$")
+_NUMERIC_MONTH = re.compile(r"^(\d{1,2})[/\-.](\d{2}|\d{4})$")
+_FISCAL_YEAR = re.compile(r"^fy\s*'?(\d{2}|\d{4})$")
+_QUARTER = re.compile(r"^q([1-4])[\s\-']*(?:fy)?\s*(\d{2}|\d{4})$")
+
+
+def _year(text: str) -> int:
+    year = int(text)
+    return year + 2000 if year < 100 else year
+
+
+@lru_cache(maxsize=65536)
+def _normalize_timestamp_text(text: str) -> str:
+    text = " ".join(text.strip().lower().split())
+    match = _MONTH_NAME.match(text)
+    if match and match.group(1)[:3] in _MONTHS:
+        return "%04d-%02d" % (_year(match.group(2)), _MONTHS[match.group(1)[:3]])
+    match = _YEAR_MONTH_NAME.match(text)
+    if match and match.group(2)[:3] in _MONTHS:
+        return "%04d-%02d" % (int(match.group(1)), _MONTHS[match.group(2)[:3]])
+    match = _ISO_DATE.match(text)
+    if match:
+        return "%04d-%02d" % (int(match.group(1)), int(match.group(2)))
+    match = _NUMERIC_MONTH.match(text)
+    if match and 1 <= int(match.group(1)) <= 12:
+        return "%04d-%02d" % (_year(match.group(2)), int(match.group(1)))
+    match = _FISCAL_YEAR.match(text)
+    if match:
+        return "FY%04d" % _year(match.group(1))
+    match = _QUARTER.match(text)
+    if match:
+        return "%04d-Q%s" % (_year(match.group(2)), match.group(1))
+    return text
+
+
+def normalize_timestamp(value: Any) -> str:
+    """Normalize a period label such as 'Jul 25', 'July 2025', '2025-07-01' or '07/25' to '2025-07'; 'FY25' becomes 'FY2025'."""
+    if isinstance(value, (datetime, date)):
+        return "%04d-%02d" % (value.year, value.month)
+    if value is None:
+        return ""
+    return _normalize_timestamp_text(str(value))
+
+
+@lru_cache(maxsize=65536)
+def normalize_label(value: str) -> str:
+    """Normalize a free-text label (unit, CoA code) for comparison: case- and whitespace-insensitive."""
+    return " ".join(str(value).strip().lower().split())
+
+
+@dataclass
+class EvaluationOptions:
+    """Matching tolerances for the evaluator."""
+    value_abs_tolerance: float = 0.0
+    value_rel_tolerance: float = 0.0
+    match_timestamp: bool = True
+    match_unit: bool = True
+
+    @property
+    def exact_values(self) -> bool:
+        return self.value_abs_tolerance == 0 and self.value_rel_tolerance == 0
+
+    def within_tolerance(self, predicted: float, expected: float) -> bool:
+        allowed = max(self.value_abs_tolerance, self.value_rel_tolerance * abs(expected))
+        return abs(predicted - expected) <= allowed
+
+
+def _field(entry: Any, name: str, default: Any = None) -> Any:
+    if isinstance(entry, dict):
+        return entry.get(name, default)
+    return getattr(entry, name, default)
+
+
+def _group_key(entry: Any, options: EvaluationOptions) -> Tuple[Hashable, ...]:
+    return (
+        normalize_label(_field(entry, "CoA_label")),
+        normalize_timestamp(_field(entry, "timestamp_of_value")) if options.match_timestamp else None,
+        normalize_label(_field(entry, "unit")) if options.match_unit else None,
+    )
+
+
+def _match_group(predicted: List[Tuple[float, int]], expected: List[Tuple[float, int]],
+                 options: EvaluationOptions) -> List[Tuple[int, int]]:
+    """One-to-one match (value, index) lists of a single join group and return matched index pairs."""
+    if options.exact_values:
+        # Hash join on the value
+        by_value: Dict[float, List[int]] = defaultdict(list)
+        for value, index in expected:
+            by_value[value].append(index)
+        pairs = []
+        for value, index in predicted:
+            candidates = by_value.get(value)
+            if candidates:
+                pairs.append((index, candidates.pop()))
+        return pairs
+
+    # Tolerant join: sort both sides and sweep, matching each prediction to the closest free expected value.
+    # The nearest free slot on each side is found with "next free slot" union-find links (path-halved),
+    # so runs of equal, already matched values are skipped in near-constant time
+    predicted = sorted(predicted)
+    expected = sorted(expected)
+    expected_values = [value for value, _ in expected]
+    size = len(expected)
+    # right[i]: the first free slot >= i (size if none); left[i + 1]: the last free slot <= i (-1 if none)
+    right = list(range(size + 1))
+    left = list(range(-1, size))
+
+    def free_right(slot: int) -> int:
+        while right[slot] != slot:
+            right[slot] = right[right[slot]]
+            slot = right[slot]
+        return slot
+
+    def free_left(slot: int) -> int:
+        while slot >= 0 and left[slot + 1] != slot:
+            parent = left[slot + 1]
+            left[slot + 1] = left[parent + 1] if parent >= 0 else -1
+            slot = left[slot + 1]
+        return slot
+
+    pairs = []
+    for value, index in predicted:
+        position = bisect_left(expected_values, value)
+        best = None
+        for candidate in (free_left(position - 1), free_right(position)):
+            if 0 <= candidate < size and options.within_tolerance(value, expected_values[candidate]):
+                if best is None or abs(expected_values[candidate] - value) < abs(expected_values[best] - value):
+                    best = candidate
+        if best is not None:
+            right[best] = best + 1
+            left[best + 1] = best - 1
+            pairs.append((index, expected[best][1]))
+    return pairs
+
+
+def _counts(predicted: int, expected: int, true_positives: int) -> MatchCounts:
+    precision = true_positives / predicted if predicted else 0.0
+    recall = true_positives / expected if expected else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return MatchCounts(predicted=predicted, expected=expected, true_positives=true_positives,
+                       precision=round(precision, 6), recall=round(recall, 6), f1=round(f1, 6))
+
+
+def evaluate(predictions: Iterable[Any], ground_truth: Iterable[Any],
+             options: Optional[EvaluationOptions] = None) -> EvaluationReport:
+    """Join predicted ExpectedOutput entries with GroundTruth entries and report precision/recall.
+
+    Entries are grouped with a hash index on (CoA_label, normalized timestamp, unit) and matched
+    one-to-one on value within each group, so the join runs in linear time for exact values
+    (n log n within groups when a value tolerance is set). Entries may be pydantic models or dicts.
+    """
+    options = options or EvaluationOptions()
+    predictions = list(predictions)
+    ground_truth = list(ground_truth)
+
+    predicted_groups: Dict[Tuple, List[Tuple[float, int]]] = defaultdict(list)
+    for index, entry in enumerate(predictions):
+        predicted_groups[_group_key(entry, options)].append((_field(entry, "value"), index))
+    expected_groups: Dict[Tuple, List[Tuple[float, int]]] = defaultdict(list)
+    for index, entry in enumerate(ground_truth):
+        expected_groups[_group_key(entry, options)].append((_field(entry, "value"), index))
+
+    matched_predictions = set()
+    for key, predicted in predicted_groups.items():
+        expected = expected_groups.get(key)
+        if expected:
+            matched_predictions.update(index for index, _ in _match_group(predicted, expected, options))
+
+    per_sheet = defaultdict(lambda: [0, 0, 0])
+    per_coa = defaultdict(lambda: [0, 0, 0])
+    for index, entry in enumerate(predictions):
+        hit = index in matched_predictions
+        for bucket in (per_sheet[str(_field(entry, "sheet_name"))], per_coa[str(_field(entry, "CoA_label"))]):
+            bucket[0] += 1
+            bucket[2] += hit
+    for entry in ground_truth:
+        per_coa[str(_field(entry, "CoA_label"))][1] += 1
+        sheet_name = _field(entry, "sheet_name")
+        if sheet_name is not None:
+            per_sheet[str(sheet_name)][1] += 1
+
+    report = EvaluationReport(
+        overall=_counts(len(predictions), len(ground_truth), len(matched_predictions)),
+        per_sheet={name: _counts(*values) for name, values in sorted(per_sheet.items())},
+        per_coa={name: _counts(*values) for name, values in sorted(per_coa.items())},
+    )
+    logger.info("Evaluation: precision %.4f, recall %.4f, f1 %.4f (%d predicted, %d expected)",
+                report.overall.precision, report.overall.recall, report.overall.f1,
+                len(predictions), len(ground_truth))
+    return report
+
+
+def load_predictions(path: str) -> List[Any]:
+    """Load predicted entries from a SheetCoAMapping JSON file or a directory of them."""
+    files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    entries = []
+    for file_path in files:
+        with open(file_path, "r", encoding="utf-8") as f:
+            entries.extend(SheetCoAMapping(**json.load(f)).mappings)
+    return entries
+
+
+def load_ground_truth(path: str) -> List[Any]:
+    """Load ground truth entries from a GroundTruthList JSON file or a plain JSON list of entries."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return GroundTruthList(**data).entries
+    # Plain lists may carry a sheet_name per entry, which enables per-sheet recall
+    return data
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Evaluate predictions against ground truth and exit non-zero if the F1 score is below --min-f1."""
+    parser = argparse.ArgumentParser(description="Evaluate CoA mappings against ground truth.")
+    parser.add_argument("--predictions", required=True, help="SheetCoAMapping JSON file or directory (e.g. data/client_1/mappings)")
+    parser.add_argument("--ground-truth", required=True, help="GroundTruthList JSON file")
+    parser.add_argument("--abs-tolerance", type=float, default=0.0, help="Absolute value tolerance")
+    parser.add_argument("--rel-tolerance", type=float, default=0.0, help="Relative value tolerance")
+    parser.add_argument("--ignore-timestamp", action="store_true", help="Do not require matching periods")
+    parser.add_argument("--ignore-unit", action="store_true", help="Do not require matching units")
+    parser.add_argument("--min-f1", type=float, default=0.0, help="Fail if the overall F1 score is below this")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    options = EvaluationOptions(value_abs_tolerance=args.abs_tolerance, value_rel_tolerance=args.rel_tolerance,
+                                match_timestamp=not args.ignore_timestamp, match_unit=not args.ignore_unit)
+    report = evaluate(load_predictions(args.predictions), load_ground_truth(args.ground_truth), options)
+
+    report_json = report.model_dump_json(indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json)
+        logger.info("Evaluation report written to: %s", args.output)
+    else:
+        print(report_json)
+    return 0 if report.overall.f1 >= args.min_f1 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional
+import orjson
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def echo_responder(request: Dict[str, Any]) -> Dict[str, Any]:
+    """Default reply: an assistant message echoing the size of the conversation."""
+    return {"role": "assistant", "content": "Received %d messages." % len(request.get("messages", []))}
+
+
+def _conversation_hints(request: Dict[str, Any]) -> Dict[str, Any]:
+    """Sheet names and CoA items mentioned in the agents' task prompts, used to fill in example results."""
+    text = "\n".join(str(message.get("content") or "") for message in request.get("messages", []))
+    hints: Dict[str, Any] = {"location_in_sheet": "A1"}
+    listed = re.search(r"SHEET NAMES TO EVALUATE:\*\*\s*```\n(.*?)```", text, re.S)
+    sheet_names = re.findall(r"^- (.+)$", listed.group(1), re.M) if listed else []
+    named = re.search(r"\*\*Sheet Name\*\*: (.+)", text)
+    if named:
+        sheet_names = [named.group(1).strip()]
+    if sheet_names:
+        hints["sheet_names"] = sheet_names
+        hints["sheet_name"] = hints["name"] = sheet_names[0]
+    coa = re.search(r"## Chart of Accounts Items:\n- (.+)", text)
+    if coa:
+        hints["CoA_label"] = coa.group(1).strip()
+    return hints
+
+
+def schema_example(schema: Dict[str, Any], hints: Optional[Dict[str, Any]] = None,
+                   defs: Optional[Dict[str, Any]] = None, name: Optional[str] = None) -> Any:
+    """Build a minimal instance of a JSON schema, taking field values from hints where a field name matches.
+
+    Arrays get one item, except arrays of objects with a sheet_name, which get one item per hinted sheet.
+    """
+    hints = hints or {}
+    defs = schema.get("$defs", defs or {})
+    if "$ref" in schema:
+        return schema_example(defs[schema["$ref"].rsplit("/", 1)[-1]], hints, defs, name)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"] or schema["anyOf"]
+        return schema_example(options[0], hints, defs, name)
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {field: schema_example(subschema, hints, defs, field) for field, subschema in schema.get("properties", {}).items()}
+    if kind == "array":
+        item = schema.get("items", {})
+        resolved = defs.get(item["$ref"].rsplit("/", 1)[-1], item) if "$ref" in item else item
+        if "sheet_name" in resolved.get("properties", {}) and len(hints.get("sheet_names", [])) > 1:
+            return [schema_example(item, dict(hints, sheet_name=sheet_name), defs) for sheet_name in hints["sheet_names"]]
+        return [schema_example(item, hints, defs)]
+    if name in hints:
+        return hints[name]
+    return {"integer": 1, "number": 1.0, "boolean": True, "null": None}.get(kind, "example")
+
+
+def submit_result_responder(request: Dict[str, Any]) -> Dict[str, Any]:
+    """Reply that immediately submits a schema-valid result, so whole agent pipelines can run offline.
+
+    The result goes through the submit_result tool if it is offered, or as JSON content for a
+    structured-output request; anything else is echoed.
+    """
+    hints = _conversation_hints(request)
+    for tool in request.get("tools") or []:
+        function = tool.get("function", {})
+        if function.get("name") == "submit_result":
+            arguments = schema_example(function.get("parameters", {}), hints)
+            return {"role": "assistant", "content": None, "tool_calls": [{
+                "id": "call_%s" % uuid.uuid4().hex[:12], "type": "function",
+                "function": {"name": "submit_result", "arguments": orjson.dumps(arguments).decode()}}]}
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return {"role": "assistant", "content": orjson.dumps(schema_example(response_format["json_schema"]["schema"], hints)).decode()}
+    return echo_responder(request)
+
+
+class _FakeLLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        payload = orjson.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        request = orjson.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": "Unknown path %s" % self.path, "type": "not_found"}})
+            return
+        self.server.fake.handle(self, request)
+
+
+class FakeLLMServer:
+    """Local OpenAI-compatible chat completions endpoint that enforces its own limits.
+
+    Requests above rpm (sliding one-minute window) or max_concurrency get a 429 with Retry-After,
+    and error_rate of the rest fail at random with a 429 or 500, so clients can be exercised
+    against rate limiting offline. Replies come from responder(request) after latency seconds.
+    """
+
+    def __init__(self, rpm: float = 600, max_concurrency: int = 4, error_rate: float = 0.0, latency: float = 0.05,
+                 responder: Callable[[Dict[str, Any]], Dict[str, Any]] = echo_responder, host: str = "127.0.0.1", port: int = 0):
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.latency = latency
+        self.responder = responder
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "errors": 0}
+        self._accepted = deque()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _FakeLLMHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d/v1" % (host, port)
+
+    def _admit(self) -> Optional[float]:
+        """Admit a request, or return the Retry-After in seconds if it is over the limits."""
+        with self._lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            while self._accepted and now - self._accepted[0] >= 60:
+                self._accepted.popleft()
+            if len(self._accepted) >= self.rpm:
+                return 60 - (now - self._accepted[0])
+            if self._in_flight >= self.max_concurrency:
+                return 1.0
+            self._accepted.append(now)
+            self._in_flight += 1
+            return None
+
+    def handle(self, handler: _FakeLLMHandler, request: Dict[str, Any]) -> None:
+        retry_after = self._admit()
+        if retry_after is not None:
+            with self._lock:
+                self.stats["rate_limited"] += 1
+            handler._send(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                          {"Retry-After": "%.2f" % retry_after})
+            return
+        try:
+            time.sleep(self.latency)
+            if random.random() < self.error_rate:
+                with self._lock:
+                    self.stats["errors"] += 1
+                if random.random() < 0.5:
+                    handler._send(429, {"error": {"message": "Injected rate limit", "type": "rate_limit_exceeded"}})
+                else:
+                    handler._send(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+                return
+            message = self.responder(request)
+            prompt_tokens = sum(len(str(m.get("content") or "")) for m in request.get("messages", [])) // 4
+            completion_tokens = len(orjson.dumps(message)) // 4
+            with self._lock:
+                self.stats["ok"] += 1
+            handler._send(200, {
+                "id": "chatcmpl-%s" % uuid.uuid4().hex[:12], "object": "chat.completion", "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "message": message,
+                             "finish_reason": "tool_calls" if message.get("tool_calls") else "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def start(self) -> "FakeLLMServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("Fake LLM server listening on %s", self.base_url)
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
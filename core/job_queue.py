@@ -0,0 +1,257 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import orjson
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# A job runs one select task, then an encode and a map task per selected sheet
+TASK_KINDS = ("select", "encode", "map")
+FINISHED = ("done", "failed", "cancelled")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    workbook TEXT NOT NULL,
+    coa_file TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    encoded_sheets_dir TEXT NOT NULL,
+    sheets TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    error TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    kind TEXT NOT NULL,
+    sheet_name TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    result TEXT,
+    error TEXT,
+    queued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (status, priority DESC, job_id, id);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id);
+"""
+
+
+def _row(row: sqlite3.Row, json_fields: Sequence[str] = ()) -> Dict[str, Any]:
+    record = dict(row)
+    for name in json_fields:
+        if record.get(name) is not None:
+            record[name] = orjson.loads(record[name])
+    return record
+
+
+class JobQueue:
+    """SQLite-backed queue of mapping jobs and their select/encode/map tasks.
+
+    Every process (the HTTP server and each worker) opens its own JobQueue on the same file; each
+    thread gets its own connection. Tasks are claimed in a write transaction, highest priority
+    first and oldest job first among equal priorities, so two workers never get the same task.
+    Finishing a task enqueues its follow-up tasks in the same transaction, and the job finishes
+    when it has no queued or running task left.
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 2):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def submit(self, workbook: str, coa_file: str, output_dir: str, encoded_sheets_dir: Optional[str] = None,
+               sheets: Optional[List[str]] = None, priority: int = 0) -> int:
+        """Queue a job and its select task; return the job id."""
+        now = time.time()
+        with self._transaction() as connection:
+            job_id = connection.execute(
+                "INSERT INTO jobs (workbook, coa_file, output_dir, encoded_sheets_dir, sheets, priority, submitted_at) "
+                "VALUES (?, ?, ?, '', ?, ?, ?)",
+                (workbook, coa_file, output_dir, orjson.dumps(sheets).decode() if sheets else None, priority, now)).lastrowid
+            output_dir = os.path.join(output_dir, str(job_id))
+            connection.execute("UPDATE jobs SET output_dir = ?, encoded_sheets_dir = ? WHERE id = ?",
+                               (output_dir, encoded_sheets_dir or os.path.join(output_dir, "encoded_sheets"), job_id))
+            self._add_task(connection, job_id, "select", None, priority, now)
+        logger.info("Queued job %d for %s (priority %d)", job_id, workbook, priority)
+        return job_id
+
+    @staticmethod
+    def _add_task(connection: sqlite3.Connection, job_id: int, kind: str, sheet_name: Optional[str], priority: int,
+                  now: float) -> None:
+        connection.execute("INSERT INTO tasks (job_id, kind, sheet_name, priority, queued_at) VALUES (?, ?, ?, ?, ?)",
+                           (job_id, kind, sheet_name, priority, now))
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """Mark the next queued task as running on worker and return it with its job, or None if the queue is empty."""
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM tasks WHERE status = 'queued' ORDER BY priority DESC, job_id, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE tasks SET status = 'running', worker = ?, started_at = ?, attempts = attempts + 1 "
+                               "WHERE id = ?", (worker, now, row["id"]))
+            connection.execute("UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) "
+                               "WHERE id = ? AND status = 'queued'", (now, row["job_id"]))
+            job = connection.execute("SELECT * FROM jobs WHERE id = ?", (row["job_id"],)).fetchone()
+        task = _row(row)
+        task.update(status="running", worker=worker, started_at=now, attempts=row["attempts"] + 1)
+        task["job"] = _row(job, ("sheets",))
+        return task
+
+    def complete(self, task_id: int, result: Any, follow_ups: Sequence[Tuple[str, Optional[str]]] = ()) -> None:
+        """Record a finished task and queue its follow-up (kind, sheet_name) tasks, unless its job was cancelled."""
+        now = time.time()
+        with self._transaction() as connection:
+            task = connection.execute("SELECT job_id, priority FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            job_status = connection.execute("SELECT status FROM jobs WHERE id = ?", (task["job_id"],)).fetchone()["status"]
+            status = "cancelled" if job_status == "cancelled" else "done"
+            connection.execute("UPDATE tasks SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                               (status, orjson.dumps(result, default=str).decode(), now, task_id))
+            if status == "done":
+                for kind, sheet_name in follow_ups:
+                    self._add_task(connection, task["job_id"], kind, sheet_name, task["priority"], now)
+            self._finish_job_if_idle(connection, task["job_id"], now)
+
+    def fail(self, task_id: int, error: str, retry: bool = True) -> bool:
+        """Record a failed task; it is queued again while it has attempts left. Return True if it was requeued."""
+        now = time.time()
+        with self._transaction() as connection:
+            task = connection.execute("SELECT job_id, attempts FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            job_status = connection.execute("SELECT status FROM jobs WHERE id = ?", (task["job_id"],)).fetchone()["status"]
+            requeue = retry and job_status != "cancelled" and task["attempts"] < self.max_attempts
+            if requeue:
+                connection.execute("UPDATE tasks SET status = 'queued', worker = NULL, error = ? WHERE id = ?", (error, task_id))
+            else:
+                connection.execute("UPDATE tasks SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                                   ("cancelled" if job_status == "cancelled" else "failed", error, now, task_id))
+                self._finish_job_if_idle(connection, task["job_id"], now)
+        return requeue
+
+    @staticmethod
+    def _finish_job_if_idle(connection: sqlite3.Connection, job_id: int, now: float) -> None:
+        counts = dict(connection.execute("SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        if counts.get("queued") or counts.get("running"):
+            return
+        if counts.get("failed"):
+            connection.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                               ("%d task(s) failed" % counts["failed"], now, job_id))
+        else:
+            connection.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'", (now, job_id))
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a job that has not finished: its queued tasks are dropped and running ones are discarded when they end.
+
+        Return False if the job does not exist or has already finished.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            updated = connection.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                (now, job_id)).rowcount
+            if updated:
+                connection.execute("UPDATE tasks SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'",
+                                   (now, job_id))
+        if updated:
+            logger.info("Cancelled job %d", job_id)
+        return bool(updated)
+
+    def job_status(self, job_id: int) -> Optional[str]:
+        """Return the status of a job, or None if it does not exist."""
+        row = self._connection().execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["status"] if row is not None else None
+
+    def requeue_running(self, workers: Optional[Sequence[str]] = None) -> int:
+        """Return running tasks of the given workers (all workers if None) to the queue, e.g. after a crash."""
+        with self._transaction() as connection:
+            if workers is None:
+                ids = [row[0] for row in connection.execute("SELECT id FROM tasks WHERE status = 'running'")]
+            else:
+                ids = [row[0] for row in connection.execute(
+                    "SELECT id FROM tasks WHERE status = 'running' AND worker IN (%s)" % ",".join("?" * len(workers)), list(workers))]
+        for task_id in ids:
+            self.fail(task_id, "Worker stopped while running the task")
+        return len(ids)
+
+    def job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return a job with its tasks, or None."""
+        connection = self._connection()
+        job = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        record = _row(job, ("sheets",))
+        record["tasks"] = [_row(row, ("result",)) for row in
+                           connection.execute("SELECT * FROM tasks WHERE job_id = ? ORDER BY id", (job_id,)).fetchall()]
+        return record
+
+    def jobs(self, status: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Return the most recent jobs, optionally only those with the given status."""
+        query, parameters = "SELECT * FROM jobs", []
+        if status:
+            query, parameters = query + " WHERE status = ?", [status]
+        rows = self._connection().execute(query + " ORDER BY id DESC LIMIT ?", parameters + [limit]).fetchall()
+        return [_row(row, ("sheets",)) for row in rows]
+
+    def metrics(self, window: float = 300.0) -> Dict[str, Any]:
+        """Queue depth, running tasks and job counts, plus throughput and mean wait/run times over the last window seconds."""
+        connection = self._connection()
+        since = time.time() - window
+        depth = {kind: 0 for kind in TASK_KINDS}
+        running = {kind: 0 for kind in TASK_KINDS}
+        for kind, status, count in connection.execute(
+                "SELECT kind, status, COUNT(*) FROM tasks WHERE status IN ('queued', 'running') GROUP BY kind, status"):
+            (depth if status == "queued" else running)[kind] = count
+        jobs = dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        finished = {}
+        for kind, count, wait, run in connection.execute(
+                "SELECT kind, COUNT(*), AVG(started_at - queued_at), AVG(finished_at - started_at) FROM tasks "
+                "WHERE status = 'done' AND finished_at >= ? GROUP BY kind", (since,)):
+            finished[kind] = {"completed": count, "per_minute": round(count * 60 / window, 2),
+                              "mean_wait_s": round(wait or 0.0, 3), "mean_run_s": round(run or 0.0, 3)}
+        jobs_finished = connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'done' AND finished_at >= ?", (since,)).fetchone()[0]
+        return {
+            "queue_depth": sum(depth.values()), "queued_by_kind": depth,
+            "running": sum(running.values()), "running_by_kind": running,
+            "jobs": jobs,
+            "window_s": window,
+            "tasks_per_minute": round(sum(item["completed"] for item in finished.values()) * 60 / window, 2),
+            "jobs_per_minute": round(jobs_finished * 60 / window, 2),
+            "tasks": finished,
+        }
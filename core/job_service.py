@@ -0,0 +1,333 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import signal
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import orjson
+from dotenv import load_dotenv
+from core.job_queue import JobQueue
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+DEFAULT_JOB_DIR = os.getenv("EXCEL_AGENT_JOB_DIR", os.path.join(os.getenv("EXCEL_AGENT_TELEMETRY_DIR", "logs"), "jobs"))
+
+
+def _load_coa_items(coa_file: str) -> List[str]:
+    with open(coa_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data: Any) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def _unsafe_sheet_name(sheet_name: str) -> bool:
+    """Return True if a sheet name could leave the directory it is used as a file name in."""
+    return "/" in sheet_name or "\\" in sheet_name or sheet_name in ("", ".", "..")
+
+
+def run_task(task: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Tuple[str, Optional[str]]]]:
+    """Run one select, encode or map task and return its result summary and follow-up (kind, sheet_name) tasks.
+
+    select writes <output_dir>/selected_sheets.json (the job's own sheet list skips the selector),
+    encode writes the sheet's SingleSheetEncoding unless the encodings directory already has one
+    (a sheet matching a learned template takes the template's encoding instead of calling the encoder),
+    and map writes <output_dir>/mappings/<sheet>.json.
+    """
+    from agents import SheetSelectorAgent, SpreadsheetEncoderAgent
+    from core.encodings import load_sheet_encoding
+    from core.templates import TEMPLATES, adapt_encoding, sheet_fingerprint
+    from core.utils import get_sheet_names
+    from main import map_sheet
+    from tools.snapshot import get_sheet_snapshot
+
+    job = task["job"]
+    workbook, output_dir, encoded_sheets_dir = job["workbook"], job["output_dir"], job["encoded_sheets_dir"]
+    sheet_name = task["sheet_name"]
+
+    if task["kind"] == "select":
+        # Sheet names become file names under the job's directories, so only the workbook's own are accepted
+        sheet_names = get_sheet_names(workbook)
+        sheets = job["sheets"]
+        if sheets:
+            unknown = [sheet for sheet in sheets if sheet not in sheet_names or _unsafe_sheet_name(sheet)]
+            if unknown:
+                raise ValueError("Sheets not in %s: %s" % (workbook, unknown))
+        else:
+            selection = SheetSelectorAgent(api_key=os.getenv("OPENAI_API_KEY")).select_sheets(
+                sheet_names, _load_coa_items(job["coa_file"]), excel_file_path=workbook)
+            sheets = [sheet.sheet_name for sheet in selection.selected_sheets
+                      if sheet.include and sheet.sheet_name in sheet_names and not _unsafe_sheet_name(sheet.sheet_name)]
+        _write_json(os.path.join(output_dir, "selected_sheets.json"), sheets)
+        return {"sheets": sheets}, [("encode", sheet) for sheet in sheets]
+
+    if task["kind"] == "encode":
+        if load_sheet_encoding(encoded_sheets_dir, sheet_name) is not None:
+            return {"reused": True}, [("map", sheet_name)]
+        path = os.path.join(encoded_sheets_dir, "%s.json" % sheet_name)
+        snapshot = get_sheet_snapshot(workbook, sheet_name)
+        match = TEMPLATES.match(sheet_fingerprint(snapshot))
+        if match is not None and match[0].encoding is not None:
+            _write_json(path, adapt_encoding(match[0].encoding, snapshot).model_dump())
+            return {"path": path, "template": match[0].fingerprint.digest}, [("map", sheet_name)]
+        encoding = SpreadsheetEncoderAgent(api_key=os.getenv("OPENAI_API_KEY")).encode(workbook, sheet_name=sheet_name)
+        _write_json(path, encoding.model_dump())
+        return {"path": path, "tables": len(encoding.tables)}, [("map", sheet_name)]
+
+    if task["kind"] == "map":
+        map_reduce = os.getenv("EXCEL_AGENT_MAP_REDUCE", "0") == "1"
+        result = map_sheet(workbook, sheet_name, _load_coa_items(job["coa_file"]), encoded_sheets_dir, map_reduce)
+        path = os.path.join(output_dir, "mappings", "%s.json" % sheet_name)
+        _write_json(path, result.model_dump())
+        return {"path": path, "mappings": len(result.mappings)}, []
+
+    raise ValueError("Unknown task kind: %s" % task["kind"])
+
+
+class _CancellationWatch:
+    """Ends the worker process if the job of its running task is cancelled; the supervisor starts a new worker.
+
+    The check and the exit happen under the same lock that finish() takes, so a worker that has
+    moved on to another task is never stopped for the previous task's job.
+    """
+
+    def __init__(self, queue: JobQueue, task: Dict[str, Any], poll_interval: float):
+        self.queue = queue
+        self.task = task
+        self.poll_interval = poll_interval
+        self._lock = Lock()
+        self._finished = False
+        Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if self._finished:
+                    return
+                if self.queue.job_status(self.task["job_id"]) == "cancelled":
+                    logger.info("Stopping task %d: job %d was cancelled", self.task["id"], self.task["job_id"])
+                    self.queue.fail(self.task["id"], "Job was cancelled", retry=False)
+                    os._exit(0)
+
+    def finish(self) -> None:
+        with self._lock:
+            self._finished = True
+
+
+def worker_main(db_path: str, worker: str, poll_interval: float = 0.5) -> None:
+    """Claim and run tasks until the process is terminated."""
+    from core.telemetry import TELEMETRY
+
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    queue = JobQueue(db_path)
+    logger.info("Worker %s (pid %d) started", worker, os.getpid())
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            time.sleep(poll_interval)
+            continue
+        logger.info("Worker %s running %s task %d of job %d (%s)", worker, task["kind"], task["id"], task["job_id"],
+                    task["sheet_name"] or task["job"]["workbook"])
+        watch = _CancellationWatch(queue, task, poll_interval)
+        try:
+            result, follow_ups = run_task(task)
+        except Exception as e:
+            watch.finish()
+            logger.exception("Task %d failed", task["id"])
+            queue.fail(task["id"], "%s: %s" % (type(e).__name__, e))
+        else:
+            watch.finish()
+            queue.complete(task["id"], result, follow_ups)
+        TELEMETRY.flush()
+
+
+class _JobHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, body: Any) -> None:
+        payload = orjson.dumps(body, option=orjson.OPT_INDENT_2)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _job_id(self, path: str, suffix: str = "") -> Optional[int]:
+        match = re.fullmatch(r"/jobs/(\d+)%s" % suffix, path)
+        return int(match.group(1)) if match else None
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        if path == "/metrics":
+            self._send(200, service.metrics())
+        elif path == "/jobs":
+            status = parse_qs(url.query).get("status", [None])[0]
+            self._send(200, service.queue.jobs(status=status))
+        elif self._job_id(path) is not None:
+            job = service.queue.job(self._job_id(path))
+            self._send(200 if job else 404, job or {"error": "Unknown job"})
+        else:
+            self._send(404, {"error": "Unknown path %s" % path})
+
+    def do_POST(self) -> None:
+        service = self.server.service
+        path = urlparse(self.path).path.rstrip("/")
+        if path == "/jobs":
+            try:
+                request = orjson.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                job_id = service.submit(**request)
+            except (orjson.JSONDecodeError, TypeError, ValueError) as e:
+                self._send(400, {"error": str(e)})
+                return
+            self._send(201, service.queue.job(job_id))
+        elif self._job_id(path, "/cancel") is not None:
+            job_id = self._job_id(path, "/cancel")
+            if service.queue.cancel(job_id):
+                self._send(200, service.queue.job(job_id))
+            else:
+                self._send(409 if service.queue.job(job_id) else 404, {"error": "Job %d is not queued or running" % job_id})
+        else:
+            self._send(404, {"error": "Unknown path %s" % path})
+
+    def do_DELETE(self) -> None:
+        job_id = self._job_id(urlparse(self.path).path.rstrip("/"))
+        if job_id is None:
+            self._send(404, {"error": "Unknown path %s" % self.path})
+        elif self.server.service.queue.cancel(job_id):
+            self._send(200, self.server.service.queue.job(job_id))
+        else:
+            self._send(409 if self.server.service.queue.job(job_id) else 404, {"error": "Job %d is not queued or running" % job_id})
+
+
+class JobService:
+    """Local mapping service: an HTTP API in front of a SQLite job queue and a pool of worker processes.
+
+    POST /jobs {"workbook", "coa_file", "priority"?, "sheets"?, "encoded_sheets_dir"?} queues a job;
+    GET /jobs[?status=], GET /jobs/<id> and GET /metrics report on the queue; POST /jobs/<id>/cancel
+    or DELETE /jobs/<id> cancels a job. A supervisor thread restarts dead workers (requeueing their
+    task); a worker whose task belongs to a cancelled job stops itself.
+    """
+
+    def __init__(self, db_path: str, workers: int = 2, job_dir: str = DEFAULT_JOB_DIR, host: str = "127.0.0.1",
+                 port: int = 8780, poll_interval: float = 0.5):
+        self.queue = JobQueue(db_path)
+        self.db_path = db_path
+        self.job_dir = job_dir
+        self.worker_count = workers
+        self.poll_interval = poll_interval
+        self.started_at = time.time()
+        self.workers: Dict[str, Any] = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._server = ThreadingHTTPServer((host, port), _JobHandler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        self._running = False
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def submit(self, workbook: str, coa_file: str, priority: int = 0, sheets: Optional[List[str]] = None,
+               encoded_sheets_dir: Optional[str] = None) -> int:
+        """Validate and queue a job; return its id."""
+        if sheets is not None and (not isinstance(sheets, list) or not all(isinstance(sheet, str) for sheet in sheets)):
+            raise ValueError("sheets must be a list of sheet names")
+        if sheets and any(_unsafe_sheet_name(sheet) for sheet in sheets):
+            raise ValueError("Sheet names may not contain path separators")
+        if isinstance(priority, bool) or not isinstance(priority, int):
+            raise ValueError("priority must be an integer")
+        for path in (workbook, coa_file):
+            if not os.path.exists(path):
+                raise ValueError("No such file: %s" % path)
+        return self.queue.submit(os.path.abspath(workbook), os.path.abspath(coa_file), self.job_dir,
+                                 os.path.abspath(encoded_sheets_dir) if encoded_sheets_dir else None, sheets, priority)
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = self.queue.metrics()
+        metrics["workers"] = {"configured": self.worker_count, "alive": sum(p.is_alive() for p in self.workers.values())}
+        metrics["uptime_s"] = round(time.time() - self.started_at, 1)
+        return metrics
+
+    def _spawn(self, name: str) -> None:
+        process = self._context.Process(target=worker_main, args=(self.db_path, name, self.poll_interval), name=name, daemon=True)
+        process.start()
+        self.workers[name] = process
+
+    def _supervise(self) -> None:
+        while self._running:
+            time.sleep(self.poll_interval)
+            dead = [name for name, process in self.workers.items() if not process.is_alive()]
+            if dead and self._running:
+                self.queue.requeue_running(dead)
+                for name in dead:
+                    self._spawn(name)
+
+    def start(self) -> "JobService":
+        # Tasks left running by a previous service process are run again
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logger.info("Requeued %d tasks left running by a previous service", requeued)
+        for index in range(self.worker_count):
+            self._spawn("worker-%d" % index)
+        self._running = True
+        Thread(target=self._supervise, daemon=True).start()
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info("Job service listening on %s with %d workers (queue %s)", self.url, self.worker_count, self.db_path)
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        self._server.shutdown()
+        self._server.server_close()
+        for process in self.workers.values():
+            process.terminate()
+        for process in self.workers.values():
+            process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the local mapping job service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8780)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("EXCEL_AGENT_JOB_WORKERS", "2")), help="Worker processes")
+    parser.add_argument("--db", default=os.path.join(DEFAULT_JOB_DIR, "queue.sqlite"), help="SQLite queue file")
+    parser.add_argument("--job-dir", default=DEFAULT_JOB_DIR, help="Directory for the jobs' outputs")
+    parser.add_argument("--fake-llm", action="store_true",
+                        help="Serve the LLM from a local fake server that submits schema-valid results (offline testing)")
+    args = parser.parse_args()
+
+    # Spawned workers inherit the environment, so the API and Langfuse keys from .env are loaded here
+    load_dotenv()
+    fake_server = None
+    if args.fake_llm:
+        from core.fake_llm import FakeLLMServer, submit_result_responder
+
+        fake_server = FakeLLMServer(rpm=6000, max_concurrency=16, latency=0.05, responder=submit_result_responder).start()
+        os.environ.update(OPENAI_BASE_URL=fake_server.base_url, OPENAI_API_KEY="fake", EXCEL_AGENT_LANGFUSE_SAMPLE_RATE="0")
+    # Workers share the provider's limits (see RateLimiter.from_env)
+    os.environ.setdefault("EXCEL_AGENT_SHEET_PROCESSES", str(args.workers))
+
+    service = JobService(args.db, workers=args.workers, job_dir=args.job_dir, host=args.host, port=args.port).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        if fake_server is not None:
+            fake_server.stop()
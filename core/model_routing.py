@@ -0,0 +1,86 @@
+import json
+import os
+from typing import Dict, Optional
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+FAST_MODEL = os.getenv("EXCEL_AGENT_FAST_MODEL", "gpt-4.1-mini")
+STRONG_MODEL = os.getenv("EXCEL_AGENT_STRONG_MODEL", "o3")
+
+# USD per 1K tokens
+DEFAULT_PRICING = {
+    "o3": {"input": 0.002, "cached_input": 0.0005, "output": 0.008},
+    "o4-mini": {"input": 0.0011, "cached_input": 0.000275, "output": 0.0044},
+    "gpt-4.1": {"input": 0.002, "cached_input": 0.0005, "output": 0.008},
+    "gpt-4.1-mini": {"input": 0.0004, "cached_input": 0.0001, "output": 0.0016},
+    "gpt-4.1-nano": {"input": 0.0001, "cached_input": 0.000025, "output": 0.0004},
+    "gpt-4o": {"input": 0.0025, "cached_input": 0.00125, "output": 0.01},
+    "gpt-4o-mini": {"input": 0.00015, "cached_input": 0.000075, "output": 0.0006},
+}
+
+# Per-agent routes: "default" is tried first, "large" is used for sheets above the size
+# threshold and "escalation" is used when the first attempt fails validation or is ambiguous
+DEFAULT_ROUTES = {
+    "SheetSelectorAgent": {"default": FAST_MODEL, "escalation": STRONG_MODEL},
+    "SpreadsheetEncoderAgent": {"default": FAST_MODEL, "escalation": STRONG_MODEL},
+    "ExcelAgent": {"default": FAST_MODEL, "large": STRONG_MODEL, "escalation": STRONG_MODEL},
+}
+
+DEFAULT_LARGE_SHEET_CELLS = 2000
+
+
+class ModelRouter:
+    """Chooses the model for each agent and step and holds the pricing table."""
+
+    def __init__(self, routes: Optional[Dict[str, Dict[str, str]]] = None,
+                 pricing: Optional[Dict[str, Dict[str, float]]] = None,
+                 large_sheet_cells: int = DEFAULT_LARGE_SHEET_CELLS):
+        """Initialize with route and pricing tables, falling back to the defaults."""
+        self.routes = {agent: dict(route) for agent, route in (routes or DEFAULT_ROUTES).items()}
+        self.pricing = dict(pricing or DEFAULT_PRICING)
+        self.large_sheet_cells = large_sheet_cells
+
+    @classmethod
+    def from_config(cls, config_path: Optional[str] = None) -> "ModelRouter":
+        """Build a router from the defaults overlaid with an optional JSON config file."""
+        routes = {agent: dict(route) for agent, route in DEFAULT_ROUTES.items()}
+        pricing = dict(DEFAULT_PRICING)
+        large_sheet_cells = DEFAULT_LARGE_SHEET_CELLS
+        if config_path:
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            for agent, route in config.get("routes", {}).items():
+                routes.setdefault(agent, {}).update(route)
+            pricing.update(config.get("pricing", {}))
+            large_sheet_cells = config.get("large_sheet_cells", large_sheet_cells)
+            logger.info("Loaded model routing config from %s", config_path)
+        return cls(routes=routes, pricing=pricing, large_sheet_cells=large_sheet_cells)
+
+    def model_for(self, agent_name: str, step: str = "default") -> str:
+        """Return the model configured for an agent step, falling back to the agent's default."""
+        route = self.routes.get(agent_name, {})
+        return route.get(step) or route.get("default") or STRONG_MODEL
+
+    def model_for_sheet(self, agent_name: str, sheet_cells: int) -> str:
+        """Return the model for a sheet of the given number of non-empty cells."""
+        if sheet_cells > self.large_sheet_cells:
+            return self.model_for(agent_name, "large")
+        return self.model_for(agent_name)
+
+    def escalation_model(self, agent_name: str) -> str:
+        """Return the model to retry with when the first attempt is not acceptable."""
+        return self.model_for(agent_name, "escalation")
+
+    def get_pricing(self, model: str) -> Optional[Dict[str, float]]:
+        """Return the per-1K-token pricing of a model, matching dated snapshots by prefix."""
+        if model in self.pricing:
+            return self.pricing[model]
+        # e.g. "o3-2025-04-16" -> "o3"; prefer the longest matching name
+        for name in sorted(self.pricing, key=len, reverse=True):
+            if model and model.startswith(name + "-"):
+                return self.pricing[name]
+        return None
+
+
+MODEL_ROUTER = ModelRouter.from_config(os.getenv("EXCEL_AGENT_MODEL_CONFIG"))
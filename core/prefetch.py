@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import orjson
+from core.logger import setup_logger
+from core.tool_memo import ToolCallMemo
+from tools.registry import TOOL_REGISTRY, ToolCallError
+
+logger = setup_logger(__name__)
+
+# Arguments that differ between runs on different sheets; traces abstract them away
+_RUN_ARGUMENTS = ("file_path", "sheet_name")
+_START = "^"
+
+
+def _signature(tool_name: str, arguments: Dict[str, Any]) -> str:
+    """Run-independent form of a tool call: its name and every argument except the workbook and sheet."""
+    generic = {name: value for name, value in arguments.items() if name not in _RUN_ARGUMENTS}
+    return orjson.dumps([tool_name, generic], option=orjson.OPT_SORT_KEYS, default=str).decode()
+
+
+class CallTraces:
+    """Tool-call sequences of past runs, kept as a JSONL file and a first-order transition table.
+
+    Each line is one conversation's sequence of call signatures; transitions count which call
+    followed which (the first call follows a start marker), and predict() returns the usual
+    followers of a call.
+    """
+
+    def __init__(self, path: str, min_count: int = 2, min_probability: float = 0.3):
+        self.path = path
+        self.min_count = min_count
+        self.min_probability = min_probability
+        self.transitions: Dict[str, Counter] = defaultdict(Counter)
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+        sequences = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    self._count(orjson.loads(line))
+                    sequences += 1
+                except orjson.JSONDecodeError:
+                    continue
+        logger.info("Loaded %d tool-call traces from %s", sequences, self.path)
+
+    def _count(self, sequence: Sequence[str]) -> None:
+        previous = _START
+        for signature in sequence:
+            self.transitions[previous][signature] += 1
+            previous = signature
+
+    def record(self, sequence: Sequence[str]) -> None:
+        """Add a finished conversation's call signatures to the file and the transition table."""
+        if not sequence:
+            return
+        with self._lock:
+            self._load()
+            self._count(sequence)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(orjson.dumps(list(sequence)) + b"\n")
+
+    def predict(self, previous: Optional[str], limit: int = 3) -> List[str]:
+        """Return the signatures that most often followed previous (None for the first call of a run)."""
+        with self._lock:
+            self._load()
+            followers = self.transitions.get(previous or _START)
+            if not followers:
+                return []
+            total = sum(followers.values())
+            return [signature for signature, count in followers.most_common(limit)
+                    if count >= self.min_count and count / total >= self.min_probability]
+
+
+class Prefetcher:
+    """Speculatively runs the calls a conversation is likely to make next while the LLM is thinking.
+
+    After each turn the calls it made are looked up in the traces and their usual followers are
+    computed on a background thread for the same workbook and sheet. A real call whose validated
+    arguments match a prefetched one takes its result instead of running the tool.
+    """
+
+    def __init__(self, traces: CallTraces, executor: ThreadPoolExecutor, dispatch: Callable[[str, Dict[str, Any]], str],
+                 file_path: str, allowed_tools: Sequence[str], sheet_name: Optional[str] = None, max_per_turn: int = 4):
+        self.traces = traces
+        self.executor = executor
+        self.dispatch = dispatch
+        self.file_path = file_path
+        self.allowed_tools = set(allowed_tools)
+        self.sheet_name = sheet_name
+        self.max_per_turn = max_per_turn
+        self.sequence: List[str] = []
+        self.pending: Dict[Tuple[str, bytes], Future] = {}
+        self.stats = {"prefetched": 0, "hits": 0, "misses": 0, "wasted": 0, "saved_ms": 0.0}
+        self._turn: List[str] = []
+
+    def observe(self, tool_name: str, arguments: Dict[str, Any]) -> None:
+        """Note a call the model made, for the trace of this run and the next predictions."""
+        signature = _signature(tool_name, arguments)
+        self.sequence.append(signature)
+        self._turn.append(signature)
+        self.sheet_name = arguments.get("sheet_name", self.sheet_name)
+
+    def _run(self, tool_name: str, arguments: Dict[str, Any]) -> Tuple[str, float]:
+        start = time.perf_counter()
+        return self.dispatch(tool_name, arguments), (time.perf_counter() - start) * 1000
+
+    def schedule(self, memo: Optional[ToolCallMemo] = None) -> None:
+        """Start computing the likely next calls; call this right before asking the LLM for its next turn."""
+        previous = self._turn if self.sequence else [None]
+        self._turn = []
+        scheduled = 0
+        for signature in dict.fromkeys(prediction for call in previous for prediction in self.traces.predict(call)):
+            if scheduled >= self.max_per_turn:
+                break
+            tool_name, generic = orjson.loads(signature)
+            if tool_name not in self.allowed_tools:
+                continue
+            raw = dict(generic, sheet_name=self.sheet_name) if self.sheet_name else dict(generic)
+            try:
+                arguments = TOOL_REGISTRY.parse_arguments(tool_name, orjson.dumps(raw).decode(), file_path=self.file_path)
+            except ToolCallError:
+                continue
+            key = ToolCallMemo.key(tool_name, arguments)
+            if key in self.pending or (memo is not None and key in memo.calls):
+                continue
+            self.pending[key] = self.executor.submit(self._run, tool_name, arguments)
+            self.stats["prefetched"] += 1
+            scheduled += 1
+
+    def take(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[Tuple[str, float]]:
+        """Return (result, milliseconds saved) if this call was prefetched, waiting for it only if it is already running.
+
+        A prefetch still queued behind other conversations' speculative work is cancelled and the
+        call is left to run inline, so a real call never waits for the shared prefetch worker.
+        """
+        future = self.pending.pop(ToolCallMemo.key(tool_name, arguments), None)
+        if future is None or future.cancel():
+            self.stats["misses"] += 1
+            return None
+        start = time.perf_counter()
+        try:
+            content, compute_ms = future.result()
+        except Exception:
+            # The real call will raise the same error in the usual place
+            self.stats["misses"] += 1
+            return None
+        saved_ms = max(compute_ms - (time.perf_counter() - start) * 1000, 0.0)
+        self.stats["hits"] += 1
+        self.stats["saved_ms"] += saved_ms
+        return content, saved_ms
+
+    def close(self) -> Dict[str, Any]:
+        """Drop unused prefetches, record this run's trace and return the run's prefetch statistics."""
+        for future in self.pending.values():
+            future.cancel()
+        self.stats["wasted"] = len(self.pending)
+        self.pending.clear()
+        self.traces.record(self.sequence)
+        calls = self.stats["hits"] + self.stats["misses"]
+        self.stats["hit_rate"] = round(self.stats["hits"] / calls, 3) if calls else 0.0
+        self.stats["saved_ms"] = round(self.stats["saved_ms"], 1)
+        return dict(self.stats)
+
+
+PREFETCH_ENABLED = os.getenv("EXCEL_AGENT_PREFETCH", "1") == "1"
+CALL_TRACES = CallTraces(os.getenv("EXCEL_AGENT_TRACE_FILE", os.path.join(os.getenv("EXCEL_AGENT_TELEMETRY_DIR", "logs"), "tool_traces.jsonl")))
+# One background worker keeps speculative work from competing with the agent's own tool calls
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
@@ -0,0 +1,235 @@
+import bisect
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import orjson
+from core.logger import setup_logger
+from core.telemetry import TELEMETRY
+
+logger = setup_logger(__name__)
+
+# Upper bounds (ms) of the tool wall-time histogram buckets; the last bucket is open-ended
+HISTOGRAM_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Stacks whose share of a run is below this many microseconds are left out of the collapsed file
+_MIN_STACK_US = 100
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _frame_name(function: Tuple[str, int, str]) -> str:
+    filename, line, name = function
+    if filename == "~":
+        # Built-ins such as <built-in method time.sleep>
+        return name.replace(";", ",")
+    return "%s:%s:%d" % (os.path.basename(filename), name, line)
+
+
+def collapsed_stacks(stats: pstats.Stats) -> Dict[str, int]:
+    """Turn cProfile stats into collapsed stacks ('a;b;c' -> self time in microseconds).
+
+    cProfile records caller/callee edges rather than full stacks, so each function's self time is
+    spread over the stacks leading to it in proportion to the time its callers spent in it.
+    """
+    entries = stats.stats
+    callees: Dict[Any, List[Tuple[Any, float]]] = defaultdict(list)
+    roots = []
+    for function, (_, _, _, cumulative, callers) in entries.items():
+        if not callers:
+            roots.append(function)
+        for caller, edge in callers.items():
+            callees[caller].append((function, edge[3]))
+
+    stacks: Dict[str, int] = defaultdict(int)
+
+    def visit(function: Any, path: Tuple[str, ...], on_path: frozenset, share: float) -> None:
+        _, _, self_time, cumulative, _ = entries[function]
+        path = path + (_frame_name(function),)
+        weight = int(self_time * share * 1e6)
+        if weight:
+            stacks[";".join(path)] += weight
+        for callee, edge_cumulative in callees.get(function, ()):
+            callee_cumulative = entries[callee][3]
+            if callee in on_path or not callee_cumulative:
+                continue
+            child_share = share * edge_cumulative / callee_cumulative
+            if callee_cumulative * child_share * 1e6 >= _MIN_STACK_US:
+                visit(callee, path, on_path | {callee}, child_share)
+
+    for root in roots:
+        visit(root, (), frozenset({root}), 1.0)
+    return dict(stacks)
+
+
+class Profiler:
+    """Opt-in profiling of agent runs and the tool layer, written under the telemetry output directory.
+
+    Each agent run gets a cProfile dump and a collapsed-stack file for flamegraph tools; workbook
+    loads are traced with tracemalloc; every tool call feeds a per-tool wall-time histogram. All
+    hooks are no-ops unless profiling is enabled.
+    """
+
+    def __init__(self, enabled: bool = False, output_dir: str = "logs"):
+        self.enabled = enabled
+        self.output_dir = output_dir
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._active = 0
+        self._histograms: Dict[str, List[int]] = {}
+        self._durations: Dict[str, List[float]] = defaultdict(list)
+        # In pool workers tool timings are handed to the parent instead of written (see collect_for_parent)
+        self.collect_only = False
+
+    @property
+    def profile_dir(self) -> str:
+        return os.path.join(self.output_dir, "profile_%s" % TELEMETRY.run_id)
+
+    def enable(self) -> None:
+        self.enabled = True
+        logger.info("Profiling enabled, writing to %s", self.profile_dir)
+
+    def _path(self, name: str) -> str:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return os.path.join(self.profile_dir, name)
+
+    @contextmanager
+    def profile_run(self, agent: str, sheet_name: Optional[str] = None) -> Iterator[None]:
+        """Profile the enclosed agent run with cProfile; nested runs in the same thread are part of the outer one.
+
+        From Python 3.12 only one profiler can be active per process (and it sees every thread), so
+        runs started in other threads while one is profiled, e.g. the regions of a sheet, are part
+        of that one as well.
+        """
+        with self._lock:
+            nested = getattr(self._local, "active", False) or (sys.version_info >= (3, 12) and self._active > 0)
+            if self.enabled and not nested:
+                self._active += 1
+        if not self.enabled or nested:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, e.g. one started around the whole process, is already active
+            with self._lock:
+                self._active -= 1
+            yield
+            return
+        self._local.active = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.active = False
+            with self._lock:
+                self._active -= 1
+                self._runs += 1
+                number = self._runs
+            name = _UNSAFE.sub("_", "%s_%s_%d_%d" % (agent, sheet_name or "run", os.getpid(), number))
+            stats = pstats.Stats(profile)
+            stats.dump_stats(self._path(name + ".prof"))
+            with open(self._path(name + ".collapsed"), "w", encoding="utf-8") as f:
+                for stack, weight in sorted(collapsed_stacks(stats).items()):
+                    f.write("%s %d\n" % (stack, weight))
+            self.write_tool_histograms()
+            logger.info("Profiled %s run on '%s' (%.2fs): %s.prof/.collapsed", agent, sheet_name, time.perf_counter() - start, name)
+
+    @contextmanager
+    def trace_memory(self, label: str, top: int = 10) -> Iterator[None]:
+        """Record the allocation peak and the top allocation sites of the enclosed block (e.g. a workbook load)."""
+        if not self.enabled:
+            yield
+            return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+            differences = after.compare_to(before, "lineno")[:top]
+            lines = ["%s: %.2fs, peak %.1f MB traced, %.1f MB still allocated" % (label, elapsed, peak / 1e6, current / 1e6)]
+            lines.extend("    %s" % difference for difference in differences)
+            with self._lock, open(self._path("memory_%d.txt" % os.getpid()), "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            logger.info("Memory of %s: peak %.1f MB", label, peak / 1e6)
+
+    def record_tool(self, tool_name: str, wall_ms: float) -> None:
+        """Add one tool call's wall time to the tool's histogram."""
+        if not self.enabled:
+            return
+        with self._lock:
+            buckets = self._histograms.get(tool_name)
+            if buckets is None:
+                buckets = self._histograms[tool_name] = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+            buckets[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, wall_ms)] += 1
+            self._durations[tool_name].append(wall_ms)
+
+    def collect_for_parent(self) -> None:
+        """Switch a forked pool worker to handing its tool timings to the parent; drops the parent's inherited ones."""
+        with self._lock:
+            self.collect_only = True
+            self._histograms = {}
+            self._durations = defaultdict(list)
+
+    def drain_tool_durations(self) -> Dict[str, List[float]]:
+        """Return the tool wall times (ms) recorded so far and forget them."""
+        with self._lock:
+            durations = dict(self._durations)
+            self._histograms = {}
+            self._durations = defaultdict(list)
+        return durations
+
+    def merge_tool_durations(self, durations: Dict[str, List[float]]) -> None:
+        """Add tool wall times collected in a pool worker to this process's histograms."""
+        for tool_name, values in durations.items():
+            for wall_ms in values:
+                self.record_tool(tool_name, wall_ms)
+
+    def tool_histograms(self) -> Dict[str, Dict[str, Any]]:
+        """Per-tool bucket counts (keyed by upper bound in ms) with count, p50, p95 and max."""
+        with self._lock:
+            histograms = {name: list(buckets) for name, buckets in self._histograms.items()}
+            durations = {name: sorted(values) for name, values in self._durations.items()}
+        labels = ["<=%g" % bound for bound in HISTOGRAM_BOUNDS_MS] + [">%g" % HISTOGRAM_BOUNDS_MS[-1]]
+        summary = {}
+        for name, buckets in sorted(histograms.items()):
+            values = durations[name]
+            summary[name] = {
+                "count": len(values),
+                "p50_ms": round(values[len(values) // 2], 3),
+                "p95_ms": round(values[min(int(len(values) * 0.95), len(values) - 1)], 3),
+                "max_ms": round(values[-1], 3),
+                "buckets_ms": {label: count for label, count in zip(labels, buckets) if count},
+            }
+        return summary
+
+    def write_tool_histograms(self) -> Optional[str]:
+        """Write this process's tool histograms next to the profiles and return the path."""
+        if not self.enabled or self.collect_only or not self._histograms:
+            return None
+        path = self._path("tools_%d.json" % os.getpid())
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(self.tool_histograms(), option=orjson.OPT_INDENT_2))
+        return path
+
+
+PROFILER = Profiler(enabled=os.getenv("EXCEL_AGENT_PROFILE", "0") == "1", output_dir=TELEMETRY.output_dir)
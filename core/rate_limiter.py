@@ -0,0 +1,217 @@
+import argparse
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+import openai
+from core.logger import setup_logger
+from core.telemetry import TELEMETRY
+
+logger = setup_logger(__name__)
+
+T = TypeVar("T")
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and provider-side 5xx
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class TokenBucket:
+    """Continuously refilling bucket holding up to one minute of capacity."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.available = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount can be taken (requests larger than the bucket only wait for a full bucket)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0.0) / self.rate
+
+    def take(self, amount: float) -> None:
+        # May go negative, so an oversized request delays the ones after it
+        self.available -= amount
+
+
+class RateLimiter:
+    """Process-wide limiter for LLM calls: request and token buckets plus an adaptive concurrency limit.
+
+    The concurrency limit follows AIMD: it is halved on every rate-limit error and grows by one
+    after a limit's worth of consecutive successes, up to max_concurrency. A rate-limit error also
+    pauses every caller until the provider's Retry-After (or the backoff) has passed. Failed calls
+    are retried with full-jitter exponential backoff.
+    """
+
+    def __init__(self, requests_per_minute: float = 500, tokens_per_minute: float = 200000,
+                 max_concurrency: int = 8, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0,
+                 enabled: bool = True):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "failed": 0, "wait_s": 0.0}
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        """Build the limiter from EXCEL_AGENT_* variables, splitting the budget between sheet worker processes."""
+        processes = max(int(os.getenv("EXCEL_AGENT_SHEET_PROCESSES", "1")), 1)
+        return cls(
+            requests_per_minute=float(os.getenv("EXCEL_AGENT_RPM", "500")) / processes,
+            tokens_per_minute=float(os.getenv("EXCEL_AGENT_TPM", "200000")) / processes,
+            max_concurrency=max(int(os.getenv("EXCEL_AGENT_LLM_CONCURRENCY", "8")) // processes, 1),
+            max_retries=int(os.getenv("EXCEL_AGENT_LLM_RETRIES", "6")),
+            enabled=os.getenv("EXCEL_AGENT_RATE_LIMIT", "1") == "1",
+        )
+
+    def acquire(self, estimated_tokens: int) -> float:
+        """Block until a concurrency slot and budget for one request of estimated_tokens are free; return the wait in seconds."""
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = max(self.paused_until - now, self.requests.wait_time(1, now),
+                           self.tokens.wait_time(estimated_tokens, now))
+                if wait <= 0 and self.in_flight < self.concurrency:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    self.in_flight += 1
+                    waited = now - start
+                    self.stats["wait_s"] += waited
+                    return waited
+                # Woken early when a slot frees up or the limits change
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, estimated_tokens: int, used_tokens: Optional[int] = None, rate_limited: bool = False,
+                retry_after: Optional[float] = None) -> None:
+        """Free the slot taken by acquire, correct the token estimate and adapt the concurrency limit."""
+        with self._condition:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - estimated_tokens)
+            if rate_limited:
+                self.stats["rate_limited"] += 1
+                self._successes = 0
+                self.concurrency = max(self.concurrency // 2, 1)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                logger.warning("Rate limited by the provider, concurrency limit now %d", self.concurrency)
+            elif used_tokens is not None:
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self._successes = 0
+                    self.concurrency += 1
+            self._condition.notify_all()
+
+    def _count(self, key: str) -> None:
+        with self._condition:
+            self.stats[key] += 1
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff for the given retry attempt (1-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, function: Callable[..., T], estimated_tokens: int, *args: Any, **kwargs: Any) -> T:
+        """Call function within the limits, retrying retryable errors; usage.total_tokens of the result corrects the estimate.
+        
+        The time spent waiting for the limiter and the retry count are recorded on the open telemetry span.
+        """
+        if not self.enabled:
+            return function(*args, **kwargs)
+        self._count("calls")
+        attempt = 0
+        waited = 0.0
+        while True:
+            waited += self.acquire(estimated_tokens)
+            try:
+                result = function(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                rate_limited = isinstance(e, openai.RateLimitError)
+                retry_after = _retry_after(e)
+                delay = max(retry_after or 0.0, self.backoff(attempt))
+                # Only the provider's Retry-After pauses every caller; the jittered backoff is this caller's own
+                self.release(estimated_tokens, rate_limited=rate_limited, retry_after=retry_after)
+                if attempt > self.max_retries:
+                    self._count("failed")
+                    raise
+                self._count("retries")
+                logger.warning("LLM call failed (%s), retry %d/%d in %.1fs", type(e).__name__, attempt, self.max_retries, delay)
+                time.sleep(delay)
+                waited += delay
+                continue
+            except BaseException:
+                self.release(estimated_tokens)
+                raise
+            usage = getattr(result, "usage", None)
+            self.release(estimated_tokens, used_tokens=getattr(usage, "total_tokens", None) or estimated_tokens)
+            TELEMETRY.annotate(queue_wait_ms=waited * 1000, retries=attempt)
+            return result
+
+    def summary(self) -> Dict[str, Any]:
+        with self._condition:
+            return dict(self.stats, wait_s=round(self.stats["wait_s"], 2), concurrency=self.concurrency)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, from the Retry-After header of an API error."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after")) if headers.get("retry-after") else None
+    except ValueError:
+        return None
+
+
+RATE_LIMITER = RateLimiter.from_env()
+
+
+if __name__ == "__main__":
+    from core.fake_llm import FakeLLMServer
+
+    parser = argparse.ArgumentParser(description="Drive the rate limiter against a local fake LLM server that injects 429s.")
+    parser.add_argument("--requests", type=int, default=200, help="Number of completions to request")
+    parser.add_argument("--threads", type=int, default=32, help="Concurrent callers")
+    parser.add_argument("--server-rpm", type=float, default=600, help="Requests per minute the fake server accepts")
+    parser.add_argument("--server-concurrency", type=int, default=4, help="Concurrent requests the fake server accepts")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Fraction of requests failed with a random 429 or 500")
+    parser.add_argument("--rpm", type=float, default=1200, help="Limiter requests per minute (deliberately above the server's)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Limiter max concurrency")
+    args = parser.parse_args()
+
+    server = FakeLLMServer(rpm=args.server_rpm, max_concurrency=args.server_concurrency, error_rate=args.error_rate)
+    server.start()
+    client = openai.OpenAI(api_key="fake", base_url=server.base_url, max_retries=0)
+    limiter = RateLimiter(requests_per_minute=args.rpm, tokens_per_minute=10 ** 9, max_concurrency=args.concurrency,
+                          max_retries=8, base_delay=0.2, max_delay=5.0)
+
+    def complete(index: int) -> bool:
+        try:
+            limiter.call(client.chat.completions.create, 50, model="fake", messages=[{"role": "user", "content": str(index)}])
+            return True
+        except Exception as e:
+            logger.error("Request %d failed: %s", index, e)
+            return False
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        succeeded = sum(executor.map(complete, range(args.requests)))
+    elapsed = time.monotonic() - start
+    server.stop()
+    print("%d/%d succeeded in %.1fs (%.0f requests/min), limiter: %s, server: %s" % (
+        succeeded, args.requests, elapsed, succeeded / elapsed * 60, limiter.summary(), server.stats))
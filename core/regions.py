@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+from openpyxl.utils import column_index_from_string, get_column_letter
+from core.logger import setup_logger
+from pydantic_models.models import ExpectedOutput, SheetCoAMapping, SingleSheetEncoding
+from tools.snapshot import SheetSnapshot, parse_cell_reference
+
+logger = setup_logger(__name__)
+
+
+@dataclass(frozen=True)
+class SheetRegion:
+    """A rectangular block of a sheet mapped independently, with the header rows that label its columns."""
+    table_name: str
+    min_row: int
+    min_column: int
+    max_row: int
+    max_column: int
+    header_rows: Optional[Tuple[int, int]] = None
+    label_columns: Optional[Tuple[int, int]] = None
+
+    @property
+    def range(self) -> str:
+        return "%s%d:%s%d" % (get_column_letter(self.min_column), self.min_row,
+                              get_column_letter(self.max_column), self.max_row)
+
+    @property
+    def header_range(self) -> Optional[str]:
+        if self.header_rows is None:
+            return None
+        return "%s%d:%s%d" % (get_column_letter(self.min_column), self.header_rows[0],
+                              get_column_letter(self.max_column), self.header_rows[1])
+
+    @property
+    def label_range(self) -> Optional[str]:
+        """Columns outside the region that hold its row labels, e.g. 'A:C'."""
+        if self.label_columns is None:
+            return None
+        return "%s:%s" % (get_column_letter(self.label_columns[0]), get_column_letter(self.label_columns[1]))
+
+    @property
+    def cells(self) -> int:
+        return (self.max_row - self.min_row + 1) * (self.max_column - self.min_column + 1)
+
+    def contains(self, row: int, column: int) -> bool:
+        return self.min_row <= row <= self.max_row and self.min_column <= column <= self.max_column
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _header_rows(snapshot: SheetSnapshot, min_row: int, max_row: int, min_column: int, max_column: int,
+                 max_header_rows: int = 10) -> Optional[Tuple[int, int]]:
+    """Return the rows above the first row with a literal number, which hold the table's column headers."""
+    for row in range(min_row, min(max_row, min_row + max_header_rows) + 1):
+        if any(_is_number(snapshot.value(row, column)) for column in range(min_column, max_column + 1)):
+            return (min_row, row - 1) if row > min_row else None
+    return None
+
+
+def _is_blank_row(snapshot: SheetSnapshot, row: int, min_column: int, max_column: int) -> bool:
+    return all(snapshot.value(row, column) is None for column in range(min_column, max_column + 1))
+
+
+def _split_rows(snapshot: SheetSnapshot, region: SheetRegion, max_rows: int) -> List[SheetRegion]:
+    """Split a tall region into row bands, cutting at blank rows where possible."""
+    first_data_row = region.header_rows[1] + 1 if region.header_rows else region.min_row
+    bands = []
+    start = first_data_row
+    while start <= region.max_row:
+        end = min(start + max_rows - 1, region.max_row)
+        if end < region.max_row:
+            # Prefer to cut at the last blank row in the second half of the band
+            for row in range(end, start + max_rows // 2, -1):
+                if _is_blank_row(snapshot, row, region.min_column, region.max_column):
+                    end = row
+                    break
+        bands.append(SheetRegion(region.table_name, start, region.min_column, end, region.max_column,
+                                 header_rows=region.header_rows, label_columns=region.label_columns))
+        start = end + 1
+    return bands
+
+
+def split_sheet_regions(encoding: Optional[SingleSheetEncoding], snapshot: SheetSnapshot,
+                        max_rows: int = 60) -> List[SheetRegion]:
+    """Split a sheet into independently mappable regions from its encoded table boundaries.
+
+    Tables taller than max_rows are split further into row bands that share the table's header rows.
+    Without an encoding the whole used range is treated as a single table.
+    """
+    tables = []
+    for table in (encoding.tables if encoding else []):
+        boundaries = table.boundaries
+        try:
+            min_column = column_index_from_string(boundaries.start_column.upper())
+            max_column = column_index_from_string(boundaries.end_column.upper())
+        except ValueError:
+            logger.warning("Skipping table '%s' with invalid boundaries %s", table.table_name, boundaries.range)
+            continue
+        min_row, max_row = max(boundaries.start_row, 1), min(boundaries.end_row, snapshot.max_row)
+        max_column = min(max_column, snapshot.max_column)
+        if min_row <= max_row and min_column <= max_column:
+            tables.append((table.table_name, min_row, min_column, max_row, max_column))
+    if not tables:
+        tables.append((snapshot.sheet_name, 1, 1, snapshot.max_row, snapshot.max_column))
+
+    regions = []
+    for table_name, min_row, min_column, max_row, max_column in tables:
+        header_rows = _header_rows(snapshot, min_row, max_row, min_column, max_column)
+        region = SheetRegion(table_name, min_row, min_column, max_row, max_column, header_rows=header_rows)
+        if max_row - min_row + 1 > max_rows:
+            regions.extend(_split_rows(snapshot, region, max_rows))
+        else:
+            regions.append(region)
+
+    logger.info("Split sheet '%s' into %d regions: %s", snapshot.sheet_name, len(regions), [r.range for r in regions])
+    return regions
+
+
+def merge_region_mappings(sheet_name: str, regions: Sequence[SheetRegion],
+                          results: Sequence[Optional[SheetCoAMapping]]) -> SheetCoAMapping:
+    """Merge per-region mappings into one SheetCoAMapping, resolving duplicate locations.
+
+    A location mapped by several regions keeps the entry from the region that contains the cell
+    (the first such region when regions overlap); entries outside every region are kept only if
+    no other region mapped the same cell.
+    """
+    chosen: Dict[str, Tuple[int, ExpectedOutput]] = {}
+    summaries = []
+    for region, result in zip(regions, results):
+        if result is None:
+            summaries.append("Region %s: failed" % region.range)
+            continue
+        summaries.append("Region %s: %s" % (region.range, result.analysis_summary))
+        for mapping in result.mappings:
+            location = mapping.location_in_sheet.replace("$", "").upper()
+            try:
+                inside = region.contains(*parse_cell_reference(location))
+            except ValueError:
+                inside = False
+            rank = 0 if inside else 1
+            existing = chosen.get(location)
+            if existing is None or rank < existing[0]:
+                if existing is not None and existing[1].CoA_label != mapping.CoA_label:
+                    logger.info("Resolved duplicate mapping for %s: %s over %s", location, mapping.CoA_label, existing[1].CoA_label)
+                chosen[location] = (rank, mapping.model_copy(update={"sheet_name": sheet_name, "location_in_sheet": location}))
+
+    mappings = [mapping for _, mapping in chosen.values()]
+    logger.info("Merged %d region results into %d mappings for sheet '%s'", len(results), len(mappings), sheet_name)
+    return SheetCoAMapping(sheet_name=sheet_name, mappings=mappings, analysis_summary="\n".join(summaries))
@@ -0,0 +1,223 @@
+import atexit
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+import orjson
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+_current_context: ContextVar[Dict[str, Any]] = ContextVar("telemetry_context", default={})
+
+
+@dataclass
+class Span:
+    """A single timed LLM call or tool invocation."""
+    kind: str
+    name: str
+    run_id: str
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    agent: Optional[str] = None
+    sheet_name: Optional[str] = None
+    started_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    wall_ms: float = 0.0
+    queue_wait_ms: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    request_bytes: int = 0
+    response_bytes: int = 0
+    workbook_cache_hit: Optional[bool] = None
+    error: Optional[str] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class Telemetry:
+    """Collects spans for LLM calls and tool invocations and exports them to a local JSONL file."""
+
+    def __init__(self, enabled: bool = True, output_dir: str = "logs", langfuse_sample_rate: float = 1.0):
+        """Initialize the collector; the JSONL file is opened lazily on the first recorded span."""
+        self.enabled = enabled
+        self.output_dir = output_dir
+        self.langfuse_sample_rate = langfuse_sample_rate
+        self.run_id = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:6]
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self._file = None
+        # In pool workers spans are only kept in memory and handed to the parent (see collect_for_parent)
+        self.collect_only = False
+        self._inherited_file = None
+
+    @property
+    def spans_path(self) -> str:
+        return os.path.join(self.output_dir, "telemetry_%s.jsonl" % self.run_id)
+
+    def sample_langfuse(self) -> bool:
+        """Decide whether the current agent run should be traced through Langfuse."""
+        return random.random() < self.langfuse_sample_rate
+
+    @contextmanager
+    def context(self, **attributes: Any) -> Iterator[None]:
+        """Attach attributes (e.g. agent, sheet_name) to every span recorded inside the block."""
+        token = _current_context.set({**_current_context.get(), **attributes})
+        try:
+            yield
+        finally:
+            _current_context.reset(token)
+
+    def current_context(self) -> Dict[str, Any]:
+        """Attributes set by the enclosing context() blocks (e.g. agent, sheet_name)."""
+        return dict(_current_context.get())
+
+    @contextmanager
+    def span(self, kind: str, name: str, queued_at: Optional[float] = None, **attributes: Any) -> Iterator[Span]:
+        """Time the enclosed block as a span; queued_at is a perf_counter timestamp of when the work was requested."""
+        context = _current_context.get()
+        span = Span(kind=kind, name=name, run_id=self.run_id,
+                    agent=context.get("agent"), sheet_name=context.get("sheet_name"), attributes=attributes)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        if queued_at is not None:
+            span.queue_wait_ms = (start - queued_at) * 1000
+        try:
+            yield span
+        except BaseException as e:
+            span.error = "%s: %s" % (type(e).__name__, e)
+            raise
+        finally:
+            span.wall_ms = (time.perf_counter() - start) * 1000
+            _current_span.reset(token)
+            self.record(span)
+
+    def annotate(self, **attributes: Any) -> None:
+        """Set fields on the span that is currently open in this context, if any."""
+        span = _current_span.get()
+        if span is None:
+            return
+        for key, value in attributes.items():
+            if hasattr(span, key) and key != "attributes":
+                setattr(span, key, value)
+            else:
+                span.attributes[key] = value
+
+    def record(self, span: Span) -> None:
+        """Store a finished span and append it to the JSONL export."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.spans.append(span)
+            if self.collect_only:
+                return
+            line = orjson.dumps(asdict(span), default=str) + b"\n"
+            if self._file is None:
+                os.makedirs(self.output_dir, exist_ok=True)
+                self._file = open(self.spans_path, "ab")
+            self._file.write(line)
+
+    def collect_for_parent(self) -> None:
+        """Switch a forked pool worker to collecting spans in memory for the parent to merge.
+
+        Pool workers exit without running atexit handlers, so a span file of their own would
+        never be flushed. The parent's spans and open export file are dropped; the file object
+        is kept referenced (and never flushed here) so that its buffer is not written twice.
+        """
+        with self._lock:
+            self.collect_only = True
+            self.spans = []
+            self._inherited_file, self._file = self._file, None
+
+    def drain(self) -> List[Span]:
+        """Return the spans recorded so far and forget them (used by pool workers after each task)."""
+        with self._lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+    def merge(self, spans: List[Span]) -> None:
+        """Record spans collected in a pool worker as part of this run."""
+        for span in spans:
+            span.run_id = self.run_id
+            self.record(span)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def summarize(self, group_by: Optional[str] = "sheet_name") -> Dict[str, Dict[str, Any]]:
+        """Aggregate spans per group (e.g. per sheet); group_by=None aggregates the whole run."""
+        with self._lock:
+            spans = list(self.spans)
+
+        groups: Dict[str, Dict[str, Any]] = {}
+        for span in spans:
+            key = str(getattr(span, group_by)) if group_by else self.run_id
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    "llm_calls": 0, "llm_wall_ms": 0.0, "llm_queue_wait_ms": 0.0,
+                    "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                    "tool_calls": 0, "tool_wall_ms": 0.0, "tool_queue_wait_ms": 0.0,
+                    "request_bytes": 0, "response_bytes": 0,
+                    "workbook_cache_hits": 0, "workbook_cache_misses": 0, "errors": 0,
+                    "memo_hits": 0, "prefetch_hits": 0, "prefetch_saved_ms": 0.0,
+                    "tools": defaultdict(lambda: {"calls": 0, "wall_ms": 0.0}),
+                }
+            prefix = "llm" if span.kind == "llm" else "tool"
+            group["%s_calls" % prefix] += 1
+            group["%s_wall_ms" % prefix] += span.wall_ms
+            group["%s_queue_wait_ms" % prefix] += span.queue_wait_ms
+            group["prompt_tokens"] += span.prompt_tokens
+            group["completion_tokens"] += span.completion_tokens
+            group["cached_tokens"] += span.cached_tokens
+            group["request_bytes"] += span.request_bytes
+            group["response_bytes"] += span.response_bytes
+            if span.workbook_cache_hit is True:
+                group["workbook_cache_hits"] += 1
+            elif span.workbook_cache_hit is False:
+                group["workbook_cache_misses"] += 1
+            if span.error:
+                group["errors"] += 1
+            if span.attributes.get("memo_hit"):
+                group["memo_hits"] += 1
+            if span.attributes.get("prefetch_hit"):
+                group["prefetch_hits"] += 1
+                group["prefetch_saved_ms"] += span.attributes.get("prefetch_saved_ms", 0.0)
+            if span.kind == "tool":
+                group["tools"][span.name]["calls"] += 1
+                group["tools"][span.name]["wall_ms"] += span.wall_ms
+
+        for group in groups.values():
+            group["tools"] = dict(group["tools"])
+        return groups
+
+    def write_summary(self) -> str:
+        """Write the per-sheet and per-run summary next to the span export and return its path."""
+        summary = {
+            "run_id": self.run_id,
+            "run": self.summarize(group_by=None).get(self.run_id, {}),
+            "sheets": self.summarize(group_by="sheet_name"),
+        }
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, "telemetry_summary_%s.json" % self.run_id)
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+        self.flush()
+        logger.info("Telemetry summary written to: %s", path)
+        return path
+
+
+TELEMETRY = Telemetry(
+    enabled=os.getenv("EXCEL_AGENT_TELEMETRY", "1") != "0",
+    output_dir=os.getenv("EXCEL_AGENT_TELEMETRY_DIR", "logs"),
+    langfuse_sample_rate=float(os.getenv("EXCEL_AGENT_LANGFUSE_SAMPLE_RATE", "1.0")),
+)
+atexit.register(TELEMETRY.flush)
@@ -0,0 +1,281 @@
+import datetime
+import hashlib
+import os
+import re
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+import orjson
+from openpyxl.utils import get_column_letter
+from pydantic import ValidationError
+from core.logger import setup_logger
+from pydantic_models.models import ExpectedOutput, MappingRule, SheetCoAMapping, SingleSheetEncoding
+from tools.cell_context import CellContext, period_rank, resolve_cells, resolve_layout
+from tools.snapshot import SheetSnapshot, parse_cell_reference
+
+logger = setup_logger(__name__)
+
+_DIGITS = re.compile(r"\d+")
+# Formats a month-year timestamp may be written in; a learned timestamp keeps its format when its period moves
+_MONTH_FORMATS = ("%b %Y", "%b %y", "%B %Y", "%B %y", "%b-%y", "%b-%Y", "%m/%Y", "%Y-%m")
+
+
+def _normalize(text: str) -> str:
+    """Lower-case text with numbers replaced by '#', so 'New FY26' and 'New FY27' look the same."""
+    return _DIGITS.sub("#", " ".join(text.lower().split()))
+
+
+def _header_shape(header: Optional[str]) -> Optional[str]:
+    """A column header with its periods replaced by placeholders, e.g. 'Period # / <period0> / budget / £k'."""
+    if not header:
+        return None
+    return " / ".join("<period%d>" % period_rank(part) if period_rank(part) is not None else _normalize(part)
+                      for part in header.split(" / "))
+
+
+def _jaccard(first: FrozenSet[str], second: FrozenSet[str]) -> float:
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+@dataclass(frozen=True)
+class SheetFingerprint:
+    """Structure of a sheet without its numbers: row labels, column header shapes and the table layout."""
+    digest: str
+    labels: FrozenSet[str]
+    headers: FrozenSet[str]
+    shape: FrozenSet[str]
+
+    def similarity(self, other: "SheetFingerprint") -> float:
+        """Weighted overlap of labels, headers and layout (1.0 = same structure)."""
+        if self.digest == other.digest:
+            return 1.0
+        return (0.5 * _jaccard(self.labels, other.labels) + 0.3 * _jaccard(self.headers, other.headers)
+                + 0.2 * _jaccard(self.shape, other.shape))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"digest": self.digest, "labels": sorted(self.labels), "headers": sorted(self.headers), "shape": sorted(self.shape)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SheetFingerprint":
+        return cls(data["digest"], frozenset(data["labels"]), frozenset(data["headers"]), frozenset(data["shape"]))
+
+
+def _sheet_contexts(snapshot: SheetSnapshot) -> Tuple[Any, List[CellContext]]:
+    layout = resolve_layout(snapshot)
+    return layout, resolve_cells(snapshot, include_formulas=True, layout=layout)
+
+
+def sheet_fingerprint(snapshot: SheetSnapshot) -> SheetFingerprint:
+    """Fingerprint a sheet from its label columns, header patterns and table shape, ignoring all numbers."""
+    layout, contexts = _sheet_contexts(snapshot)
+    labels = frozenset(_normalize(context.label) for context in contexts if context.label)
+    headers = frozenset("%s:%s" % (re.match(r"[A-Z]+", context.cell).group(0), _header_shape(context.header))
+                        for context in contexts if context.header)
+    shape = frozenset(["label:%s" % get_column_letter(column) for column in layout.label_columns]
+                      + ["value:%s" % get_column_letter(column) for column in layout.value_columns]
+                      + ["header:%d-%d" % (block.first_row, block.last_row) for block in layout.header_blocks])
+    digest = hashlib.sha256(orjson.dumps([sorted(shape), sorted(labels), sorted(headers)])).hexdigest()[:16]
+    return SheetFingerprint(digest, labels, headers, shape)
+
+
+def _rows_by_label(contexts: Sequence[CellContext]) -> Dict[str, List[int]]:
+    """Rows of each normalized row label, top to bottom."""
+    rows: Dict[str, List[int]] = {}
+    seen = set()
+    for context in contexts:
+        row = parse_cell_reference(context.cell)[0]
+        if context.label and row not in seen:
+            seen.add(row)
+            rows.setdefault(_normalize(context.label), []).append(row)
+    return rows
+
+
+def learn_rules(snapshot: SheetSnapshot, result: SheetCoAMapping) -> List[MappingRule]:
+    """Turn a sheet's mappings into rules anchored on each cell's row label and column header."""
+    _, contexts = _sheet_contexts(snapshot)
+    by_cell = {context.cell: context for context in contexts}
+    rows_by_label = _rows_by_label(contexts)
+    rules = []
+    for mapping in result.mappings:
+        try:
+            row, column = parse_cell_reference(mapping.location_in_sheet)
+        except ValueError:
+            continue
+        context = by_cell.get("%s%d" % (get_column_letter(column), row))
+        label = _normalize(context.label) if context and context.label else None
+        occurrences = rows_by_label.get(label, [])
+        rules.append(MappingRule(
+            label=label, occurrence=occurrences.index(row) if row in occurrences else 0, row=row,
+            column_letter=get_column_letter(column), header=_header_shape(context.header) if context else None,
+            period=context.period if context else None, CoA_label=mapping.CoA_label,
+            timestamp_of_value=mapping.timestamp_of_value, unit=mapping.unit))
+    return rules
+
+
+def _parse_month(text: str) -> Optional[Tuple[datetime.datetime, str]]:
+    for date_format in _MONTH_FORMATS:
+        try:
+            return datetime.datetime.strptime(text.strip(), date_format), date_format
+        except ValueError:
+            continue
+    return None
+
+
+def _retime(timestamp: str, old_period: Optional[str], new_period: Optional[str]) -> Optional[str]:
+    """The learned timestamp moved from the old column period to the new one, or None if it cannot be."""
+    if old_period == new_period or old_period is None:
+        return timestamp
+    if new_period is None:
+        return None
+    if _normalize(timestamp) == _normalize(old_period):
+        return new_period
+    old, new, learned = _parse_month(old_period), _parse_month(new_period), _parse_month(timestamp)
+    if old and new and learned and (learned[0].year, learned[0].month) == (old[0].year, old[0].month):
+        return new[0].strftime(learned[1])
+    if old_period in timestamp:
+        return timestamp.replace(old_period, new_period)
+    return None
+
+
+def apply_rules(snapshot: SheetSnapshot, rules: Sequence[MappingRule]) -> List[Tuple[ExpectedOutput, CellContext]]:
+    """Map a sheet with learned rules; rules whose row, column or period cannot be found are skipped.
+
+    A rule's row is the same occurrence of its label (or the same row for unlabelled cells). Its
+    column is the same column if the header shape still matches, or else the one column of that
+    row with the same header shape and period.
+    """
+    _, contexts = _sheet_contexts(snapshot)
+    by_cell = {context.cell: context for context in contexts}
+    by_row: Dict[int, List[CellContext]] = {}
+    for context in contexts:
+        by_row.setdefault(parse_cell_reference(context.cell)[0], []).append(context)
+    rows_by_label = _rows_by_label(contexts)
+
+    applied, seen = [], set()
+    for rule in rules:
+        if rule.label is None:
+            row = rule.row
+        elif rule.occurrence < len(rows_by_label.get(rule.label, [])):
+            row = rows_by_label[rule.label][rule.occurrence]
+        else:
+            continue
+        context = by_cell.get("%s%d" % (rule.column_letter, row))
+        if context is None or _header_shape(context.header) != rule.header:
+            candidates = [candidate for candidate in by_row.get(row, [])
+                          if _header_shape(candidate.header) == rule.header and candidate.period == rule.period]
+            context = candidates[0] if len(candidates) == 1 else None
+        if context is None or context.cell in seen or not isinstance(context.value, (int, float)) or isinstance(context.value, bool):
+            continue
+        timestamp = _retime(rule.timestamp_of_value, rule.period, context.period)
+        if timestamp is None:
+            continue
+        # A unit that was the row label (e.g. a site or 'New FY26') follows the row label of the new sheet
+        unit = context.label if rule.label and context.label and _normalize(rule.unit) == rule.label else rule.unit
+        seen.add(context.cell)
+        applied.append((ExpectedOutput(sheet_name=snapshot.sheet_name, location_in_sheet=context.cell, value=round(context.value),
+                                       CoA_label=rule.CoA_label, timestamp_of_value=timestamp, unit=unit), context))
+    logger.info("Sheet '%s': %d of %d template rules applied", snapshot.sheet_name, len(applied), len(rules))
+    return applied
+
+
+def adapt_encoding(encoding: SingleSheetEncoding, snapshot: SheetSnapshot) -> SingleSheetEncoding:
+    """A learned encoding renamed and resized for a sheet with the same structure."""
+    dimensions = encoding.dimensions.model_copy(update={
+        "rows": snapshot.max_row, "columns": snapshot.max_column,
+        "range": "A1:%s%d" % (get_column_letter(max(snapshot.max_column, 1)), max(snapshot.max_row, 1))})
+    return encoding.model_copy(update={"name": snapshot.sheet_name, "sheet_name": snapshot.sheet_name, "dimensions": dimensions})
+
+
+@dataclass
+class SheetTemplate:
+    """A learned sheet structure with the encoding and mapping rules of the sheet it was learned from."""
+    fingerprint: SheetFingerprint
+    rules: List[MappingRule]
+    encoding: Optional[SingleSheetEncoding]
+    source: Dict[str, Any]
+
+
+@lru_cache(maxsize=256)
+def _load(path: str, mtime_ns: int) -> Optional[SheetTemplate]:
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        return SheetTemplate(
+            fingerprint=SheetFingerprint.from_dict(data["fingerprint"]),
+            rules=[MappingRule.model_validate(rule) for rule in data["rules"]],
+            encoding=SingleSheetEncoding.model_validate(data["encoding"]) if data.get("encoding") else None,
+            source=data.get("source", {}))
+    except (orjson.JSONDecodeError, ValidationError, KeyError) as e:
+        logger.warning("Ignoring unreadable sheet template %s: %s", path, e)
+        return None
+
+
+class TemplateLibrary:
+    """Directory of learned sheet templates, one JSON file per fingerprint digest.
+
+    A sheet matches the template with the same digest or, failing that, the most similar one
+    above min_similarity (packs built on one template differ in a few labels or columns).
+    """
+
+    def __init__(self, directory: str, enabled: bool = True, min_similarity: float = 0.85):
+        self.directory = directory
+        self.enabled = enabled
+        self.min_similarity = min_similarity
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, "%s.json" % digest)
+
+    def _read(self, path: str) -> Optional[SheetTemplate]:
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return _load(os.path.abspath(path), mtime_ns)
+
+    def templates(self) -> List[SheetTemplate]:
+        if not os.path.isdir(self.directory):
+            return []
+        templates = (self._read(os.path.join(self.directory, name)) for name in sorted(os.listdir(self.directory))
+                     if name.endswith(".json"))
+        return [template for template in templates if template is not None]
+
+    def match(self, fingerprint: SheetFingerprint) -> Optional[Tuple[SheetTemplate, float]]:
+        """Return the best matching template and its similarity, or None."""
+        if not self.enabled:
+            return None
+        template = self._read(self._path(fingerprint.digest))
+        if template is not None:
+            return template, 1.0
+        scored = [(template, fingerprint.similarity(template.fingerprint)) for template in self.templates()]
+        scored = [(template, score) for template, score in scored if score >= self.min_similarity]
+        if not scored:
+            return None
+        return max(scored, key=lambda item: item[1])
+
+    def learn(self, fingerprint: SheetFingerprint, rules: List[MappingRule], encoding: Optional[SingleSheetEncoding],
+              workbook: str, sheet_name: str) -> Optional[str]:
+        """Save (or replace) the template of a fingerprint; returns its path, or None if there is nothing to learn."""
+        if not self.enabled or not rules:
+            return None
+        path = self._path(fingerprint.digest)
+        data = {"fingerprint": fingerprint.to_dict(), "rules": [rule.model_dump() for rule in rules],
+                "encoding": encoding.model_dump() if encoding else None,
+                "source": {"workbook": os.path.abspath(workbook), "sheet_name": sheet_name, "learned_at": time.time()}}
+        os.makedirs(self.directory, exist_ok=True)
+        # Written to a temporary file first so that concurrent readers never see a partial template
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, "wb") as f:
+            f.write(orjson.dumps(data, default=str, option=orjson.OPT_INDENT_2))
+        os.replace(temporary, path)
+        logger.info("Learned template %s from sheet '%s' (%d rules)", fingerprint.digest, sheet_name, len(rules))
+        return path
+
+
+TEMPLATES = TemplateLibrary(
+    directory=os.getenv("EXCEL_AGENT_TEMPLATE_DIR", os.path.join(os.getenv("EXCEL_AGENT_TELEMETRY_DIR", "logs"), "templates")),
+    enabled=os.getenv("EXCEL_AGENT_TEMPLATES", "1") == "1",
+    min_similarity=float(os.getenv("EXCEL_AGENT_TEMPLATE_MIN_SIMILARITY", "0.85")),
+)
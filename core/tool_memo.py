@@ -0,0 +1,46 @@
+from typing import Any, Dict, Optional, Tuple
+import orjson
+from core.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ToolCallMemo:
+    """Tool calls already answered in one conversation, and whether the conversation is still making progress.
+
+    Calls are keyed on the tool name and its validated arguments in canonical JSON, so a repeat with
+    reordered or defaulted arguments still matches. A turn that only repeats earlier calls makes no
+    progress; after stall_limit such turns in a row the loop should stop.
+    """
+
+    def __init__(self, stall_limit: int = 3):
+        self.stall_limit = stall_limit
+        self.calls: Dict[Tuple[str, bytes], Tuple[str, int]] = {}
+        self.hits = 0
+        self.stalled_turns = 0
+        self._turn_new_calls = 0
+
+    @staticmethod
+    def key(tool_name: str, arguments: Dict[str, Any]) -> Tuple[str, bytes]:
+        return tool_name, orjson.dumps(arguments, option=orjson.OPT_SORT_KEYS, default=str)
+
+    def lookup(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[str]:
+        """Return a short back-reference if this call was already answered, else None."""
+        earlier = self.calls.get(self.key(tool_name, arguments))
+        if earlier is None:
+            return None
+        self.hits += 1
+        tool_call_id, iteration = earlier
+        logger.info("Duplicate %s call, referring back to %s", tool_name, tool_call_id)
+        return ("Duplicate call: %s was already called with these arguments (tool call %s, iteration %d); "
+                "its result above is unchanged." % (tool_name, tool_call_id, iteration))
+
+    def remember(self, tool_name: str, arguments: Dict[str, Any], tool_call_id: str, iteration: int) -> None:
+        self.calls[self.key(tool_name, arguments)] = (tool_call_id, iteration)
+        self._turn_new_calls += 1
+
+    def end_turn(self) -> bool:
+        """Close a turn; return True once stall_limit turns in a row added no new tool call."""
+        self.stalled_turns = 0 if self._turn_new_calls else self.stalled_turns + 1
+        self._turn_new_calls = 0
+        return self.stalled_turns >= self.stall_limit
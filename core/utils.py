@@ -4,6 +4,8 @@ from openpyxl.styles import Border
 from typing import List, Optional, Dict
 from core.logger import setup_logger
 from openpyxl import load_workbook
+from tools.daemon import TOOL_CLIENT
+from tools.snapshot import get_workbook_sheet_names
 
 logger = setup_logger(__name__)
 
@@ -98,9 +100,13 @@ def remove_hidden_columns_all_sheets(file_path: str, output_path: Optional[str]
 
 
 def get_sheet_names(file_path: str) -> List[str]:
-    """Get all sheet names from the Excel file."""
+    """Get all sheet names from the Excel file (from the tool daemon if one is running; the sheets themselves are not parsed)."""
     logger.info("Getting sheet names from %s", file_path)
-    workbook = load_workbook(file_path)
+    if TOOL_CLIENT.available():
+        result = get_workbook_sheet_names(file_path)
+        logger.info("Got %d sheets through the workbook cache: %s", len(result), result)
+        return result
+    workbook = load_workbook(file_path, read_only=True)
     result = workbook.sheetnames
     logger.info("Successfully loaded workbook with %d sheets: %s", len(result), result)
     workbook.close()
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from typing import Any, Dict, List, Sequence, Tuple
+import numpy as np
+from core.logger import setup_logger
+from core.telemetry import TELEMETRY
+from pydantic_models.models import ExpectedOutput, MappingIssue, VerificationReport
+from tools.snapshot import get_sheet_snapshot, get_workbook_sheet_names, parse_cell_reference
+
+logger = setup_logger(__name__)
+
+# Mapped values are integers, so a cell holding 70135.64 verifies a mapping of 70136
+DEFAULT_ABS_TOLERANCE = 0.5
+
+
+def verify_mappings(excel_file_path: str, mappings: Sequence[ExpectedOutput],
+                    abs_tolerance: float = DEFAULT_ABS_TOLERANCE, rel_tolerance: float = 0.0) -> VerificationReport:
+    """Check that every mapping's cell holds its value as a literal number.
+
+    Mappings are grouped by sheet and checked with one vectorized gather per sheet against the
+    snapshot's numeric view. Formula cells are flagged (their value is not stored in the file we
+    read), as are references outside the used range, unparseable references and unknown sheets.
+    """
+    issues: List[MappingIssue] = []
+    by_sheet: Dict[str, List[Tuple[int, int, int]]] = defaultdict(list)
+    sheet_names = set(get_workbook_sheet_names(excel_file_path))
+
+    def flag(index: int, status: str, cell_value: Any = None) -> None:
+        mapping = mappings[index]
+        issues.append(MappingIssue(index=index, sheet_name=mapping.sheet_name, location_in_sheet=mapping.location_in_sheet,
+                                   value=mapping.value, status=status,
+                                   cell_value=None if cell_value is None else str(cell_value)))
+
+    for index, mapping in enumerate(mappings):
+        if mapping.sheet_name not in sheet_names:
+            flag(index, "unknown_sheet")
+            continue
+        try:
+            row, column = parse_cell_reference(mapping.location_in_sheet)
+        except ValueError:
+            flag(index, "invalid_reference")
+            continue
+        by_sheet[mapping.sheet_name].append((index, row, column))
+
+    for sheet_name, entries in by_sheet.items():
+        snapshot = get_sheet_snapshot(excel_file_path, sheet_name)
+        numbers, formulas = snapshot.numeric_view()
+        indexes, rows, columns = (np.array(values) for values in zip(*entries))
+        in_range = (rows >= 1) & (rows <= snapshot.max_row) & (columns >= 1) & (columns <= snapshot.max_column)
+        rows, columns = np.where(in_range, rows - 1, 0), np.where(in_range, columns - 1, 0)
+
+        cells = numbers[rows, columns]
+        expected = np.array([mappings[index].value for index in indexes], dtype=float)
+        tolerance = np.maximum(abs_tolerance, rel_tolerance * np.abs(expected))
+        is_formula = formulas[rows, columns] & in_range
+        is_number = ~np.isnan(cells) & in_range
+        matches = is_number & (np.abs(cells - expected) <= tolerance)
+
+        for position in np.flatnonzero(~matches):
+            index, row, column = int(indexes[position]), int(rows[position]) + 1, int(columns[position]) + 1
+            if not in_range[position]:
+                flag(index, "out_of_range")
+            elif is_formula[position]:
+                flag(index, "formula", snapshot.value(row, column))
+            elif is_number[position]:
+                flag(index, "mismatch", snapshot.value(row, column))
+            else:
+                flag(index, "not_numeric", snapshot.value(row, column))
+
+    issues.sort(key=lambda issue: issue.index)
+    report = VerificationReport(checked=len(mappings), passed=len(mappings) - len(issues), issues=issues)
+    TELEMETRY.annotate(verified_mappings=report.checked, failed_mappings=len(report.failing))
+    if issues:
+        logger.warning("Verified %d mappings: %d passed, %d failing, %d formula cells", report.checked, report.passed,
+                       len(report.failing), len(issues) - len(report.failing))
+    else:
+        logger.info("Verified %d mappings: all passed", report.checked)
+    return report
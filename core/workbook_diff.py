@@ -0,0 +1,192 @@
+import math
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+from openpyxl.utils import get_column_letter
+from core.logger import setup_logger
+from core.regions import SheetRegion, _header_rows, _split_rows
+from pydantic_models.models import SheetCoAMapping
+from tools.snapshot import SheetSnapshot, parse_cell_reference
+
+logger = setup_logger(__name__)
+
+
+def _cell_key(value: Any) -> Any:
+    """Comparable form of a cell value (ArrayFormula objects compare by their formula text)."""
+    if type(value).__name__ == "ArrayFormula":
+        return ("array_formula", value.text)
+    return value
+
+
+def _same_value(old: Any, new: Any) -> bool:
+    """Compare two cell values, ignoring float noise from re-saving a workbook."""
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(old, bool) and not isinstance(new, bool):
+        return math.isclose(old, new, rel_tol=1e-9, abs_tol=1e-9)
+    return _cell_key(old) == _cell_key(new)
+
+
+def _is_label(value: Any) -> bool:
+    """Labels identify a row or column across versions: text and dates, but not numbers or formulas."""
+    if isinstance(value, str):
+        return bool(value.strip()) and not value.startswith("=")
+    return isinstance(value, (datetime, date))
+
+
+def _signature(values: Sequence[Any]) -> Tuple[Any, ...]:
+    return tuple(value.strip().lower() if isinstance(value, str) else value for value in values if _is_label(value))
+
+
+def _align(old_signatures: List[Tuple[Any, ...]], new_signatures: List[Tuple[Any, ...]]) -> Dict[int, int]:
+    """Map 1-based old positions to new positions for runs of matching signatures."""
+    matcher = SequenceMatcher(None, old_signatures, new_signatures, autojunk=False)
+    mapping = {}
+    for old_start, new_start, size in matcher.get_matching_blocks():
+        for offset in range(size):
+            mapping[old_start + offset + 1] = new_start + offset + 1
+    return mapping
+
+
+@dataclass
+class SheetDiff:
+    """Differences between two versions of a sheet, with rows and columns aligned on their labels."""
+    sheet_name: str
+    row_map: Dict[int, int] = field(default_factory=dict)
+    column_map: Dict[int, int] = field(default_factory=dict)
+    added_rows: List[int] = field(default_factory=list)
+    removed_rows: List[int] = field(default_factory=list)
+    added_columns: List[int] = field(default_factory=list)
+    removed_columns: List[int] = field(default_factory=list)
+    changed_cells: Set[Tuple[int, int]] = field(default_factory=set)
+
+    @property
+    def unchanged(self) -> bool:
+        return not self.changed_cells and not self.removed_rows and not self.removed_columns
+
+    @property
+    def shifted(self) -> bool:
+        """True if any surviving row or column moved."""
+        return any(old != new for old, new in self.row_map.items()) or any(old != new for old, new in self.column_map.items())
+
+    def new_location(self, row: int, column: int) -> Optional[Tuple[int, int]]:
+        """Return where an old cell is in the new sheet, or None if its row or column was removed."""
+        new_row, new_column = self.row_map.get(row), self.column_map.get(column)
+        if new_row is None or new_column is None:
+            return None
+        return new_row, new_column
+
+    def summary(self) -> str:
+        return ("%d changed cells, %d added / %d removed rows, %d added / %d removed columns%s" % (
+            len(self.changed_cells), len(self.added_rows), len(self.removed_rows),
+            len(self.added_columns), len(self.removed_columns), ", layout shifted" if self.shifted else ""))
+
+
+def diff_sheets(old: SheetSnapshot, new: SheetSnapshot) -> SheetDiff:
+    """Diff two versions of a sheet.
+
+    Rows and columns are aligned on their text and date labels, so inserted periods or line items
+    shift the rest of the sheet instead of marking it all as changed. Changed cells (in new
+    coordinates) are aligned cells whose value differs plus every non-empty cell of an added row
+    or column.
+    """
+    old_columns = [old.column_values(column) for column in range(1, old.max_column + 1)]
+    new_columns = [new.column_values(column) for column in range(1, new.max_column + 1)]
+    column_map = _align([_signature(values) for values in old_columns], [_signature(values) for values in new_columns])
+    row_map = _align([_signature(old.row_values(row)) for row in range(1, old.max_row + 1)],
+                     [_signature(new.row_values(row)) for row in range(1, new.max_row + 1)])
+
+    diff = SheetDiff(sheet_name=new.sheet_name, row_map=row_map, column_map=column_map)
+    mapped_rows, mapped_columns = set(row_map.values()), set(column_map.values())
+    diff.added_rows = [row for row in range(1, new.max_row + 1) if row not in mapped_rows]
+    diff.added_columns = [column for column in range(1, new.max_column + 1) if column not in mapped_columns]
+    diff.removed_rows = [row for row in range(1, old.max_row + 1) if row not in row_map]
+    diff.removed_columns = [column for column in range(1, old.max_column + 1) if column not in column_map]
+
+    for old_column, new_column in column_map.items():
+        old_values, new_values = old_columns[old_column - 1], new_columns[new_column - 1]
+        for old_row, new_row in row_map.items():
+            if not _same_value(old_values[old_row - 1], new_values[new_row - 1]):
+                diff.changed_cells.add((new_row, new_column))
+    added_rows, added_columns = set(diff.added_rows), set(diff.added_columns)
+    for column, values in enumerate(new_columns, start=1):
+        for row, value in enumerate(values, start=1):
+            if value is not None and (row in added_rows or column in added_columns):
+                diff.changed_cells.add((row, column))
+
+    logger.info("Diff of sheet '%s': %s", new.sheet_name, diff.summary())
+    return diff
+
+
+def _column_runs(cells: Set[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Group the columns of the given cells into runs of adjacent columns."""
+    runs = []
+    for column in sorted({column for _, column in cells}):
+        if runs and column == runs[-1][1] + 1:
+            runs[-1][1] = column
+        else:
+            runs.append([column, column])
+    return [(first, last) for first, last in runs]
+
+
+def dirty_regions(regions: Sequence[SheetRegion], diff: SheetDiff, snapshot: SheetSnapshot,
+                  max_rows: int = 60) -> List[SheetRegion]:
+    """Narrow the sheet's regions to the parts that need re-mapping.
+
+    A region with changes is cut down to the runs of adjacent columns that changed, keeping its
+    rows and header rows and pointing at its leading columns for row labels. Changed cells outside
+    every region (e.g. a new period column appended right of a table) become regions of their own.
+    """
+    # Only values can be mapped; changed labels already show up as added rows or columns
+    remaining = {cell for cell in diff.changed_cells
+                 if snapshot.value(*cell) is not None and not _is_label(snapshot.value(*cell))}
+    dirty = []
+    for region in regions:
+        inside = {cell for cell in remaining if region.contains(*cell)}
+        if not inside:
+            continue
+        remaining -= inside
+        for min_column, max_column in _column_runs(inside):
+            label_columns = (region.min_column, min_column - 1) if min_column > region.min_column else region.label_columns
+            dirty.append(SheetRegion(region.table_name, region.min_row, min_column, region.max_row, max_column,
+                                     header_rows=region.header_rows, label_columns=label_columns))
+
+    for min_column, max_column in _column_runs(remaining):
+        rows = [row for row, column in remaining if min_column <= column <= max_column]
+        min_row, max_row = min(rows), max(rows)
+        region = SheetRegion("Changed cells", min_row, min_column, max_row, max_column,
+                             header_rows=_header_rows(snapshot, min_row, max_row, min_column, max_column),
+                             label_columns=(1, min_column - 1) if min_column > 1 else None)
+        dirty.extend(_split_rows(snapshot, region, max_rows) if max_row - min_row + 1 > max_rows else [region])
+
+    logger.info("Sheet '%s' has %d dirty regions: %s", diff.sheet_name, len(dirty), [region.range for region in dirty])
+    return dirty
+
+
+def carry_over_mappings(previous: SheetCoAMapping, diff: SheetDiff,
+                        fresh: Optional[SheetCoAMapping] = None) -> SheetCoAMapping:
+    """Move prior mappings of unchanged cells to their new locations and merge in freshly mapped entries.
+
+    Prior entries whose cell was removed or changed are dropped; a fresh entry for the same
+    location replaces the prior one.
+    """
+    chosen = {}
+    dropped = 0
+    for mapping in previous.mappings:
+        try:
+            location = diff.new_location(*parse_cell_reference(mapping.location_in_sheet))
+        except ValueError:
+            location = None
+        if location is None or location in diff.changed_cells:
+            dropped += 1
+            continue
+        reference = "%s%d" % (get_column_letter(location[1]), location[0])
+        chosen[reference] = mapping.model_copy(update={"sheet_name": diff.sheet_name, "location_in_sheet": reference})
+    carried = len(chosen)
+    for mapping in (fresh.mappings if fresh else []):
+        chosen[mapping.location_in_sheet.replace("$", "").upper()] = mapping
+
+    summary = "Carried over %d prior mappings (%d dropped as changed or removed). %s" % (
+        carried, dropped, fresh.analysis_summary if fresh else "No regions needed re-mapping.")
+    logger.info("Sheet '%s': carried over %d prior mappings, dropped %d, %d freshly mapped",
+                diff.sheet_name, carried, dropped, len(fresh.mappings) if fresh else 0)
+    return SheetCoAMapping(sheet_name=diff.sheet_name, mappings=list(chosen.values()), analysis_summary=summary)
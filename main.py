@@ -1,13 +1,82 @@
+import argparse
 import os
 import json
+from typing import Any, Dict, List, Tuple
 from dotenv import load_dotenv
 from agents import SpreadsheetEncoderAgent, SheetSelectorAgent, ExcelAgent
+from core.encodings import load_sheet_encoding
 from core.logger import setup_logger
+from core.profiling import PROFILER
+from core.telemetry import TELEMETRY, Span
+from core.templates import TEMPLATES, adapt_encoding, learn_rules, sheet_fingerprint
 from core.utils import get_sheet_names
+from core.workbook_diff import diff_sheets
+from pydantic_models.models import SheetCoAMapping
+from tools.columnar import columnar_snapshot_exists, convert_workbook, load_columnar_workbook
+from tools.shared_memory import shared_workbook_pool
+from tools.snapshot import get_sheet_snapshot
 
 
 logger = setup_logger(__name__)
 
+def map_sheet(excel_file: str, sheet_name: str, coa_items: list, encoded_sheets_dir: str, map_reduce: bool,
+              mappings_dir: str = None, baseline_dir: str = None) -> SheetCoAMapping:
+    """Map one sheet to CoA codes with ExcelAgent (runs in the main process or in a pool worker).
+    
+    With a baseline snapshot of the workbook the previous mappings were made from, only the
+    regions that changed since then are re-mapped. A sheet matching a learned template is mapped
+    by applying the template's rules; any other mapped sheet becomes a template for later ones.
+    """
+    logger.info("Processing sheet: %s", sheet_name)
+    agent = ExcelAgent(api_key=os.getenv("OPENAI_API_KEY"))
+    encoding = load_sheet_encoding(encoded_sheets_dir, sheet_name)
+    
+    result = None
+    previous_filepath = os.path.join(mappings_dir, f"{sheet_name}.json") if mappings_dir else None
+    if baseline_dir and previous_filepath and os.path.exists(previous_filepath):
+        baseline = load_columnar_workbook(baseline_dir)
+        if sheet_name in baseline.sheet_names:
+            with open(previous_filepath, "r", encoding="utf-8") as f:
+                previous = SheetCoAMapping(**json.load(f))
+            diff = diff_sheets(baseline.snapshot(sheet_name), get_sheet_snapshot(excel_file, sheet_name))
+            result = agent.execute_incremental(excel_file, sheet_name, previous, diff, encoding=encoding, coa_items=coa_items)
+    
+    fingerprint, from_template = None, False
+    if TEMPLATES.enabled:
+        snapshot = get_sheet_snapshot(excel_file, sheet_name)
+        fingerprint = sheet_fingerprint(snapshot)
+        match = TEMPLATES.match(fingerprint)
+        if match is not None:
+            template, similarity = match
+            logger.info("Sheet '%s' matches template %s (similarity %.2f)", sheet_name, template.fingerprint.digest, similarity)
+            if encoding is None and template.encoding is not None:
+                encoding = adapt_encoding(template.encoding, snapshot)
+            if result is None:
+                result = agent.execute_from_template(excel_file, sheet_name, template, coa_items=coa_items)
+                from_template = result is not None
+    
+    if result is None and map_reduce:
+        result = agent.execute_by_regions(excel_file, sheet_name, encoding=encoding, coa_items=coa_items)
+    elif result is None:
+        result = agent.execute(excel_file, sheet_name=sheet_name, encoding=encoding, coa_items=coa_items)
+    
+    # Check every mapping against its cell before it is written; failing entries can be sent back for correction
+    correct = os.getenv("EXCEL_AGENT_CORRECT_MAPPINGS", "0") == "1"
+    result = agent.verify_and_correct(excel_file, result, correct=correct, coa_items=coa_items)
+    if fingerprint is not None and not from_template and result.mappings:
+        TEMPLATES.learn(fingerprint, learn_rules(get_sheet_snapshot(excel_file, sheet_name), result), encoding, excel_file, sheet_name)
+    return result
+
+def _init_sheet_worker() -> None:
+    """Pool initializer: keep the worker's spans and tool timings in memory for the parent to merge."""
+    TELEMETRY.collect_for_parent()
+    PROFILER.collect_for_parent()
+
+def _map_sheet_in_worker(*args: Any) -> Tuple[SheetCoAMapping, List[Span], Dict[str, List[float]]]:
+    """map_sheet in a pool worker, returning the spans and tool timings it recorded along with its result."""
+    result = map_sheet(*args)
+    return result, TELEMETRY.drain(), PROFILER.drain_tool_durations()
+
 def main():
     """Example usage of ExcelAgent and SpreadsheetEncoderAgent."""
     logger.info("Starting ExcelAgent application")
@@ -113,14 +182,34 @@ def main():
     
     # Process each selected sheet with ExcelAgent
     logger.info("=== Processing selected sheets with ExcelAgent ===")
-    agent = ExcelAgent(api_key=api_key)
     
-    for sheet_name in selected_sheet_names:
-        logger.info("Processing sheet: %s", sheet_name)
-        
-        # Execute CoA mapping for this sheet
-        result = agent.execute(excel_file, sheet_name=sheet_name, coa_items=coa_items)
-        
+    # Map-reduce mode maps each table region of a sheet concurrently
+    map_reduce = os.getenv("EXCEL_AGENT_MAP_REDUCE", "0") == "1"
+    # With more than one process, sheets are mapped in a pool that shares the parsed workbook
+    sheet_processes = int(os.getenv("EXCEL_AGENT_SHEET_PROCESSES", "1"))
+    
+    # Incremental mode re-maps only what changed since the workbook snapshot saved by the last run
+    incremental = os.getenv("EXCEL_AGENT_INCREMENTAL", "0") == "1"
+    baseline_dir = f"data/{client_name}/baseline_snapshot"
+    if incremental and not columnar_snapshot_exists(baseline_dir):
+        logger.info("No baseline snapshot in %s yet, mapping all sheets", baseline_dir)
+    use_baseline = incremental and columnar_snapshot_exists(baseline_dir)
+    
+    sheet_args = [(excel_file, sheet_name, coa_items, encoded_sheets_dir, map_reduce, mappings_dir, baseline_dir if use_baseline else None)
+                  for sheet_name in selected_sheet_names]
+    if sheet_processes > 1:
+        with shared_workbook_pool([excel_file], processes=sheet_processes, initializer=_init_sheet_worker) as pool:
+            outputs = pool.starmap(_map_sheet_in_worker, sheet_args)
+        # The workers' spans and tool timings become part of this run's telemetry and histograms
+        results = []
+        for result, spans, tool_durations in outputs:
+            TELEMETRY.merge(spans)
+            PROFILER.merge_tool_durations(tool_durations)
+            results.append(result)
+    else:
+        results = (map_sheet(*args) for args in sheet_args)
+    
+    for sheet_name, result in zip(selected_sheet_names, results):
         # Save the mapping result to a JSON file
         mapping_filename = f"{sheet_name}.json"
         mapping_filepath = os.path.join(mappings_dir, mapping_filename)
@@ -131,6 +220,19 @@ def main():
         logger.info("Successfully processed sheet: %s", sheet_name)
     
     logger.info("Successfully processed all selected sheets and saved mapping results to %s", mappings_dir)
+    
+    if incremental:
+        # The mapped workbook becomes the baseline that the next revision is diffed against
+        convert_workbook(excel_file, baseline_dir)
+
+    # Write per-sheet and per-run telemetry summary next to the span export
+    TELEMETRY.write_summary()
+    PROFILER.write_tool_histograms()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map the client's workbook to CoA codes.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile agent runs, workbook loads and tool calls (same as EXCEL_AGENT_PROFILE=1)")
+    if parser.parse_args().profile:
+        PROFILER.enable()
     main()
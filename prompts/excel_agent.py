@@ -1,16 +1,16 @@
 import json
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple
 from pydantic_models.models import SheetCoAMapping
 
-def get_task_prompt(**kwargs) -> str:
+
+@lru_cache(maxsize=None)
+def get_static_prompt() -> str:
     """
-    Returns the task prompt for the Excel Agent.
+    Returns the static part of the Excel Agent task prompt (instructions and output schema).
     
-    The Excel Agent is responsible for executing various tasks on Excel files using
-    a set of specialized tools. It can analyze spreadsheet data, extract information,
-    and perform data manipulation tasks.
-    
-    Args:
-        **kwargs: Additional named arguments to append to the end of the task prompt
+    The result is built once per process so that it is byte-identical across sheets and
+    clients, which lets provider-side prompt caching reuse it.
     """
     # Generate the schema from the Pydantic model
     schema = SheetCoAMapping.model_json_schema()
@@ -23,7 +23,7 @@ def get_task_prompt(**kwargs) -> str:
 
     **CRITICAL: You must either:**
     1. **Return tool calls** if you need to use tools to gather information or perform actions
-    2. **Return the final result** if no tools need to be called and you can provide the complete answer
+    2. **Call the `submit_result` tool** with the complete SheetCoAMapping once no more tools need to be called
 
     ## Encoded Spreadsheet Usage
 
@@ -34,8 +34,6 @@ def get_task_prompt(**kwargs) -> str:
     - Leverage the pre-analyzed data types and patterns to choose the most appropriate tools
     - **Your output format must exactly match the provided format specification**
 
-    {additional_context}
-
     ## Primary Task
 
     **Your main task is to map values in the specific sheet to their corresponding Chart of Accounts (CoA) codes.**
@@ -46,7 +44,7 @@ def get_task_prompt(**kwargs) -> str:
 
     Your final output must follow the required structured format for CoA analysis results for the specific sheet.
 
-    The response will be automatically formatted according to the specified schema.
+    Submit it by calling the `submit_result` tool; its arguments must follow the schema below.
 
     ## Required Output Schema (SheetCoAMapping)
 
@@ -56,11 +54,74 @@ def get_task_prompt(**kwargs) -> str:
     
     """
 
+    return prompt_template.format(schema_json=schema_json)
+
+
+@lru_cache(maxsize=32)
+def get_client_prompt_prefix(coa_items: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    Returns the cacheable prompt prefix for a client: the static prompt followed by the client's CoA list.
+    
+    Args:
+        coa_items: The client's Chart of Accounts items, or None if no CoA list is given
+    """
+    prefix = get_static_prompt()
+    if coa_items is not None:
+        prefix += "\n\n## Chart of Accounts Items:\n"
+        prefix += "".join(f"- {item}\n" for item in coa_items)
+    return prefix
+
+
+def get_task_prompt(coa_items: Optional[Sequence[str]] = None, encoded_sheet: Optional[str] = None, **kwargs) -> str:
+    """
+    Returns the task prompt for the Excel Agent.
+    
+    The Excel Agent is responsible for executing various tasks on Excel files using
+    a set of specialized tools. It can analyze spreadsheet data, extract information,
+    and perform data manipulation tasks.
+    
+    The prompt is laid out so that everything shared between sheets of a client comes
+    first and the per-sheet context comes last.
+    
+    Args:
+        coa_items: The client's Chart of Accounts items
+        encoded_sheet: Compact encoding of the sheet's layout, attached at the very end
+        **kwargs: Additional named arguments to append to the end of the task prompt
+    """
+    prefix = get_client_prompt_prefix(tuple(coa_items) if coa_items is not None else None)
+
     # Append any additional context from kwargs
     additional_context = ""
     if kwargs:
         additional_context = "\n\n## Additional Context:\n"
         for key, value in kwargs.items():
             additional_context += f"- **{key.replace('_', ' ').title()}**: {value}\n"
+    if encoded_sheet:
+        additional_context += "\n\n## Encoded Spreadsheet:\n" + encoded_sheet + "\n"
     
-    return prompt_template.format(schema_json=schema_json, additional_context=additional_context) 
\ No newline at end of file
+    return prefix + additional_context
+
+
+def get_template_check_prompt(sheet_name: str, source_sheet: str, entries: Sequence[str], omitted: int = 0) -> str:
+    """
+    Returns the prompt for checking mappings that were produced by applying a learned sheet template.
+    
+    The check is a single call without tools, so the prompt carries each mapped cell's row label
+    and column period and asks only whether they fit the CoA label and timestamp.
+    
+    Args:
+        sheet_name: The sheet that was mapped
+        source_sheet: Workbook and sheet the template was learned from
+        entries: One 'cell | value | row label | period | CoA label | timestamp | unit' line per mapping
+        omitted: Number of further mappings not listed
+    """
+    return (
+        f"The sheet '{sheet_name}' has the same structure as the sheet {source_sheet}, which was mapped to Chart of "
+        "Accounts (CoA) codes before. Its mappings were transferred by row label and column. Check that each mapping "
+        "below still fits: the CoA label must match the row label and the timestamp must match the column period.\n\n"
+        "Answer template_fits=false if the sheet clearly does not follow the template (most mappings do not fit), "
+        "otherwise list the cells of the individual mappings that do not fit in wrong_cells.\n\n"
+        "cell | value | row label | period | CoA label | timestamp | unit\n"
+        + "\n".join(entries)
+        + (f"\n... and {omitted} more mappings of the same rows" if omitted else "")
+    )
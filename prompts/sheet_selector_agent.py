@@ -1,33 +1,22 @@
 import json
+from functools import lru_cache
 from pydantic_models.models import SheetSelectionResponse
 
-def get_task_prompt(sheet_names: list, coa_items: list, excel_file_path: str = None) -> str:
-    """Generate the task prompt for the sheet selector agent."""
+
+@lru_cache(maxsize=None)
+def get_static_prompt() -> str:
+    """Generate the static part of the sheet selector prompt, built once so it forms a byte-stable prefix."""
     
     # Generate the schema from the Pydantic model
     schema = SheetSelectionResponse.model_json_schema()
     schema_json = json.dumps(schema, indent=2)
     
-    coa_items_text = "\n".join([f"- {item}" for item in coa_items])
-    
     prompt = f"""
 You are a financial data analyst tasked with identifying which Excel sheets are likely to contain values corresponding to specific Chart of Accounts (CoA) items.
 
-**EXCEL FILE:** {excel_file_path or "Not specified"}
-
 **TASK:**
 Analyze the provided list of sheet names from the Excel file and determine which sheets are likely to contain financial data that corresponds to the CoA items listed below.
 
-**CHART OF ACCOUNTS ITEMS TO MATCH:**
-```
-{coa_items_text}
-```
-
-**SHEET NAMES TO EVALUATE:**
-```
-{chr(10).join([f"- {sheet}" for sheet in sheet_names])}
-```
-
 **INSTRUCTIONS:**
 
 1. **For each sheet name, analyze whether it's likely to contain financial data that would map to any of the CoA items**
@@ -44,7 +33,7 @@ Analyze the provided list of sheet names from the Excel file and determine which
    - If the sheet name is ambiguous or unclear (e.g., "Sheet1", "Data", "Summary"), use tools to examine the sheet content
    - Use tools efficiently - examine only a small sample of data to understand the sheet's purpose
 
-4. **Return a JSON response that follows the SheetSelectionResponse schema structure with:**
+4. **Submit your decisions by calling the `submit_result` tool with arguments that follow the SheetSelectionResponse schema structure:**
    - `selected_sheets`: List of SheetSelection objects
    - Each SheetSelection contains:
      - `sheet_name`: Name of the sheet
@@ -70,3 +59,25 @@ Please analyze each sheet name carefully and provide your reasoning for inclusio
 """
     
     return prompt
+
+
+def get_task_prompt(sheet_names: list, coa_items: list, excel_file_path: str = None) -> str:
+    """Generate the task prompt for the sheet selector agent."""
+    
+    coa_items_text = "\n".join([f"- {item}" for item in coa_items])
+    
+    prompt = f"""
+**CHART OF ACCOUNTS ITEMS TO MATCH:**
+```
+{coa_items_text}
+```
+
+**EXCEL FILE:** {excel_file_path or "Not specified"}
+
+**SHEET NAMES TO EVALUATE:**
+```
+{chr(10).join([f"- {sheet}" for sheet in sheet_names])}
+```
+"""
+    
+    return get_static_prompt() + prompt
@@ -1,15 +1,14 @@
 import json
+from functools import lru_cache
 from pydantic_models.models import SingleSheetEncoding
 
-def get_task_prompt(**kwargs) -> str:
+
+@lru_cache(maxsize=None)
+def get_static_prompt() -> str:
     """
-    Returns the task prompt for the Spreadsheet Encoder Agent.
-    
-    The Spreadsheet Encoder Agent is responsible for generating compressed representations
-    of spreadsheet structure and data types for efficient LLM understanding.
+    Returns the static part of the Spreadsheet Encoder Agent task prompt (instructions and output schema).
     
-    Args:
-        **kwargs: Additional named arguments to append to the end of the task prompt
+    The result is built once per process so that it forms a byte-stable prefix for every sheet.
     """
     # Generate the schema from the Pydantic model
     schema = SingleSheetEncoding.model_json_schema()
@@ -47,7 +46,7 @@ def get_task_prompt(**kwargs) -> str:
     - Plan your tool usage efficiently - batch related queries when possible
     - Only respond with either:
       - Tool calls to extract information
-      - The final comprehensive encoded representation in JSON format
+      - The final comprehensive encoded representation, submitted with the `submit_result` tool
 
     ### 3. **No Assumptions**
     - Extract actual data through tools rather than guessing
@@ -91,7 +90,7 @@ def get_task_prompt(**kwargs) -> str:
     ### Response Format
     You must respond in one of two ways:
     1. **Tool Calls**: Use available tools to extract information from the spreadsheet
-    2. **Final Response**: Return the complete encoded representation in the SingleSheetEncoding format
+    2. **Final Response**: Call the `submit_result` tool with the complete encoded representation in the SingleSheetEncoding format
 
     ## Required Output Schema (SingleSheetEncoding)
 
@@ -108,7 +107,21 @@ def get_task_prompt(**kwargs) -> str:
     - Focus on creating a complete picture that captures the essence and structure of the specific sheet you are encoding
     - **CRITICAL**: Use the minimum number of tool calls necessary - they are costly, so plan efficiently and batch related queries
 
-    {additional_context}"""
+    """
+
+    return prompt_template.format(schema_json=schema_json)
+
+
+def get_task_prompt(**kwargs) -> str:
+    """
+    Returns the task prompt for the Spreadsheet Encoder Agent.
+    
+    The Spreadsheet Encoder Agent is responsible for generating compressed representations
+    of spreadsheet structure and data types for efficient LLM understanding.
+    
+    Args:
+        **kwargs: Additional named arguments to append to the end of the task prompt
+    """
 
     # Append any additional context from kwargs
     additional_context = ""
@@ -117,4 +130,4 @@ def get_task_prompt(**kwargs) -> str:
         for key, value in kwargs.items():
             additional_context += f"- **{key.replace('_', ' ').title()}**: {value}\n"
     
-    return prompt_template.format(schema_json=schema_json, additional_context=additional_context) 
\ No newline at end of file
+    return get_static_prompt() + additional_context 
\ No newline at end of file
@@ -145,3 +145,69 @@ class SheetSelectionResponse(BaseModel):
     class Config:
         """Configuration for SheetSelectionResponse model."""
         name = "SheetSelectionResponse"
+
+
+# Evaluation models
+class MatchCounts(BaseModel):
+    """Model representing match counts and the derived precision/recall for a group of entries."""
+    predicted: int = Field(0, description="Number of predicted entries in the group")
+    expected: int = Field(0, description="Number of ground truth entries in the group")
+    true_positives: int = Field(0, description="Number of predicted entries matched to a ground truth entry")
+    precision: float = Field(0.0, description="true_positives / predicted")
+    recall: float = Field(0.0, description="true_positives / expected")
+    f1: float = Field(0.0, description="Harmonic mean of precision and recall")
+
+
+class EvaluationReport(BaseModel):
+    """Model representing the evaluation of predicted mappings against ground truth."""
+    overall: MatchCounts = Field(..., description="Counts and metrics over all entries")
+    per_sheet: Dict[str, MatchCounts] = Field(..., description="Metrics per sheet; expected and recall only count ground truth entries that carry a sheet_name")
+    per_coa: Dict[str, MatchCounts] = Field(..., description="Metrics per CoA code")
+
+
+# Verification models
+class MappingIssue(BaseModel):
+    """Model representing a mapping whose cell does not hold the mapped value as a literal."""
+    index: int = Field(..., description="Position of the mapping in the verified list")
+    sheet_name: str = Field(..., description="Sheet named by the mapping")
+    location_in_sheet: str = Field(..., description="Cell reference named by the mapping")
+    value: int = Field(..., description="Value the mapping claims the cell holds")
+    status: str = Field(..., description="One of: mismatch, not_numeric, formula, out_of_range, invalid_reference, unknown_sheet")
+    cell_value: Optional[str] = Field(None, description="What the cell actually holds, if it could be read")
+
+    @property
+    def failing(self) -> bool:
+        """Formula cells cannot be checked against a literal value, so they are flagged but not failed."""
+        return self.status != "formula"
+
+
+class VerificationReport(BaseModel):
+    """Model representing the result of checking mappings against their sheets."""
+    checked: int = Field(..., description="Number of mappings checked")
+    passed: int = Field(..., description="Number of mappings whose cell holds the mapped value")
+    issues: List[MappingIssue] = Field(default_factory=list, description="Mappings that failed or could not be checked")
+
+    @property
+    def failing(self) -> List[MappingIssue]:
+        return [issue for issue in self.issues if issue.failing]
+
+
+# Template models
+class MappingRule(BaseModel):
+    """Model representing a mapping learned from a sheet, anchored on its row label and column instead of a cell."""
+    label: Optional[str] = Field(None, description="Normalized row label of the mapped cell (digits replaced by '#')")
+    occurrence: int = Field(0, description="Which row with this label the cell is on (0 = the first), for labels that repeat")
+    row: int = Field(..., description="Row of the cell in the sheet the rule was learned from, used when the row has no label")
+    column_letter: str = Field(..., description="Column of the cell")
+    header: Optional[str] = Field(None, description="Column header of the cell, with periods replaced by placeholders")
+    period: Optional[str] = Field(None, description="Column period of the cell in the sheet the rule was learned from")
+    CoA_label: str = Field(..., description="Chart of Accounts label the cell maps to")
+    timestamp_of_value: str = Field(..., description="Timestamp of the learned mapping; re-derived from the column period when the period moves")
+    unit: str = Field(..., description="Unit of the learned mapping")
+
+
+class TemplateCheck(BaseModel):
+    """Model representing the LLM's check of mappings produced from a learned sheet template."""
+    template_fits: bool = Field(..., description="Whether the sheet follows the template, so the mappings are plausible overall")
+    wrong_cells: List[str] = Field(default_factory=list, description="Cell references of mappings that do not fit their row label or period")
+    comment: str = Field("", description="Short reason for the verdict")
@@ -1,8 +1,23 @@
+import importlib
 from .tools import (
     get_row_values, get_column_values, get_cell_value,
     get_data_types_column, get_sheet_dimensions,
     find_cells_with_value, get_range_values, get_sheet_content,
     get_max_rows, get_max_columns,
-    get_row_values_sample, get_column_values_sample, get_data_types_column_sample
+    get_row_values_sample, get_column_values_sample, get_data_types_column_sample,
+    search_workbook, query_sheet, get_cell_contexts
 )
+from .registry import TOOL_REGISTRY, ToolRegistry, ToolCallError
 
+# The snapshot backends are imported on first use, so that running them as scripts
+# (python -m tools.columnar / tools.xlsx_reader) does not import them twice
+_LAZY = {
+    "convert_workbook": "columnar", "load_columnar_workbook": "columnar", "open_columnar_workbook": "columnar",
+    "StreamingWorkbook": "xlsx_reader",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    return getattr(importlib.import_module("." + _LAZY[name], __name__), name)
@@ -0,0 +1,290 @@
+import datetime
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from openpyxl.utils import get_column_letter
+from core.logger import setup_logger
+from tools.snapshot import SheetSnapshot
+
+logger = setup_logger(__name__)
+
+_MONTH = r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*"
+# Period patterns from most to least specific; a column takes the most specific period in its header rows
+_PERIOD_PATTERNS = (
+    re.compile(r"^%s[\s\-'/.,]*(?:\d{2}|\d{4})$" % _MONTH, re.IGNORECASE),
+    re.compile(r"^(?:\d{1,2}[/\-.])?\d{1,2}[/\-.](?:\d{2}|\d{4})$|^\d{4}[/\-.]\d{1,2}(?:[/\-.]\d{1,2})?$"),
+    re.compile(r"^%s$" % _MONTH, re.IGNORECASE),
+    re.compile(r"^(?:q[1-4]|h[12])\b.*|.*\b(?:q[1-4]|h[12])$", re.IGNORECASE),
+    re.compile(r"^(?:fy|cy)\s*'?\d{2,4}\b.*|^(?:19|20)\d{2}(?:\s*[/\-]\s*\d{2,4})?$|.*\bfy\s*'?\d{2,4}$", re.IGNORECASE),
+    re.compile(r"^(?:period|month|week|p|m|wk)\s*\d{1,2}\b.*|^(?:ytd|ltm|ttm|full year|fy)\b.*", re.IGNORECASE),
+)
+_FISCAL_YEAR = re.compile(r"\bfy\s*'?\d{2,4}\b", re.IGNORECASE)
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_year(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and 1990 <= value <= 2100
+
+
+def _is_header_numbers(numbers: List[Any]) -> bool:
+    """Numbers that label columns rather than being figures: ascending years or a 1, 2, 3... column index."""
+    if len(numbers) < 2 or not all(isinstance(value, int) and not isinstance(value, bool) for value in numbers):
+        return False
+    if all(_is_year(value) for value in numbers) and numbers == sorted(set(numbers)):
+        return True
+    return len(numbers) >= 3 and all(later - earlier == 1 for earlier, later in zip(numbers, numbers[1:]))
+
+
+def _is_formula(value: Any) -> bool:
+    return isinstance(value, str) and value.startswith("=")
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.strftime("%b %Y")
+    if isinstance(value, float):
+        return format(value, ".12g")
+    return " ".join(str(value).split())
+
+
+def period_rank(value: Any) -> Optional[int]:
+    """How specific a header value is as a period (0 = a month and year), or None if it is not date-like."""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return 0
+    if _is_year(value):
+        return 4
+    if not isinstance(value, str) or _is_formula(value):
+        return None
+    text = " ".join(value.split())
+    for rank, pattern in enumerate(_PERIOD_PATTERNS):
+        if pattern.match(text):
+            return rank
+    return None
+
+
+@dataclass
+class HeaderBlock:
+    """Consecutive header rows and, per value column, the header texts (top to bottom) and the period."""
+    first_row: int
+    last_row: int
+    headers: Dict[int, List[str]] = field(default_factory=dict)
+    periods: Dict[int, str] = field(default_factory=dict)
+
+
+@dataclass
+class SheetLayout:
+    """Where a sheet's values, labels and column headers are."""
+    value_columns: List[int]
+    label_columns: List[int]
+    header_blocks: List[HeaderBlock]
+    # A fiscal year named in a title or label cell above the data, used for columns without a period
+    default_period: Optional[str] = None
+
+    def block_for(self, row: int) -> Optional[HeaderBlock]:
+        """The nearest header block above a row."""
+        found = None
+        for block in self.header_blocks:
+            if block.last_row < row:
+                found = block
+        return found
+
+
+@dataclass(frozen=True)
+class CellContext:
+    """A numeric cell with the row label and column period that give it meaning."""
+    cell: str
+    value: Any
+    label: Optional[str]
+    period: Optional[str]
+    header: Optional[str]
+
+
+def _header_row(snapshot: SheetSnapshot, row: int, value_columns: List[int], min_cells: int) -> bool:
+    """A header row has text or dates in the value columns, no figures and no more formulas than text.
+
+    Years in ascending order and 1, 2, 3... column indexes count as header text.
+    """
+    present = [value for value in (snapshot.value(row, column) for column in value_columns) if value is not None]
+    formulas = sum(1 for value in present if _is_formula(value))
+    numbers = [value for value in present if _is_number(value)]
+    if numbers and not _is_header_numbers(numbers):
+        return False
+    labels = len(present) - formulas
+    return labels >= min_cells and labels >= formulas
+
+
+def _fill_merged(snapshot: SheetSnapshot, row: int, value_columns: List[int]) -> Dict[int, Any]:
+    """Header values of a row, with each value carried right over the empty cells after it.
+
+    The snapshot keeps a merged cell's value in its top-left cell only, so a group header such
+    as 'FY25' above twelve month columns is spread over the columns up to the next header value.
+    """
+    values, current, previous = {}, None, None
+    for column in value_columns:
+        value = snapshot.value(row, column)
+        if _is_formula(value):
+            # Formula text says nothing about the column without evaluating it
+            current = None
+        elif value is not None:
+            current = value
+        elif previous is not None and column != previous + 1:
+            # A gap in the value columns (e.g. a label column in between) ends the merged range
+            current = None
+        if current is not None:
+            values[column] = current
+        previous = column
+    return values
+
+
+def resolve_layout(snapshot: SheetSnapshot, max_row: Optional[int] = None) -> SheetLayout:
+    """Detect the value columns, label columns and header rows of a sheet down to max_row.
+
+    Value columns hold figures (literal numbers or formulas). Header rows are rows with text or
+    dates in the value columns and no figures; consecutive header rows (blank rows between them
+    allowed) form a block that labels the data below it until the next block. Label columns are
+    the text columns beside the figures, ranked by how many data rows they label.
+    """
+    max_row = min(max_row or snapshot.max_row, snapshot.max_row)
+    figures: Dict[int, int] = {}
+    for row_number, row in snapshot.iter_rows():
+        if row_number > max_row:
+            break
+        # Rows of years or column indexes are headers, not figures
+        if _is_header_numbers([value for value in row if _is_number(value)]):
+            continue
+        for column, value in enumerate(row, start=1):
+            if _is_number(value) or _is_formula(value):
+                figures[column] = figures.get(column, 0) + 1
+    value_columns = sorted(column for column, count in figures.items() if count >= 2) or sorted(figures)
+
+    blocks: List[HeaderBlock] = []
+    data_rows: List[int] = []
+    in_block = False
+    for row in range(1, max_row + 1):
+        if _header_row(snapshot, row, value_columns, 1 if not data_rows else 2):
+            if not in_block:
+                # Columns the new block does not label keep the headers of the block before it
+                previous = blocks[-1] if blocks else None
+                blocks.append(HeaderBlock(row, row, {column: list(headers) for column, headers in previous.headers.items()} if previous else {},
+                                          dict(previous.periods) if previous else {}))
+                in_block = True
+            block = blocks[-1]
+            block.last_row = row
+            for column, value in _fill_merged(snapshot, row, value_columns).items():
+                block.headers.setdefault(column, []).append(_text(value))
+                rank = period_rank(value)
+                current = block.periods.get(column)
+                if rank is not None and (current is None or rank < period_rank(current)):
+                    block.periods[column] = _text(value)
+        elif any(snapshot.value(row, column) is not None for column in value_columns):
+            data_rows.append(row)
+            in_block = False
+
+    label_counts: Dict[int, int] = {}
+    for row in data_rows:
+        for column, value in enumerate(snapshot.row_values(row), start=1):
+            if isinstance(value, str) and not _is_formula(value) and value.strip() and not _is_number(value):
+                if column not in value_columns or figures.get(column, 0) < len(data_rows) // 2:
+                    label_counts[column] = label_counts.get(column, 0) + 1
+    threshold = max(2, len(data_rows) // 5)
+    label_columns = sorted(column for column, count in label_counts.items() if count >= threshold)
+
+    default_period = None
+    first_data_row = data_rows[0] if data_rows else max_row + 1
+    for row in range(1, first_data_row):
+        for value in snapshot.row_values(row):
+            if isinstance(value, str) and not _is_formula(value):
+                match = _FISCAL_YEAR.search(value)
+                if match:
+                    default_period = match.group(0).upper().replace(" ", "")
+                    break
+        if default_period:
+            break
+
+    logger.info("Sheet '%s': %d value columns, label columns %s, header rows %s", snapshot.sheet_name, len(value_columns),
+                [get_column_letter(column) for column in label_columns],
+                ["%d-%d" % (block.first_row, block.last_row) for block in blocks])
+    return SheetLayout(value_columns, label_columns, blocks, default_period)
+
+
+def _nearest_text(snapshot: SheetSnapshot, row: int) -> Tuple[List[Optional[str]], List[Optional[str]]]:
+    """For each column of a row (index = column), the nearest text strictly to its left and to its right, in one pass each way."""
+    values = snapshot.row_values(row)
+    texts = [_text(value) if isinstance(value, str) and value.strip() and not _is_formula(value) else None for value in values]
+    left: List[Optional[str]] = [None]
+    current = None
+    for text in texts:
+        left.append(current)
+        current = text or current
+    right: List[Optional[str]] = [None] * (len(texts) + 1)
+    current = None
+    for column in range(len(texts), 0, -1):
+        right[column] = current
+        current = texts[column - 1] or current
+    return left, right
+
+
+def _row_label(snapshot: SheetSnapshot, layout: SheetLayout, row: int, column: int,
+               nearest: Tuple[List[Optional[str]], List[Optional[str]]]) -> Optional[str]:
+    """Text of the row's label columns left of the cell, or else the nearest text to its left (from _nearest_text).
+
+    Cells with no text to their left, such as account codes in front of their descriptions, take
+    the nearest text to their right.
+    """
+    parts = []
+    for label_column in layout.label_columns:
+        if label_column >= column:
+            break
+        value = snapshot.value(row, label_column)
+        if isinstance(value, str) and value.strip() and not _is_formula(value):
+            parts.append(_text(value))
+    if parts:
+        return " / ".join(parts)
+    left, right = nearest
+    if column < len(left):
+        return left[column] or right[column]
+    return left[-1]
+
+
+def resolve_cells(snapshot: SheetSnapshot, min_row: int = 1, max_row: Optional[int] = None, min_column: int = 1,
+                  max_column: Optional[int] = None, include_formulas: bool = False,
+                  layout: Optional[SheetLayout] = None) -> List[CellContext]:
+    """Give every numeric cell of a sheet or region its row label, column period and full column header.
+
+    The layout is detected from the whole sheet down to max_row, so header rows above a region
+    and label columns left of it still apply (pass layout to reuse one already detected). Formula
+    cells are left out unless include_formulas.
+    """
+    max_row = min(max_row or snapshot.max_row, snapshot.max_row)
+    max_column = min(max_column or snapshot.max_column, snapshot.max_column)
+    layout = layout or resolve_layout(snapshot, max_row)
+    contexts = []
+    for row in range(min_row, max_row + 1):
+        block = layout.block_for(row)
+        nearest = None
+        for column in range(min_column, max_column + 1):
+            value = snapshot.value(row, column)
+            if not (_is_number(value) or (include_formulas and _is_formula(value))):
+                continue
+            if nearest is None:
+                nearest = _nearest_text(snapshot, row)
+            headers = block.headers.get(column, []) if block else []
+            period = (block.periods.get(column) if block else None) or layout.default_period
+            contexts.append(CellContext(
+                cell="%s%d" % (get_column_letter(column), row), value=value, label=_row_label(snapshot, layout, row, column, nearest),
+                period=period, header=" / ".join(dict.fromkeys(headers)) or None))
+    return contexts
+
+
+def format_cell_contexts(snapshot: SheetSnapshot, contexts: List[CellContext], max_cells: int = 300) -> str:
+    """Render cell contexts as a compact table: cell | value | row label | period | column header."""
+    lines = ["Sheet '%s': %d numeric cells%s" % (snapshot.sheet_name, len(contexts),
+                                                 " (first %d shown)" % max_cells if len(contexts) > max_cells else ""),
+             "cell | value | label | period | header"]
+    for context in contexts[:max_cells]:
+        lines.append(" | ".join(["%s" % context.cell, _text(context.value), context.label or "", context.period or "",
+                                 context.header or ""]).replace("\n", " "))
+    return "\n".join(lines)
@@ -0,0 +1,396 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from openpyxl.worksheet.formula import ArrayFormula
+from core.logger import setup_logger
+from tools.snapshot import SheetSnapshot, WorkbookBackend, _load_openpyxl_workbook, register_snapshot_backend
+
+logger = setup_logger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Names the version directory readers should open, then the one it replaced
+CURRENT_FILE = "current"
+
+# Cell kinds stored in kinds.npy; values.npy holds an int64 payload whose meaning depends on the kind
+EMPTY, INTEGER, FLOAT, BOOLEAN, STRING, FORMULA, ARRAY_FORMULA, DATETIME, DATE, TIME, TIMEDELTA = range(11)
+
+ARRAY_NAMES = ("kinds", "values", "string_offsets", "strings", "hidden_rows", "hidden_columns")
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECONDS = 1000000
+
+
+def default_snapshot_dir(file_path: str) -> str:
+    """Return where the columnar snapshot of a workbook is kept (EXCEL_AGENT_SNAPSHOT_DIR or next to the workbook)."""
+    base_dir = os.getenv("EXCEL_AGENT_SNAPSHOT_DIR") or os.path.join(os.path.dirname(os.path.abspath(file_path)), ".snapshots")
+    return os.path.join(base_dir, os.path.basename(file_path))
+
+
+def _source_key(file_path: str) -> Dict[str, Any]:
+    stat = os.stat(file_path)
+    return {"path": os.path.realpath(file_path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+class _StringTable:
+    """Deduplicating string dictionary written as a UTF-8 blob plus offsets."""
+
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.chunks: List[bytes] = []
+
+    def add(self, text: str) -> int:
+        position = self.index.get(text)
+        if position is None:
+            position = len(self.chunks)
+            self.index[text] = position
+            self.chunks.append(text.encode("utf-8"))
+        return position
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (offsets, UTF-8 data); entry i is data[offsets[i]:offsets[i + 1]]."""
+        offsets = np.zeros(len(self.chunks) + 1, dtype=np.int64)
+        np.cumsum([len(chunk) for chunk in self.chunks], out=offsets[1:])
+        return offsets, np.frombuffer(b"".join(self.chunks), dtype=np.uint8)
+
+
+def _encode_value(value: Any, strings: _StringTable) -> Tuple[int, int, Optional[float]]:
+    """Return (kind, int payload, float payload) for a cell value."""
+    if value is None:
+        return EMPTY, 0, None
+    if isinstance(value, bool):
+        return BOOLEAN, int(value), None
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return INTEGER, value, None
+    if isinstance(value, (int, float)):
+        return FLOAT, 0, float(value)
+    if isinstance(value, str):
+        return (FORMULA if value.startswith("=") else STRING), strings.add(value), None
+    if isinstance(value, ArrayFormula):
+        return ARRAY_FORMULA, (strings.add(value.ref or "") << 32) | strings.add(value.text or ""), None
+    if isinstance(value, datetime):
+        return DATETIME, (value.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1), None
+    if isinstance(value, date):
+        return DATE, value.toordinal(), None
+    if isinstance(value, time):
+        return TIME, ((value.hour * 60 + value.minute) * 60 + value.second) * _MICROSECONDS + value.microsecond, None
+    if isinstance(value, timedelta):
+        return TIMEDELTA, value // timedelta(microseconds=1), None
+    logger.warning("Storing unsupported cell value of type %s as text", type(value).__name__)
+    return STRING, strings.add(str(value)), None
+
+
+def encode_sheet(snapshot: SheetSnapshot) -> Dict[str, np.ndarray]:
+    """Encode a sheet snapshot as typed columnar arrays: kinds, int64 payloads, a string dictionary and hidden masks."""
+    shape = (snapshot.max_row, snapshot.max_column)
+    kinds = np.zeros(shape, dtype=np.uint8)
+    values = np.zeros(shape, dtype=np.int64)
+    floats = values.view(np.float64)
+    strings = _StringTable()
+    for row_number, row in snapshot.iter_rows():
+        for column, value in enumerate(row):
+            if value is None:
+                continue
+            kind, payload, number = _encode_value(value, strings)
+            kinds[row_number - 1, column] = kind
+            if number is None:
+                values[row_number - 1, column] = payload
+            else:
+                floats[row_number - 1, column] = number
+
+    # Hidden ranges may extend past the used range, so the masks are sized to cover them
+    hidden_rows = np.zeros(max(snapshot.hidden_rows, default=0) + 1, dtype=bool)
+    hidden_rows[list(snapshot.hidden_rows)] = True
+    hidden_columns = np.zeros(max(snapshot.hidden_columns, default=0) + 1, dtype=bool)
+    hidden_columns[list(snapshot.hidden_columns)] = True
+
+    string_offsets, string_data = strings.arrays()
+    return {"kinds": kinds, "values": values, "string_offsets": string_offsets, "strings": string_data,
+            "hidden_rows": hidden_rows, "hidden_columns": hidden_columns}
+
+
+def write_sheet(snapshot: SheetSnapshot, directory: str) -> None:
+    """Write one sheet snapshot's columnar arrays as .npy files."""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in encode_sheet(snapshot).items():
+        np.save(os.path.join(directory, name + ".npy"), array)
+
+
+def convert_workbook(file_path: str, output_dir: Optional[str] = None, workbook: Optional[WorkbookBackend] = None) -> str:
+    """Parse a workbook once and write every sheet to the columnar snapshot format; return the snapshot directory.
+
+    workbook, if given, is an already loaded copy of the file (e.g. from the workbook cache) and
+    is written out instead of parsing the file again.
+    """
+    output_dir = output_dir or default_snapshot_dir(file_path)
+    source = _source_key(file_path)
+    logger.info("Converting %s to a columnar snapshot in %s", file_path, output_dir)
+    if workbook is None:
+        workbook = _load_openpyxl_workbook(file_path)
+
+    # Each conversion writes a new version directory and then points CURRENT_FILE at it in one
+    # os.replace, so readers always find a complete snapshot
+    version = "v-%d-%s" % (os.getpid(), uuid.uuid4().hex[:8])
+    version_dir = os.path.join(output_dir, version)
+    os.makedirs(version_dir)
+    sheets = []
+    for index, sheet_name in enumerate(workbook.sheet_names):
+        snapshot = workbook.snapshot(sheet_name)
+        directory = "sheet_%03d" % index
+        write_sheet(snapshot, os.path.join(version_dir, directory))
+        sheets.append({"name": sheet_name, "directory": directory,
+                       "max_row": snapshot.max_row, "max_column": snapshot.max_column})
+    with open(os.path.join(version_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"format_version": FORMAT_VERSION, "source": source, "sheets": sheets}, f, indent=2)
+
+    _publish(output_dir, version)
+    logger.info("Wrote columnar snapshot of %d sheets to %s", len(sheets), output_dir)
+    return output_dir
+
+
+class ColumnarSheetSnapshot(SheetSnapshot):
+    """SheetSnapshot served from columnar arrays (memory-mapped or shared); values are decoded on access."""
+
+    def __init__(self, sheet_name: str, arrays: Dict[str, np.ndarray], source: str = ""):
+        """Wrap the arrays produced by encode_sheet without copying them."""
+        self.sheet_name = sheet_name
+        self.source = source
+        self.kinds = arrays["kinds"]
+        self.values = arrays["values"]
+        self.floats = self.values.view(np.float64)
+        self.string_offsets = arrays["string_offsets"]
+        self.string_data = arrays["strings"]
+        self.max_row, self.max_column = self.kinds.shape
+        self.hidden_rows = frozenset(np.flatnonzero(arrays["hidden_rows"]).tolist())
+        self.hidden_columns = frozenset(np.flatnonzero(arrays["hidden_columns"]).tolist())
+
+    @classmethod
+    def from_directory(cls, sheet_name: str, directory: str) -> "ColumnarSheetSnapshot":
+        """Memory-map the arrays of a sheet written by write_sheet."""
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in ARRAY_NAMES}
+        return cls(sheet_name, arrays, source=directory)
+
+    @property
+    def formula_mask(self) -> np.ndarray:
+        """Boolean grid of cells holding formulas."""
+        return (self.kinds == FORMULA) | (self.kinds == ARRAY_FORMULA)
+
+    @property
+    def rows(self) -> List[Tuple[Any, ...]]:
+        """Decode the whole grid into row tuples (prefer the accessors, which decode only what they need)."""
+        return [values for _, values in self.iter_rows()]
+
+    def string(self, position: int) -> str:
+        """Return an entry of the sheet's string dictionary."""
+        start, end = self.string_offsets[position], self.string_offsets[position + 1]
+        return self.string_data[start:end].tobytes().decode("utf-8")
+
+    def _decode(self, kind: int, payload: int, number: float) -> Any:
+        if kind == EMPTY:
+            return None
+        if kind == INTEGER:
+            return payload
+        if kind == FLOAT:
+            return number
+        if kind == STRING or kind == FORMULA:
+            return self.string(payload)
+        if kind == BOOLEAN:
+            return bool(payload)
+        if kind == ARRAY_FORMULA:
+            return ArrayFormula(self.string(payload >> 32) or None, self.string(payload & 0xFFFFFFFF))
+        if kind == DATETIME:
+            return _EPOCH + timedelta(microseconds=payload)
+        if kind == DATE:
+            return date.fromordinal(payload)
+        if kind == TIME:
+            seconds, microsecond = divmod(payload, _MICROSECONDS)
+            return time(seconds // 3600, seconds // 60 % 60, seconds % 60, microsecond)
+        if kind == TIMEDELTA:
+            return timedelta(microseconds=payload)
+        raise ValueError("Unknown cell kind %d in %s" % (kind, self.source))
+
+    def _decode_block(self, kinds: np.ndarray, values: np.ndarray, floats: np.ndarray) -> List[Any]:
+        return [None if kind == EMPTY else self._decode(kind, payload, number)
+                for kind, payload, number in zip(kinds.tolist(), values.tolist(), floats.tolist())]
+
+    def value(self, row: int, column: int) -> Any:
+        """Return the value at a 1-based row/column, or None outside the used range."""
+        if 1 <= row <= self.max_row and 1 <= column <= self.max_column:
+            return self._decode(int(self.kinds[row - 1, column - 1]), int(self.values[row - 1, column - 1]),
+                                float(self.floats[row - 1, column - 1]))
+        return None
+
+    def row_values(self, row: int) -> List[Any]:
+        """Return the values of a row for columns 1..max_column."""
+        if 1 <= row <= self.max_row:
+            return self._decode_block(self.kinds[row - 1], self.values[row - 1], self.floats[row - 1])
+        return [None] * self.max_column
+
+    def column_values(self, column: int) -> List[Any]:
+        """Return the values of a column for rows 1..max_row."""
+        if 1 <= column <= self.max_column:
+            return self._decode_block(self.kinds[:, column - 1], self.values[:, column - 1], self.floats[:, column - 1])
+        return [None] * self.max_row
+
+    def range_values(self, min_row: int, min_column: int, max_row: int, max_column: int) -> List[List[Any]]:
+        """Return a rectangular block of values; cells outside the used range are None."""
+        first_column, last_column = max(min_column, 1), min(max_column, self.max_column)
+        left = [None] * (min(first_column, max_column + 1) - min_column)
+        right = [None] * (max_column - max(last_column, min_column - 1))
+        result = []
+        for row in range(min_row, max_row + 1):
+            if 1 <= row <= self.max_row and first_column <= last_column:
+                middle = self._decode_block(self.kinds[row - 1, first_column - 1:last_column],
+                                            self.values[row - 1, first_column - 1:last_column],
+                                            self.floats[row - 1, first_column - 1:last_column])
+                result.append(left + middle + right)
+            else:
+                result.append([None] * (max_column - min_column + 1))
+        return result
+
+    def iter_rows(self) -> Iterator[Tuple[int, Tuple[Any, ...]]]:
+        """Yield (row_number, values) for every row in the used range."""
+        for row in range(1, self.max_row + 1):
+            yield row, tuple(self.row_values(row))
+
+    def nonempty_cells(self) -> int:
+        """Return the number of non-empty cells in the used range."""
+        return int(np.count_nonzero(self.kinds))
+
+    def numeric_view(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (numbers, formula mask) grids computed directly from the typed arrays."""
+        view = getattr(self, "_numeric_view", None)
+        if view is None:
+            numbers = np.full(self.kinds.shape, np.nan)
+            integers = self.kinds == INTEGER
+            numbers[integers] = self.values[integers]
+            floats = self.kinds == FLOAT
+            numbers[floats] = self.floats[floats]
+            view = self._numeric_view = (numbers, self.formula_mask)
+        return view
+
+    def is_formula(self, row: int, column: int) -> bool:
+        """Return True if the cell holds a formula rather than a literal value."""
+        if 1 <= row <= self.max_row and 1 <= column <= self.max_column:
+            return int(self.kinds[row - 1, column - 1]) in (FORMULA, ARRAY_FORMULA)
+        return False
+
+
+class ColumnarWorkbook:
+    """A workbook's columnar snapshot directory; sheets are memory-mapped on first access."""
+
+    def __init__(self, directory: str, manifest: Dict[str, Any]):
+        self.directory = directory
+        self.sheet_names = [sheet["name"] for sheet in manifest["sheets"]]
+        self._sheet_dirs = {sheet["name"]: sheet["directory"] for sheet in manifest["sheets"]}
+        self.snapshots: Dict[str, ColumnarSheetSnapshot] = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self, sheet_name: str) -> ColumnarSheetSnapshot:
+        with self.lock:
+            snapshot = self.snapshots.get(sheet_name)
+            if snapshot is None:
+                if sheet_name not in self._sheet_dirs:
+                    raise KeyError("Worksheet {0} does not exist.".format(sheet_name))
+                snapshot = ColumnarSheetSnapshot.from_directory(sheet_name, os.path.join(self.directory, self._sheet_dirs[sheet_name]))
+                self.snapshots[sheet_name] = snapshot
+            return snapshot
+
+
+def _read_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _versions(snapshot_dir: str) -> List[str]:
+    """Return the names of the current and the previous version directory of a snapshot, if any."""
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().split()
+    except OSError:
+        return []
+
+
+def _current_dir(snapshot_dir: str) -> str:
+    """Return the directory holding the current version of a snapshot (snapshots written before versioning are flat)."""
+    versions = _versions(snapshot_dir)
+    return os.path.join(snapshot_dir, versions[0]) if versions else snapshot_dir
+
+
+def _publish(snapshot_dir: str, version: str) -> None:
+    """Point a snapshot at a fully written version and remove the version that was two back.
+
+    The version it replaces is kept for readers that resolved it just before the swap; older
+    ones are only ever opened by readers that already memory-mapped their files.
+    """
+    previous = _versions(snapshot_dir)
+    pointer = os.path.join(snapshot_dir, "%s.%s" % (CURRENT_FILE, version))
+    with open(pointer, "w", encoding="utf-8") as f:
+        f.write("\n".join([version] + previous[:1]) + "\n")
+    os.replace(pointer, os.path.join(snapshot_dir, CURRENT_FILE))
+
+    if previous:
+        retired = previous[1:]
+    else:
+        # A flat snapshot from before versioning: its manifest and sheet directories are retired
+        retired = [name for name in os.listdir(snapshot_dir) if name == MANIFEST_FILE or name.startswith("sheet_")]
+    for name in retired:
+        path = os.path.join(snapshot_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+
+def columnar_snapshot_exists(snapshot_dir: str) -> bool:
+    """Return True if snapshot_dir holds a readable columnar snapshot."""
+    manifest = _read_manifest(_current_dir(snapshot_dir))
+    return manifest is not None and manifest.get("format_version") == FORMAT_VERSION
+
+
+def open_columnar_workbook(file_path: str, snapshot_dir: Optional[str] = None,
+                           workbook: Optional[WorkbookBackend] = None) -> ColumnarWorkbook:
+    """Open the columnar snapshot of a workbook, converting it first (from workbook, if given) if it is missing or stale."""
+    snapshot_dir = snapshot_dir or default_snapshot_dir(file_path)
+    version_dir = _current_dir(snapshot_dir)
+    manifest = _read_manifest(version_dir)
+    if (manifest is None or manifest.get("format_version") != FORMAT_VERSION
+            or manifest.get("source") != _source_key(file_path)):
+        convert_workbook(file_path, snapshot_dir, workbook=workbook)
+        version_dir = _current_dir(snapshot_dir)
+        manifest = _read_manifest(version_dir)
+        if manifest is None:
+            raise OSError("Columnar snapshot of %s could not be written to %s" % (file_path, snapshot_dir))
+    return ColumnarWorkbook(version_dir, manifest)
+
+
+def load_columnar_workbook(snapshot_dir: str) -> ColumnarWorkbook:
+    """Open a columnar snapshot as it is, without checking it against its source workbook (e.g. a previous version)."""
+    version_dir = _current_dir(snapshot_dir)
+    manifest = _read_manifest(version_dir)
+    if manifest is None or manifest.get("format_version") != FORMAT_VERSION:
+        raise FileNotFoundError("No columnar snapshot in %s" % snapshot_dir)
+    return ColumnarWorkbook(version_dir, manifest)
+
+
+register_snapshot_backend("columnar", open_columnar_workbook)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert workbooks to the columnar snapshot format used by the tools.")
+    parser.add_argument("files", nargs="+", help="Excel files to convert")
+    parser.add_argument("--output-dir", help="Snapshot directory (only valid with a single file)")
+    args = parser.parse_args()
+    if args.output_dir and len(args.files) > 1:
+        parser.error("--output-dir can only be used with a single file")
+    for file_path in args.files:
+        convert_workbook(file_path, args.output_dir)
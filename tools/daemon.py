@@ -0,0 +1,224 @@
+import argparse
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+import orjson
+from core.logger import setup_logger
+from core.telemetry import TELEMETRY
+from tools.columnar import ColumnarWorkbook, load_columnar_workbook, open_columnar_workbook
+from tools.registry import TOOL_REGISTRY, ToolCallError
+from tools.snapshot import WORKBOOK_CACHE, get_sheet_snapshot, get_workbook_sheet_names
+
+logger = setup_logger(__name__)
+
+# A per-user location, so other local users can neither connect to the daemon nor stand in for it
+DEFAULT_SOCKET_PATH = os.path.join(os.getenv("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), "excel_agent_%d" % os.getuid()),
+                                   "excel_agent_tools.sock")
+
+
+def _owned_socket(path: str) -> bool:
+    """Return True if path is a unix socket owned by the current user."""
+    try:
+        status = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(status.st_mode) and status.st_uid == os.getuid()
+
+
+def _private_directory(path: str) -> None:
+    """Create the socket's directory (0700) and refuse one that another user owns or may write to."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.stat(path)
+    if status.st_uid != os.getuid() or status.st_mode & 0o022:
+        raise PermissionError("Socket directory %s must be owned by the current user and not writable by others" % path)
+
+
+class _ToolRequestHandler(socketserver.StreamRequestHandler):
+    """Serve newline-delimited JSON requests on one client connection until it closes."""
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(orjson.loads(line))
+            except Exception as e:
+                response = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+            self.wfile.write(orjson.dumps(response, default=str) + b"\n")
+            self.wfile.flush()
+            if response.get("shutdown"):
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class ToolDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Long-lived server that keeps workbooks parsed in its WORKBOOK_CACHE and runs tools for agents.
+
+    Requests are JSON lines: {"op": "call", "tool": name, "args": {...}} returns the tool result
+    rendered exactly as BaseAgent would send it to the LLM; {"op": "columnar", "file_path": path}
+    writes the parsed workbook as a columnar snapshot that clients memory-map instead of parsing
+    the file themselves; "ping", "warm" and "shutdown" manage the daemon itself.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH):
+        _private_directory(os.path.dirname(os.path.abspath(socket_path)))
+        if os.path.exists(socket_path):
+            try:
+                ToolClient(socket_path=socket_path).request("ping")
+            except OSError:
+                # A stale socket left by a daemon that did not shut down cleanly
+                os.unlink(socket_path)
+            else:
+                raise OSError("A tool daemon is already listening on %s" % socket_path)
+        # Workbooks may hold client data, so only the owner may connect; the umask covers bind() itself
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _ToolRequestHandler)
+        finally:
+            os.umask(umask)
+        self.socket_path = socket_path
+        self.started_at = time.time()
+        self.calls = 0
+        self._export_lock = threading.Lock()
+
+    def dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Handle one decoded request and return the response object."""
+        op = request.get("op")
+        if op == "call":
+            self.calls += 1
+            result = TOOL_REGISTRY.call(request["tool"], request.get("args") or {})
+            return {"ok": True, "result": str(result)}
+        if op == "columnar":
+            file_path = request["file_path"]
+            with self._export_lock:
+                workbook = open_columnar_workbook(file_path, workbook=WORKBOOK_CACHE.get(file_path))
+            return {"ok": True, "snapshot_dir": workbook.directory}
+        if op == "ping":
+            return {"ok": True, "pid": os.getpid(), "uptime_s": round(time.time() - self.started_at, 1),
+                    "calls": self.calls, "workbooks": len(WORKBOOK_CACHE)}
+        if op == "warm":
+            sheet_names = get_workbook_sheet_names(request["file_path"])
+            for sheet_name in sheet_names:
+                get_sheet_snapshot(request["file_path"], sheet_name)
+            return {"ok": True, "sheets": len(sheet_names)}
+        if op == "shutdown":
+            return {"ok": True, "shutdown": True}
+        raise ValueError("Unknown op: %s" % op)
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class ToolClient:
+    """Thin client for ToolDaemon; callers fall back to in-process tools when it is unavailable."""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, enabled: bool = True, retry_interval: float = 30.0):
+        self.socket_path = socket_path
+        self.enabled = enabled
+        self.retry_interval = retry_interval
+        self._local = threading.local()
+        self._unavailable_until = 0.0
+
+    def available(self) -> bool:
+        """Return True if the daemon socket exists, belongs to the current user and has not failed recently."""
+        return self.enabled and time.monotonic() >= self._unavailable_until and _owned_socket(self.socket_path)
+
+    def _connection(self) -> Any:
+        connection = getattr(self._local, "connection", None)
+        # A forked pool worker must not reuse the connection it inherited from its parent
+        if connection is None or connection[2] != os.getpid():
+            if not _owned_socket(self.socket_path):
+                raise PermissionError("%s is not a socket owned by the current user" % self.socket_path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            connection = (sock, sock.makefile("rb"), os.getpid())
+            self._local.connection = connection
+        return connection
+
+    def _close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def request(self, op: str, **fields: Any) -> Dict[str, Any]:
+        """Send one request over this thread's connection and return the decoded response."""
+        try:
+            sock, reader, _ = self._connection()
+            sock.sendall(orjson.dumps(dict(fields, op=op), default=str) + b"\n")
+            line = reader.readline()
+            if not line:
+                raise ConnectionError("Tool daemon closed the connection")
+        except OSError:
+            self._close()
+            self._unavailable_until = time.monotonic() + self.retry_interval
+            raise
+        return orjson.loads(line)
+
+    def call(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[str]:
+        """Run a tool in the daemon and return its rendered result, or None if the daemon cannot be reached."""
+        if "file_path" in arguments:
+            # The daemon may run from another working directory
+            arguments = dict(arguments, file_path=os.path.abspath(arguments["file_path"]))
+        try:
+            response = self.request("call", tool=tool_name, args=arguments)
+        except OSError as e:
+            logger.warning("Tool daemon at %s unavailable, running tools in-process: %s", self.socket_path, e)
+            return None
+        if not response.get("ok"):
+            raise ToolCallError("Tool %s failed in the tool daemon: %s" % (tool_name, response.get("error")))
+        TELEMETRY.annotate(tool_daemon=True)
+        return response["result"]
+
+    def open_workbook(self, file_path: str) -> Optional[ColumnarWorkbook]:
+        """Return the daemon's parsed copy of a workbook as a memory-mapped columnar snapshot, or None if it cannot serve it."""
+        if not self.available():
+            return None
+        try:
+            response = self.request("columnar", file_path=os.path.abspath(file_path))
+            if not response.get("ok"):
+                logger.warning("Tool daemon could not serve %s, parsing it in-process: %s", file_path, response.get("error"))
+                return None
+            return load_columnar_workbook(response["snapshot_dir"])
+        except OSError as e:
+            logger.warning("Tool daemon at %s unavailable, parsing %s in-process: %s", self.socket_path, file_path, e)
+            return None
+
+
+TOOL_CLIENT = ToolClient(socket_path=os.getenv("EXCEL_AGENT_TOOL_SOCKET", DEFAULT_SOCKET_PATH),
+                         enabled=os.getenv("EXCEL_AGENT_TOOL_DAEMON", "1") == "1")
+WORKBOOK_CACHE.remote = TOOL_CLIENT.open_workbook
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the local tool daemon that keeps workbooks parsed between runs.")
+    parser.add_argument("--socket", default=TOOL_CLIENT.socket_path, help="Unix socket path")
+    parser.add_argument("--warm", nargs="*", default=[], help="Workbooks to parse before serving")
+    parser.add_argument("--stop", action="store_true", help="Stop a running daemon")
+    parser.add_argument("--status", action="store_true", help="Print the status of a running daemon")
+    args = parser.parse_args()
+
+    if args.stop or args.status:
+        client = ToolClient(socket_path=args.socket)
+        print(orjson.dumps(client.request("shutdown" if args.stop else "ping")).decode())
+    else:
+        # The daemon parses workbooks itself rather than asking itself for them
+        WORKBOOK_CACHE.remote = None
+        server = ToolDaemon(args.socket)
+        for file_path in args.warm:
+            logger.info("Warmed %s (%d sheets)", file_path, server.dispatch({"op": "warm", "file_path": file_path})["sheets"])
+        logger.info("Tool daemon listening on %s", args.socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
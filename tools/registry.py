@@ -0,0 +1,119 @@
+from typing import Any, Dict, Iterable, List, Tuple, Type
+import orjson
+from pydantic import BaseModel, ValidationError
+from core.logger import setup_logger
+from tools.tools import (
+    get_row_values, get_column_values, get_cell_value,
+    get_data_types_column, get_sheet_dimensions,
+    find_cells_with_value, get_range_values, get_sheet_content,
+    get_max_rows, get_max_columns, get_sheet_content_sample,
+    get_row_values_sample, get_column_values_sample, get_data_types_column_sample,
+    get_nonempty_column_letters, search_workbook, query_sheet, get_cell_contexts
+)
+
+logger = setup_logger(__name__)
+
+SUBMIT_RESULT_TOOL = "submit_result"
+
+
+class ToolCallError(Exception):
+    """Raised when a tool call from the LLM cannot be parsed, validated or dispatched."""
+
+
+class ToolRegistry:
+    """Process-wide registry that compiles OpenAI tool schemas once and dispatches tool calls by name."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._tools: Dict[str, Any] = {}
+        self._schemas: Dict[str, Dict[str, Any]] = {}
+        self._schema_sets: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        self._result_schemas: Dict[Type[BaseModel], Dict[str, Any]] = {}
+
+    def register(self, *tools: Any) -> None:
+        """Register langchain tools and precompile their OpenAI function schemas."""
+        for tool in tools:
+            self._tools[tool.name] = tool
+            self._schemas[tool.name] = {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": tool.args_schema.model_json_schema() if getattr(tool, 'args_schema', None) else {}
+                }
+            }
+        self._schema_sets.clear()
+        logger.info("Registered %d tools (%d total)", len(tools), len(self._tools))
+
+    def __contains__(self, tool_name: str) -> bool:
+        return tool_name in self._tools
+
+    def get(self, tool_name: str) -> Any:
+        """Return the registered tool with the given name."""
+        try:
+            return self._tools[tool_name]
+        except KeyError:
+            raise ToolCallError("Unknown tool: %s" % tool_name) from None
+
+    def schemas(self, tools: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Return the OpenAI tool schemas for the given tools, cached per tool set."""
+        key = tuple(tool if isinstance(tool, str) else tool.name for tool in tools)
+        schema_set = self._schema_sets.get(key)
+        if schema_set is None:
+            schema_set = [self._schemas[name] for name in key]
+            self._schema_sets[key] = schema_set
+        return schema_set
+
+    def result_schema(self, result_model: Type[BaseModel]) -> Dict[str, Any]:
+        """Return the cached schema of the submit_result tool whose arguments are the agent's final output model."""
+        schema = self._result_schemas.get(result_model)
+        if schema is None:
+            schema = {
+                "type": "function",
+                "function": {
+                    "name": SUBMIT_RESULT_TOOL,
+                    "description": "Submit the final %s result. Calling this tool ends the task, so only call it once the result is complete." % result_model.__name__,
+                    "parameters": result_model.model_json_schema()
+                }
+            }
+            self._result_schemas[result_model] = schema
+        return schema
+
+    def parse_arguments(self, tool_name: str, raw_arguments: str, **overrides: Any) -> Dict[str, Any]:
+        """Parse JSON tool arguments, apply overrides and validate them against the tool's args schema."""
+        tool = self.get(tool_name)
+        try:
+            arguments = orjson.loads(raw_arguments or "{}")
+        except orjson.JSONDecodeError as e:
+            raise ToolCallError("Invalid JSON arguments for tool %s: %s" % (tool_name, e)) from None
+        if not isinstance(arguments, dict):
+            raise ToolCallError("Arguments for tool %s must be a JSON object" % tool_name)
+        arguments.update(overrides)
+
+        args_schema = getattr(tool, 'args_schema', None)
+        if args_schema is None:
+            return arguments
+        try:
+            validated = args_schema.model_validate(arguments)
+        except ValidationError as e:
+            raise ToolCallError("Invalid arguments for tool %s: %s" % (tool_name, e)) from None
+        return {name: getattr(validated, name) for name in type(validated).model_fields}
+
+    def call(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
+        """Call the tool function directly with already validated arguments."""
+        tool = self.get(tool_name)
+        func = getattr(tool, 'func', None)
+        if func is None:
+            return tool.invoke(arguments)
+        return func(**arguments)
+
+
+TOOL_REGISTRY = ToolRegistry()
+TOOL_REGISTRY.register(
+    get_row_values, get_column_values, get_cell_value,
+    get_data_types_column, get_sheet_dimensions,
+    find_cells_with_value, get_range_values, get_sheet_content,
+    get_max_rows, get_max_columns, get_sheet_content_sample,
+    get_row_values_sample, get_column_values_sample, get_data_types_column_sample,
+    get_nonempty_column_letters, search_workbook, query_sheet, get_cell_contexts
+)
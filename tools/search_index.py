@@ -0,0 +1,109 @@
+import re
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Set, Tuple
+from openpyxl.utils import get_column_letter
+from core.logger import setup_logger
+from tools.snapshot import WORKBOOK_CACHE
+
+logger = setup_logger(__name__)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_index_lock = threading.Lock()
+
+
+def _value_key(value: Any) -> Any:
+    """Key under which a cell value is indexed: trimmed lowercase text, numbers as floats (so 5 == 5.0)."""
+    if isinstance(value, str):
+        return " ".join(value.lower().split())
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _query_key(query: Any) -> Any:
+    """Index key for a search query; numeric text such as '1,250' or '(300)' also matches numbers."""
+    if isinstance(query, str):
+        text = query.strip().replace(",", "")
+        if text.startswith("(") and text.endswith(")"):
+            text = "-" + text[1:-1]
+        try:
+            return float(text)
+        except ValueError:
+            return _value_key(query)
+    return _value_key(query)
+
+
+class WorkbookSearchIndex:
+    """Exact-value and token indexes over every sheet of a workbook.
+
+    Cells are stored once as (sheet, row, column, value); the value index maps a normalized value
+    to its cells and the token index maps each word of a text cell to the cells containing it.
+    """
+
+    def __init__(self, entry: Any):
+        """Build the indexes from a workbook cache entry (anything with sheet_names and snapshot())."""
+        self.cells: List[Tuple[str, int, int, Any]] = []
+        self.values: Dict[Any, List[int]] = defaultdict(list)
+        self.tokens: Dict[str, Set[int]] = defaultdict(set)
+        for sheet_name in entry.sheet_names:
+            for row_number, row in entry.snapshot(sheet_name).iter_rows():
+                for column, value in enumerate(row, start=1):
+                    if value is None or type(value).__name__ == "ArrayFormula":
+                        continue
+                    if isinstance(value, str) and (not value.strip() or value.startswith("=")):
+                        continue
+                    position = len(self.cells)
+                    self.cells.append((sheet_name, row_number, column, value))
+                    self.values[_value_key(value)].append(position)
+                    if isinstance(value, str):
+                        for token in _TOKEN.findall(value.lower()):
+                            self.tokens[token].add(position)
+        logger.info("Indexed %d cells (%d distinct values, %d tokens) across %d sheets",
+                    len(self.cells), len(self.values), len(self.tokens), len(entry.sheet_names))
+
+    def _result(self, position: int, match: str) -> Dict[str, Any]:
+        sheet_name, row, column, value = self.cells[position]
+        return {"sheet_name": sheet_name, "cell_reference": "%s%d" % (get_column_letter(column), row),
+                "value": value, "match": match}
+
+    def search(self, query: Any, max_results: int = 50) -> List[Dict[str, Any]]:
+        """Return cells equal to the query first, then text cells containing it as a substring, in sheet order."""
+        exact = self.values.get(_query_key(query), [])
+        results = [self._result(position, "exact") for position in exact[:max_results]]
+        if not isinstance(query, str) or len(results) >= max_results:
+            return results
+
+        needle = " ".join(query.lower().split())
+        query_tokens = _TOKEN.findall(needle)
+        if not query_tokens:
+            return results
+        # Candidate cells must contain every query token as part of one of their tokens
+        candidates = None
+        for query_token in query_tokens:
+            postings = set()
+            for token, positions in self.tokens.items():
+                if query_token in token:
+                    postings |= positions
+            candidates = postings if candidates is None else candidates & postings
+            if not candidates:
+                return results
+        seen = set(exact)
+        for position in sorted(candidates - seen):
+            if needle in _value_key(self.cells[position][3]):
+                results.append(self._result(position, "substring"))
+                if len(results) >= max_results:
+                    break
+        return results
+
+
+def get_workbook_index(file_path: str) -> WorkbookSearchIndex:
+    """Return the search index of a workbook, built once and kept with its workbook cache entry."""
+    entry = WORKBOOK_CACHE.get(file_path)
+    index = getattr(entry, "search_index", None)
+    if index is None:
+        with _index_lock:
+            index = getattr(entry, "search_index", None)
+            if index is None:
+                index = entry.search_index = WorkbookSearchIndex(entry)
+    return index
@@ -0,0 +1,135 @@
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+import numpy as np
+from core.logger import setup_logger
+from tools.columnar import ARRAY_NAMES, ColumnarSheetSnapshot, encode_sheet
+from tools.snapshot import WORKBOOK_CACHE, snapshot_backend
+
+logger = setup_logger(__name__)
+
+_ALIGNMENT = 64
+
+# Workbooks attached in this process; holding them keeps the shared memory mapped
+_ATTACHED: List["SharedWorkbook"] = []
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class SharedWorkbook:
+    """A workbook's columnar sheet arrays packed into one shared memory block.
+
+    The parent creates it once; pool workers attach with the picklable descriptor and read the
+    arrays in place, so every process serves the same physical pages through the usual tools.
+    """
+
+    def __init__(self, shm: SharedMemory, descriptor: Dict[str, Any], owner: bool):
+        self.shm = shm
+        self.descriptor = descriptor
+        self.owner = owner
+        self.file_path = descriptor["file_path"]
+        self.sheet_names = [sheet["name"] for sheet in descriptor["sheets"]]
+        self._layouts = {sheet["name"]: sheet["arrays"] for sheet in descriptor["sheets"]}
+        self.snapshots: Dict[str, ColumnarSheetSnapshot] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, file_path: str) -> "SharedWorkbook":
+        """Load every sheet of a workbook and copy its columnar arrays into a new shared memory block."""
+        # Load outside the workbook cache so forked workers do not inherit a parsed copy
+        source = snapshot_backend(WORKBOOK_CACHE.backend)(file_path)
+        encoded = [(sheet_name, encode_sheet(source.snapshot(sheet_name))) for sheet_name in source.sheet_names]
+        del source
+
+        size = 0
+        sheets = []
+        for sheet_name, arrays in encoded:
+            layout = {}
+            for name in ARRAY_NAMES:
+                array = arrays[name]
+                size = _aligned(size)
+                layout[name] = (size, array.dtype.str, array.shape)
+                size += array.nbytes
+            sheets.append({"name": sheet_name, "arrays": layout})
+
+        shm = SharedMemory(create=True, size=max(size, 1))
+        for (_, arrays), sheet in zip(encoded, sheets):
+            for name, (offset, dtype, shape) in sheet["arrays"].items():
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = arrays[name]
+        descriptor = {"shm_name": shm.name, "file_path": file_path, "sheets": sheets}
+        logger.info("Shared %d sheets of %s in %s (%d bytes)", len(sheets), file_path, shm.name, size)
+        return cls(shm, descriptor, owner=True)
+
+    @classmethod
+    def attach(cls, descriptor: Dict[str, Any]) -> "SharedWorkbook":
+        """Attach to a block created by another process without copying it."""
+        # Pool workers share the parent's resource tracker, so the registration made here is
+        # the parent's own and is cleared when the owner unlinks the block
+        shm = SharedMemory(name=descriptor["shm_name"])
+        return cls(shm, descriptor, owner=False)
+
+    def snapshot(self, sheet_name: str) -> ColumnarSheetSnapshot:
+        """Return a snapshot whose arrays are views into the shared memory block."""
+        with self.lock:
+            snapshot = self.snapshots.get(sheet_name)
+            if snapshot is None:
+                layout = self._layouts.get(sheet_name)
+                if layout is None:
+                    raise KeyError("Worksheet {0} does not exist.".format(sheet_name))
+                arrays = {}
+                for name, (offset, dtype, shape) in layout.items():
+                    array = np.ndarray(tuple(shape), dtype=dtype, buffer=self.shm.buf, offset=offset)
+                    array.flags.writeable = False
+                    arrays[name] = array
+                snapshot = ColumnarSheetSnapshot(sheet_name, arrays, source=self.shm.name)
+                self.snapshots[sheet_name] = snapshot
+            return snapshot
+
+    def close(self) -> None:
+        """Drop the array views and unmap the block; the owner also frees it."""
+        with self.lock:
+            self.snapshots.clear()
+        try:
+            self.shm.close()
+        except BufferError:
+            logger.warning("Shared workbook %s still has live views and stays mapped until they are released", self.shm.name)
+        if self.owner:
+            self.shm.unlink()
+
+
+def attach_shared_workbooks(descriptors: Sequence[Dict[str, Any]]) -> None:
+    """Attach shared workbooks and serve them through the workbook cache; used as a pool initializer."""
+    for descriptor in descriptors:
+        workbook = SharedWorkbook.attach(descriptor)
+        _ATTACHED.append(workbook)
+        WORKBOOK_CACHE.put(workbook.file_path, workbook)
+    logger.info("Attached %d shared workbooks", len(descriptors))
+
+
+def _init_worker(descriptors: Sequence[Dict[str, Any]], initializer: Optional[Callable[[], None]]) -> None:
+    attach_shared_workbooks(descriptors)
+    if initializer is not None:
+        initializer()
+
+
+@contextmanager
+def shared_workbook_pool(file_paths: Sequence[str], processes: Optional[int] = None,
+                         initializer: Optional[Callable[[], None]] = None) -> Iterator[Any]:
+    """Yield a process pool whose workers read the given workbooks from shared memory.
+
+    The workbooks are parsed once in this process; each worker attaches in its initializer, so
+    tools called in the workers never parse the files or copy the cell grids. initializer, if
+    given, runs in each worker after the workbooks are attached.
+    """
+    workbooks = [SharedWorkbook.create(file_path) for file_path in file_paths]
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_worker,
+                                  initargs=([workbook.descriptor for workbook in workbooks], initializer)) as pool:
+            yield pool
+    finally:
+        for workbook in workbooks:
+            workbook.close()
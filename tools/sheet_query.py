@@ -0,0 +1,165 @@
+import re
+from typing import Any, List, Optional, Tuple
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.worksheet.formula import ArrayFormula
+from pydantic import BaseModel, Field, field_validator, model_validator
+from core.logger import setup_logger
+from tools.snapshot import SheetSnapshot
+
+logger = setup_logger(__name__)
+
+_COLUMN = re.compile(r"^[A-Z]{1,3}$")
+
+# Longer cell text (mostly cross-sheet formulas) is cut to keep the table compact
+_MAX_CELL_CHARS = 60
+
+
+def parse_columns(spec: str) -> List[int]:
+    """Parse a column list such as 'F:P', 'B,F:P' or 'B, D, F:H' into 1-based column indexes, in order and without repeats."""
+    columns: List[int] = []
+    for part in spec.replace(" ", "").upper().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition(":")
+        if not _COLUMN.match(first) or (last and not _COLUMN.match(last)):
+            raise ValueError("Invalid column list '%s': use letters such as 'F:P' or 'B,F:P'" % spec)
+        start, end = column_index_from_string(first), column_index_from_string(last or first)
+        step = 1 if end >= start else -1
+        columns.extend(column for column in range(start, end + step, step) if column not in columns)
+    if not columns:
+        raise ValueError("Empty column list")
+    return columns
+
+
+def parse_rows(spec: str) -> Tuple[int, Optional[int]]:
+    """Parse a row range such as '7:120', '7:' or '12' into (first, last); last is None for open ranges."""
+    first, separator, last = spec.replace(" ", "").partition(":")
+    try:
+        start = int(first) if first else 1
+        end = int(last) if last else (None if separator else start)
+    except ValueError:
+        raise ValueError("Invalid row range '%s': use 'first:last', e.g. '7:120'" % spec) from None
+    if start < 1 or (end is not None and end < start):
+        raise ValueError("Invalid row range '%s'" % spec)
+    return start, end
+
+
+class SheetQuery(BaseModel):
+    """Arguments of the query_sheet tool: which rows to keep and which columns to return."""
+    file_path: str = Field(..., description="Path of the Excel workbook")
+    sheet_name: str = Field(..., description="Sheet to query")
+    columns: str = Field(..., description="Columns to return, e.g. 'F:P' or 'D,F:P'")
+    where_column: Optional[str] = Field(None, description="Column tested by matches/excludes (usually the label column, e.g. 'B'); it is always returned first")
+    matches: Optional[str] = Field(None, description="Case-insensitive regex the where_column text must match, e.g. 'revenue|sales'")
+    excludes: Optional[str] = Field(None, description="Case-insensitive regex that drops rows whose where_column text matches, e.g. 'total'")
+    numeric_only: bool = Field(False, description="Only keep rows with at least one number in the returned columns")
+    rows: Optional[str] = Field(None, description="Row range to search, e.g. '7:120' (default: the whole sheet)")
+    header_row: Optional[int] = Field(None, description="Row whose values label the returned columns (e.g. the period header row)")
+    max_rows: int = Field(100, ge=1, description="Maximum number of rows to return")
+
+    @field_validator("columns")
+    @classmethod
+    def _check_columns(cls, value: str) -> str:
+        parse_columns(value)
+        return value
+
+    @field_validator("where_column")
+    @classmethod
+    def _check_where_column(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None and len(parse_columns(value)) != 1:
+            raise ValueError("where_column must be a single column letter")
+        return value
+
+    @field_validator("matches", "excludes")
+    @classmethod
+    def _check_pattern(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError("Invalid regex '%s': %s" % (value, e)) from None
+        return value
+
+    @field_validator("rows")
+    @classmethod
+    def _check_rows(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            parse_rows(value)
+        return value
+
+    @model_validator(mode="after")
+    def _check_filter_column(self) -> "SheetQuery":
+        if (self.matches or self.excludes) and not self.where_column:
+            raise ValueError("matches/excludes need where_column: the column whose text is tested (e.g. 'B')")
+        return self
+
+
+def _full_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return format(value, ".12g")
+    if isinstance(value, ArrayFormula):
+        value = value.text
+    return " ".join(str(value).split())
+
+
+def _cell_text(value: Any) -> str:
+    text = _full_text(value).replace("|", "/")
+    return text if len(text) <= _MAX_CELL_CHARS else text[:_MAX_CELL_CHARS - 3] + "..."
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def run_query(sheet: SheetSnapshot, columns: str, where_column: Optional[str] = None, matches: Optional[str] = None,
+              excludes: Optional[str] = None, numeric_only: bool = False, rows: Optional[str] = None,
+              header_row: Optional[int] = None, max_rows: int = 100) -> str:
+    """Select rows of a sheet snapshot and render the chosen columns as a compact pipe-separated table.
+
+    The first line describes the query and how many rows matched, the second names the columns
+    (with the header row's values, if given) and every further line is one row, starting with
+    its row number. Rows whose returned cells are all empty are skipped.
+    """
+    selected = parse_columns(columns)
+    label = parse_columns(where_column)[0] if where_column else None
+    output_columns = ([label] if label is not None else []) + [column for column in selected if column != label]
+    first_row, last_row = parse_rows(rows) if rows else (1, None)
+    last_row = min(last_row or sheet.max_row, sheet.max_row)
+    include = re.compile(matches, re.IGNORECASE) if matches else None
+    exclude = re.compile(excludes, re.IGNORECASE) if excludes else None
+
+    matched = []
+    for row_number in range(first_row, last_row + 1):
+        cells = [sheet.value(row_number, column) for column in output_columns]
+        if label is not None:
+            # Patterns are tested against the whole label, not the shortened text shown in the table
+            text = _full_text(cells[0])
+            if include is not None and not include.search(text):
+                continue
+            if exclude is not None and exclude.search(text):
+                continue
+        # With only the label column returned, the label itself is the data
+        data = cells[1:] if label is not None and len(cells) > 1 else cells
+        if all(value is None for value in data):
+            continue
+        if numeric_only and not any(_is_number(value) for value in data):
+            continue
+        matched.append([str(row_number)] + [_cell_text(value) for value in cells])
+
+    condition = ""
+    if label is not None and (include or exclude):
+        condition = " where %s" % " and ".join(
+            part for part in ("%s ~ /%s/" % (get_column_letter(label), matches) if matches else "",
+                              "%s !~ /%s/" % (get_column_letter(label), excludes) if excludes else "") if part)
+    lines = ["%s!%s rows %d:%d%s: %d rows%s" % (sheet.sheet_name, columns.upper().replace(" ", ""), first_row, last_row, condition,
+                                               len(matched), " (first %d shown)" % max_rows if len(matched) > max_rows else "")]
+    header = ["row"] + [get_column_letter(column) for column in output_columns]
+    if header_row:
+        header = ["row"] + [("%s %s" % (get_column_letter(column), _cell_text(sheet.value(header_row, column)))).strip()
+                            for column in output_columns]
+    lines.append(" | ".join(header))
+    lines.extend(" | ".join(row) for row in matched[:max_rows])
+    logger.info("Query on sheet '%s' matched %d rows", sheet.sheet_name, len(matched))
+    return "\n".join(lines)
@@ -0,0 +1,228 @@
+import importlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Protocol, Tuple
+import numpy as np
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
+from core.logger import setup_logger
+from core.profiling import PROFILER
+from core.telemetry import TELEMETRY
+
+logger = setup_logger(__name__)
+
+
+class SheetSnapshot:
+    """Immutable in-memory grid of a sheet's raw cell values (formulas are kept as their '=...' text)."""
+
+    def __init__(self, sheet_name: str, max_row: int, max_column: int, rows: List[Tuple[Any, ...]],
+                 hidden_rows: FrozenSet[int] = frozenset(), hidden_columns: FrozenSet[int] = frozenset()):
+        """Initialize from row tuples covering rows 1..max_row and columns 1..max_column."""
+        self.sheet_name = sheet_name
+        self.max_row = max_row
+        self.max_column = max_column
+        self.rows = rows
+        self.hidden_rows = hidden_rows
+        self.hidden_columns = hidden_columns
+
+    def value(self, row: int, column: int) -> Any:
+        """Return the value at a 1-based row/column, or None outside the used range."""
+        if 1 <= row <= self.max_row and 1 <= column <= self.max_column:
+            return self.rows[row - 1][column - 1]
+        return None
+
+    def row_values(self, row: int) -> List[Any]:
+        """Return the values of a row for columns 1..max_column."""
+        if 1 <= row <= self.max_row:
+            return list(self.rows[row - 1])
+        return [None] * self.max_column
+
+    def column_values(self, column: int) -> List[Any]:
+        """Return the values of a column for rows 1..max_row."""
+        if 1 <= column <= self.max_column:
+            return [row[column - 1] for row in self.rows]
+        return [None] * self.max_row
+
+    def range_values(self, min_row: int, min_column: int, max_row: int, max_column: int) -> List[List[Any]]:
+        """Return a rectangular block of values; cells outside the used range are None."""
+        return [[self.value(row, column) for column in range(min_column, max_column + 1)]
+                for row in range(min_row, max_row + 1)]
+
+    def iter_rows(self) -> Iterator[Tuple[int, Tuple[Any, ...]]]:
+        """Yield (row_number, values) for every row in the used range."""
+        return enumerate(self.rows, start=1)
+
+    def nonempty_cells(self) -> int:
+        """Return the number of non-empty cells in the used range."""
+        return sum(1 for row in self.rows for value in row if value is not None)
+
+    def is_formula(self, row: int, column: int) -> bool:
+        """Return True if the cell holds a formula rather than a literal value."""
+        value = self.value(row, column)
+        return (isinstance(value, str) and value.startswith("=")) or type(value).__name__ == "ArrayFormula"
+
+    def numeric_view(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (numbers, formula mask) grids; non-numeric cells are NaN in numbers. Built once per snapshot."""
+        view = getattr(self, "_numeric_view", None)
+        if view is None:
+            numbers = np.full((self.max_row, self.max_column), np.nan)
+            formulas = np.zeros((self.max_row, self.max_column), dtype=bool)
+            for row_number, row in self.iter_rows():
+                for column, value in enumerate(row):
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        numbers[row_number - 1, column] = value
+                    elif value is not None and self.is_formula(row_number, column + 1):
+                        formulas[row_number - 1, column] = True
+            view = self._numeric_view = (numbers, formulas)
+        return view
+
+
+def parse_cell_reference(cell_reference: str) -> Tuple[int, int]:
+    """Split a cell reference such as 'AE11' into 1-based (row, column)."""
+    reference = cell_reference.replace("$", "").upper()
+    split = len(reference.rstrip("0123456789"))
+    if split == 0 or split == len(reference):
+        raise ValueError("Invalid cell reference: %s" % cell_reference)
+    return int(reference[split:]), column_index_from_string(reference[:split])
+
+
+def _snapshot_from_worksheet(worksheet: Any) -> SheetSnapshot:
+    """Copy a loaded openpyxl worksheet into a SheetSnapshot."""
+    max_row, max_column = worksheet.max_row, worksheet.max_column
+    rows = list(worksheet.iter_rows(min_row=1, max_row=max_row, min_col=1, max_col=max_column, values_only=True))
+
+    hidden_columns = set()
+    for dimension in worksheet.column_dimensions.values():
+        if dimension.hidden and dimension.min and dimension.max:
+            hidden_columns.update(range(dimension.min, dimension.max + 1))
+    hidden_rows = {row for row, dimension in worksheet.row_dimensions.items() if dimension.hidden}
+
+    return SheetSnapshot(worksheet.title, max_row, max_column, rows,
+                         hidden_rows=frozenset(hidden_rows), hidden_columns=frozenset(hidden_columns))
+
+
+class _WorkbookEntry:
+    """A parsed openpyxl workbook and the sheet snapshots built from it so far."""
+
+    def __init__(self, workbook: Any):
+        self.workbook = workbook
+        self.sheet_names = list(workbook.sheetnames)
+        self.snapshots: Dict[str, SheetSnapshot] = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self, sheet_name: str) -> SheetSnapshot:
+        with self.lock:
+            snapshot = self.snapshots.get(sheet_name)
+            if snapshot is None:
+                if sheet_name not in self.sheet_names:
+                    raise KeyError("Worksheet {0} does not exist.".format(sheet_name))
+                snapshot = _snapshot_from_worksheet(self.workbook[sheet_name])
+                self.snapshots[sheet_name] = snapshot
+            return snapshot
+
+
+def _load_openpyxl_workbook(file_path: str) -> _WorkbookEntry:
+    """Parse the workbook with openpyxl; sheet snapshots are copied out lazily."""
+    return _WorkbookEntry(load_workbook(file_path))
+
+
+class WorkbookBackend(Protocol):
+    """What a backend loader returns for a workbook path; snapshot() must be safe to call from several threads."""
+    sheet_names: List[str]
+
+    def snapshot(self, sheet_name: str) -> SheetSnapshot:
+        ...
+
+
+# Backends turn a workbook path into a WorkbookBackend (openpyxl, streaming, columnar)
+SNAPSHOT_BACKENDS: Dict[str, Callable[[str], WorkbookBackend]] = {"openpyxl": _load_openpyxl_workbook}
+
+
+# Modules that register the other built-in backends when imported
+_BACKEND_MODULES = {"columnar": "tools.columnar", "streaming": "tools.xlsx_reader"}
+
+
+def register_snapshot_backend(name: str, loader: Callable[[str], WorkbookBackend]) -> None:
+    """Register a workbook loader that WorkbookCache can use instead of parsing with openpyxl."""
+    SNAPSHOT_BACKENDS[name] = loader
+
+
+def snapshot_backend(name: str) -> Callable[[str], WorkbookBackend]:
+    """Return the loader of a backend, importing the module of a built-in one on first use."""
+    if name not in SNAPSHOT_BACKENDS and name in _BACKEND_MODULES:
+        importlib.import_module(_BACKEND_MODULES[name])
+    loader = SNAPSHOT_BACKENDS.get(name)
+    if loader is None:
+        raise ValueError("Unknown snapshot backend '%s', expected one of %s" % (name, sorted(set(SNAPSHOT_BACKENDS) | set(_BACKEND_MODULES))))
+    return loader
+
+
+class WorkbookCache:
+    """Process-wide LRU cache of parsed workbooks keyed on path, modification time and size."""
+
+    def __init__(self, max_workbooks: int = 4, backend: str = "openpyxl"):
+        self.max_workbooks = max_workbooks
+        self.backend = backend
+        self._entries: "OrderedDict[Tuple[str, int, int], _WorkbookEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Set by tools.daemon: returns the workbook as served by a warm tool daemon, or None to load it here
+        self.remote: Optional[Callable[[str], Optional[WorkbookBackend]]] = None
+
+    @staticmethod
+    def _key(file_path: str) -> Tuple[str, int, int]:
+        stat = os.stat(file_path)
+        return os.path.realpath(file_path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, file_path: str) -> _WorkbookEntry:
+        """Return the cached workbook entry, taking it from the tool daemon or parsing the file on a miss."""
+        key = self._key(file_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            hit = entry is not None
+            if hit:
+                self._entries.move_to_end(key)
+            else:
+                entry = self.remote(file_path) if self.remote is not None else None
+                if entry is not None:
+                    logger.info("Workbook cache miss, %s served by the tool daemon", file_path)
+                else:
+                    loader = snapshot_backend(self.backend)
+                    logger.info("Workbook cache miss, loading %s with the %s backend", file_path, self.backend)
+                    with PROFILER.trace_memory("Loading %s with the %s backend" % (file_path, self.backend)):
+                        entry = loader(file_path)
+                self._entries[key] = entry
+                while len(self._entries) > self.max_workbooks:
+                    self._entries.popitem(last=False)
+        TELEMETRY.annotate(workbook_cache_hit=hit)
+        return entry
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, file_path: str, entry: Any) -> None:
+        """Insert an already loaded workbook entry, e.g. one attached from shared memory."""
+        key = self._key(file_path)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_workbooks:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+WORKBOOK_CACHE = WorkbookCache(max_workbooks=int(os.getenv("EXCEL_AGENT_WORKBOOK_CACHE_SIZE", "4")),
+                               backend=os.getenv("EXCEL_AGENT_SNAPSHOT_BACKEND", "openpyxl"))
+
+
+def get_sheet_snapshot(file_path: str, sheet_name: str) -> SheetSnapshot:
+    """Return the cached snapshot of a sheet, loading the workbook if needed."""
+    return WORKBOOK_CACHE.get(file_path).snapshot(sheet_name)
+
+
+def get_workbook_sheet_names(file_path: str) -> List[str]:
+    """Return the sheet names of a workbook through the cache."""
+    return list(WORKBOOK_CACHE.get(file_path).sheet_names)
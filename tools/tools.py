@@ -1,8 +1,12 @@
-from openpyxl import load_workbook
-from typing import List, Any, Dict
+from openpyxl.utils import get_column_letter, column_index_from_string
+from typing import List, Any, Dict, Optional
 import random
 from langchain.tools import tool
 from core.logger import setup_logger
+from tools.cell_context import format_cell_contexts, resolve_cells
+from tools.search_index import get_workbook_index
+from tools.sheet_query import SheetQuery, run_query
+from tools.snapshot import get_sheet_snapshot, parse_cell_reference
 from tools.utils import get_detailed_data_types
 
 logger = setup_logger(__name__)
@@ -22,14 +26,13 @@ logger = setup_logger(__name__)
 def get_row_values(file_path: str, sheet_name: str, row_number: int) -> List[Dict[str, Any]]:
     """Get all values from a specific row in the Excel sheet with their cell references."""
     logger.info("Getting row %d values from sheet '%s' in %s", row_number, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     result = []
-    for cell in sheet[row_number]:
-        if cell.value is not None:  # Only include non-empty cells
+    for column, value in enumerate(sheet.row_values(row_number), start=1):
+        if value is not None:  # Only include non-empty cells
             result.append({
-                "cell_reference": cell.coordinate,
-                "value": cell.value
+                "cell_reference": f"{get_column_letter(column)}{row_number}",
+                "value": value
             })
     logger.info("Row %d has %d non-empty values", row_number, len(result))
     return result
@@ -39,14 +42,14 @@ def get_row_values(file_path: str, sheet_name: str, row_number: int) -> List[Dic
 def get_column_values(file_path: str, sheet_name: str, column_letter: str) -> List[Dict[str, Any]]:
     """Get all values from a specific column in the Excel sheet with their cell references."""
     logger.info("Getting column %s values from sheet '%s' in %s", column_letter, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    column_letter = column_letter.upper()
     result = []
-    for cell in sheet[column_letter]:
-        if cell.value is not None:  # Only include non-empty cells
+    for row, value in enumerate(sheet.column_values(column_index_from_string(column_letter)), start=1):
+        if value is not None:  # Only include non-empty cells
             result.append({
-                "cell_reference": cell.coordinate,
-                "value": cell.value
+                "cell_reference": f"{column_letter}{row}",
+                "value": value
             })
     logger.info("Column %s has %d non-empty values", column_letter, len(result))
     return result
@@ -56,9 +59,8 @@ def get_column_values(file_path: str, sheet_name: str, column_letter: str) -> Li
 def get_cell_value(file_path: str, sheet_name: str, cell_reference: str) -> Any:
     """Get the value of a specific cell in the Excel sheet."""
     logger.info("Getting cell %s value from sheet '%s' in %s", cell_reference, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
-    result = sheet[cell_reference].value
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    result = sheet.value(*parse_cell_reference(cell_reference))
     logger.info("Cell %s value: %s", cell_reference, result)
     return result
 
@@ -68,9 +70,8 @@ def get_data_types_column(file_path: str, sheet_name: str, column_letter: str) -
     """Get the data types of all values in a specific column."""
     logger.info("Getting data types for column %s in sheet '%s' from %s", column_letter, sheet_name, file_path)
     # Read the column values directly instead of calling get_column_values
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
-    result = [cell.value for cell in sheet[column_letter]]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    result = sheet.column_values(column_index_from_string(column_letter.upper()))
     logger.info("Column %s has %d values", column_letter, len(result))
     return get_detailed_data_types(result)
 
@@ -79,8 +80,7 @@ def get_data_types_column(file_path: str, sheet_name: str, column_letter: str) -
 def get_sheet_dimensions(file_path: str, sheet_name: str) -> Dict[str, int]:
     """Get the number of rows and columns in the Excel sheet."""
     logger.info("Getting dimensions for sheet '%s' in %s", sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     result = {"rows": sheet.max_row, "columns": sheet.max_column}
     logger.info("Sheet '%s' dimensions: %d rows x %d columns", sheet_name, result['rows'], result['columns'])
     return result
@@ -90,8 +90,7 @@ def get_sheet_dimensions(file_path: str, sheet_name: str) -> Dict[str, int]:
 def get_max_rows(file_path: str, sheet_name: str) -> int:
     """Get the maximum number of rows in the Excel sheet."""
     logger.info("Getting max rows for sheet '%s' in %s", sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     result = sheet.max_row
     logger.info("Sheet '%s' has %d rows", sheet_name, result)
     return result
@@ -101,8 +100,7 @@ def get_max_rows(file_path: str, sheet_name: str) -> int:
 def get_max_columns(file_path: str, sheet_name: str) -> int:
     """Get the maximum number of columns in the Excel sheet."""
     logger.info("Getting max columns for sheet '%s' in %s", sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     result = sheet.max_column
     logger.info("Sheet '%s' has %d columns", sheet_name, result)
     return result
@@ -121,25 +119,58 @@ def get_max_columns(file_path: str, sheet_name: str) -> int:
 def find_cells_with_value(file_path: str, sheet_name: str, search_value: Any) -> List[str]:
     """Find all cell references that contain a specific value."""
     logger.info("Searching for value '%s' in sheet '%s' from %s", search_value, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     cells = []
-    for row in sheet.iter_rows():
-        for cell in row:
-            if cell.value == search_value:
-                cells.append(cell.coordinate)
+    for row_number, row in sheet.iter_rows():
+        for column, value in enumerate(row, start=1):
+            if value == search_value:
+                cells.append(f"{get_column_letter(column)}{row_number}")
     logger.info("Found %d cells with value '%s': %s", len(cells), search_value, cells)
     return cells
 
 
+@tool
+def search_workbook(file_path: str, query: str, max_results: int = 50) -> List[Dict[str, Any]]:
+    """Search every sheet of the workbook at once for a value or text: returns exact matches first, then cells whose text contains the query, each with its sheet name and cell reference."""
+    logger.info("Searching workbook %s for '%s'", file_path, query)
+    result = get_workbook_index(file_path).search(query, max_results=max_results)
+    logger.info("Found %d cells matching '%s' across the workbook", len(result), query)
+    return result
+
+
+@tool(args_schema=SheetQuery)
+def query_sheet(file_path: str, sheet_name: str, columns: str, where_column: Optional[str] = None,
+                matches: Optional[str] = None, excludes: Optional[str] = None, numeric_only: bool = False,
+                rows: Optional[str] = None, header_row: Optional[int] = None, max_rows: int = 100) -> str:
+    """Query a sheet in one call: keep the rows whose where_column text matches a regex (and/or that hold numbers) and return the chosen columns as a compact table, labelled with the header row. Example: where_column='B', matches='revenue', columns='F:P', header_row=6."""
+    logger.info("Querying sheet '%s' in %s: columns %s where %s ~ %s", sheet_name, file_path, columns, where_column, matches)
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    return run_query(sheet, columns, where_column=where_column, matches=matches, excludes=excludes,
+                     numeric_only=numeric_only, rows=rows, header_row=header_row, max_rows=max_rows)
+
+
+@tool
+def get_cell_contexts(file_path: str, sheet_name: str, start_cell: Optional[str] = None, end_cell: Optional[str] = None,
+                      include_formulas: bool = False, max_cells: int = 300) -> str:
+    """List every numeric cell of a sheet (or of the range start_cell:end_cell) with its row label and column period, as 'cell | value | label | period | header' lines. The header rows and label columns are detected for you, so the period of a value can be read off directly. Formula cells are left out unless include_formulas=True; on calculated sheets (e.g. monthly P&Ls) most values are formulas, so pass include_formulas=True there."""
+    logger.info("Resolving cell contexts of sheet '%s' in %s (%s:%s)", sheet_name, file_path, start_cell, end_cell)
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    start_row, start_column = parse_cell_reference(start_cell) if start_cell else (1, 1)
+    end_row, end_column = parse_cell_reference(end_cell) if end_cell else (sheet.max_row, sheet.max_column)
+    contexts = resolve_cells(sheet, min(start_row, end_row), max(start_row, end_row), min(start_column, end_column),
+                             max(start_column, end_column), include_formulas=include_formulas)
+    return format_cell_contexts(sheet, contexts, max_cells=max_cells)
+
+
 @tool
 def get_range_values(file_path: str, sheet_name: str, start_cell: str, end_cell: str) -> List[List[Any]]:
     """Get values from a range of cells in the Excel sheet."""
     logger.info("Getting range %s:%s from sheet '%s' in %s", start_cell, end_cell, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
-    range_data = sheet[start_cell:end_cell]
-    result = [[cell.value for cell in row] for row in range_data]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    start_row, start_column = parse_cell_reference(start_cell)
+    end_row, end_column = parse_cell_reference(end_cell)
+    result = sheet.range_values(min(start_row, end_row), min(start_column, end_column),
+                                max(start_row, end_row), max(start_column, end_column))
     logger.info("Range %s:%s contains %d rows", start_cell, end_cell, len(result))
     return result
 
@@ -148,17 +179,16 @@ def get_range_values(file_path: str, sheet_name: str, start_cell: str, end_cell:
 def get_sheet_content(file_path: str, sheet_name: str) -> Dict[int, Dict[str, Any]]:
     """Get all content of the sheet as a nested dictionary where outer dict keys are row numbers and inner dict keys are column letters."""
     logger.info("Getting all content from sheet '%s' in %s", sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     
     result = {}
-    for row in sheet.iter_rows():
+    for row_number, row in sheet.iter_rows():
         row_dict = {}
-        for cell in row:
-            if cell.value is not None:  # Only include non-empty cells
-                row_dict[cell.column_letter] = cell.value
+        for column, value in enumerate(row, start=1):
+            if value is not None:  # Only include non-empty cells
+                row_dict[get_column_letter(column)] = value
         if row_dict:  # Only include rows with data
-            result[cell.row] = row_dict
+            result[row_number] = row_dict
     
     logger.info("Retrieved %d rows with data from sheet '%s'", len(result), sheet_name)
     return result
@@ -170,8 +200,7 @@ def get_sheet_content_sample(file_path: str, sheet_name: str) -> Dict[int, Dict[
     num_rows = 5
     num_columns = 5
     logger.info("Getting sample content (%d rows x %d columns) from sheet '%s' in %s", num_rows, num_columns, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     
     # Get the actual dimensions of the sheet
     max_row = min(sheet.max_row, num_rows)
@@ -181,9 +210,9 @@ def get_sheet_content_sample(file_path: str, sheet_name: str) -> Dict[int, Dict[
     for row_num in range(1, max_row + 1):
         row_dict = {}
         for col_num in range(1, max_col + 1):
-            cell = sheet.cell(row=row_num, column=col_num)
-            if cell.value is not None:  # Only include non-empty cells
-                row_dict[cell.column_letter] = cell.value
+            value = sheet.value(row_num, col_num)
+            if value is not None:  # Only include non-empty cells
+                row_dict[get_column_letter(col_num)] = value
         if row_dict:  # Only include rows with data
             result[row_num] = row_dict
     
@@ -197,9 +226,8 @@ def get_row_values_sample(file_path: str, sheet_name: str, row_number: int) -> L
     sample_size = 5
     logger.info("Getting sample of %d values from row %d in sheet '%s' from %s", sample_size, row_number, sheet_name, file_path)
 
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
-    all_values = [cell.value for cell in sheet[row_number]]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    all_values = sheet.row_values(row_number)
     
     # Filter out None values and get non-empty values
     non_empty_values = [val for val in all_values if val is not None]
@@ -219,9 +247,8 @@ def get_column_values_sample(file_path: str, sheet_name: str, column_letter: str
     """Get a random sample of values from a specific column in the Excel sheet."""
     sample_size = 5
     logger.info("Getting sample of %d values from column %s in sheet '%s' from %s", sample_size, column_letter, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
-    all_values = [cell.value for cell in sheet[column_letter]]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    all_values = sheet.column_values(column_index_from_string(column_letter.upper()))
     
     # Filter out None values and get non-empty values
     non_empty_values = [val for val in all_values if val is not None]
@@ -240,9 +267,8 @@ def get_column_values_sample(file_path: str, sheet_name: str, column_letter: str
 def get_data_types_column_sample(file_path: str, sheet_name: str, column_letter: str, sample_size: int = 10) -> List[str]:
     """Get the data types of a random sample of values from a specific column."""
     logger.info("Getting data types for sample of %d values from column %s in sheet '%s' from %s", sample_size, column_letter, sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
-    all_values = [cell.value for cell in sheet[column_letter]]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
+    all_values = sheet.column_values(column_index_from_string(column_letter.upper()))
     
     # Filter out None values and get non-empty values
     non_empty_values = [val for val in all_values if val is not None]
@@ -262,15 +288,14 @@ def get_data_types_column_sample(file_path: str, sheet_name: str, column_letter:
 def get_nonempty_column_letters(file_path: str, sheet_name: str) -> List[str]:
     """Get a list of column letters that contain non-empty values in the Excel sheet."""
     logger.info("Getting non-empty column letters from sheet '%s' in %s", sheet_name, file_path)
-    workbook = load_workbook(file_path)
-    sheet = workbook[sheet_name]
+    sheet = get_sheet_snapshot(file_path, sheet_name)
     
     nonempty_columns = []
-    for column in sheet.columns:
+    for column in range(1, sheet.max_column + 1):
         # Check if any cell in this column has a non-empty value
-        has_data = any(cell.value is not None for cell in column)
+        has_data = any(row[column - 1] is not None for _, row in sheet.iter_rows())
         if has_data:
-            nonempty_columns.append(column[0].column_letter)
+            nonempty_columns.append(get_column_letter(column))
     
     logger.info("Found %d non-empty columns: %s", len(nonempty_columns), nonempty_columns)
     return nonempty_columns
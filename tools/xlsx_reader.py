@@ -0,0 +1,287 @@
+import argparse
+import os
+import posixpath
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+from xml.etree.ElementTree import iterparse, parse
+from openpyxl.formula.translate import Translator
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+from openpyxl.worksheet.formula import ArrayFormula, DataTableFormula
+from core.logger import setup_logger
+from tools.snapshot import SNAPSHOT_BACKENDS, SheetSnapshot, register_snapshot_backend
+
+logger = setup_logger(__name__)
+
+_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PACKAGE_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+_ROW, _CELL, _VALUE, _FORMULA, _INLINE = _MAIN + "row", _MAIN + "c", _MAIN + "v", _MAIN + "f", _MAIN + "is"
+_COL, _TEXT, _RUN, _STRING_ITEM = _MAIN + "col", _MAIN + "t", _MAIN + "r", _MAIN + "si"
+
+_COLUMN_INDEX: Dict[str, int] = {}
+
+
+def _column_index(letters: str) -> int:
+    index = _COLUMN_INDEX.get(letters)
+    if index is None:
+        index = 0
+        for letter in letters:
+            index = index * 26 + ord(letter) - 64
+        _COLUMN_INDEX[letters] = index
+    return index
+
+
+def _split_reference(reference: str) -> Tuple[int, int]:
+    split = len(reference.rstrip("0123456789"))
+    return int(reference[split:]), _column_index(reference[:split])
+
+
+def _cast_number(text: str) -> Any:
+    if "." in text or "E" in text or "e" in text:
+        return float(text)
+    return int(text)
+
+
+def _string_item(element: Any) -> str:
+    """Plain text of a shared or inline string (<t> plus the <t> of each rich text run), as openpyxl reads it."""
+    snippets = []
+    text = element.find(_TEXT)
+    if text is not None and text.text:
+        snippets.append(text.text)
+    for run in element.iterfind(_RUN):
+        text = run.find(_TEXT)
+        if text is not None and text.text:
+            snippets.append(text.text)
+    return "".join(snippets)
+
+
+def _is_true(value: Optional[str]) -> bool:
+    return value in ("1", "true")
+
+
+class StreamingWorkbook:
+    """Workbook backend that streams one sheet's XML out of the zip straight into a SheetSnapshot.
+
+    Opening reads only the workbook part and its relationships; styles and the shared strings
+    table are decoded once, on the first snapshot, and each sheet's XML is parsed only when that
+    sheet is requested. Values are typed the way openpyxl types them (formulas as '=...' text,
+    shared formulas translated to their cell, dates from date-formatted numbers), so snapshots
+    are interchangeable with the openpyxl backend's.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.snapshots: Dict[str, SheetSnapshot] = {}
+        self.lock = threading.Lock()
+        self._shared_strings: Optional[List[str]] = None
+        self._date_styles: Set[int] = set()
+        self._timedelta_styles: Set[int] = set()
+        with zipfile.ZipFile(file_path) as archive:
+            workbook = parse(archive.open("xl/workbook.xml")).getroot()
+            relationships = parse(archive.open("xl/_rels/workbook.xml.rels")).getroot()
+        targets = {rel.get("Id"): rel.get("Target") for rel in relationships.iter(_PACKAGE_REL + "Relationship")}
+        properties = workbook.find(_MAIN + "workbookPr")
+        date1904 = properties is not None and _is_true(properties.get("date1904"))
+        self.epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+        self._paths: Dict[str, str] = {}
+        for sheet in workbook.iter(_MAIN + "sheet"):
+            target = targets.get(sheet.get(_REL + "id"), "")
+            self._paths[sheet.get("name")] = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+        self.sheet_names = list(self._paths)
+
+    def _load_shared_parts(self, archive: zipfile.ZipFile) -> None:
+        """Decode the shared strings table and find the date-formatted cell styles."""
+        names = set(archive.namelist())
+        strings = []
+        if "xl/sharedStrings.xml" in names:
+            for _, element in iterparse(archive.open("xl/sharedStrings.xml")):
+                if element.tag == _STRING_ITEM:
+                    strings.append(_string_item(element).replace("x005F_", ""))
+                    element.clear()
+        if "xl/styles.xml" in names:
+            styles = parse(archive.open("xl/styles.xml")).getroot()
+            custom = {int(fmt.get("numFmtId")): fmt.get("formatCode") for fmt in styles.iter(_MAIN + "numFmt")}
+            cell_formats = styles.find(_MAIN + "cellXfs")
+            for index, xf in enumerate(cell_formats if cell_formats is not None else []):
+                format_id = int(xf.get("numFmtId", 0))
+                code = custom.get(format_id) or BUILTIN_FORMATS.get(format_id, "General")
+                if is_date_format(code):
+                    self._date_styles.add(index)
+                if is_timedelta_format(code):
+                    self._timedelta_styles.add(index)
+        self._shared_strings = strings
+        logger.info("Decoded %d shared strings and %d date styles of %s", len(strings), len(self._date_styles), self.file_path)
+
+    def _read_sheet(self, sheet_name: str) -> SheetSnapshot:
+        with zipfile.ZipFile(self.file_path) as archive:
+            if self._shared_strings is None:
+                self._load_shared_parts(archive)
+            source = archive.open(self._paths[sheet_name])
+            cells: Dict[int, Dict[int, Any]] = {}
+            hidden_rows, hidden_columns = set(), set()
+            shared_formulas: Dict[str, Translator] = {}
+            strings, date_styles = self._shared_strings, self._date_styles
+            max_row = max_column = 0
+            row_number = 0
+            for _, element in iterparse(source):
+                tag = element.tag
+                if tag == _ROW:
+                    reference = element.get("r")
+                    row_number = int(reference) if reference else row_number + 1
+                    if _is_true(element.get("hidden")):
+                        hidden_rows.add(row_number)
+                    row_values = {}
+                    column = 0
+                    for cell in element.iter(_CELL):
+                        reference = cell.get("r")
+                        if reference:
+                            _, column = _split_reference(reference)
+                        else:
+                            column += 1
+                            reference = "%s%d" % (_column_letters(column), row_number)
+                        data_type = cell.get("t", "n")
+                        formula = cell.find(_FORMULA)
+                        if formula is not None:
+                            value = self._formula(formula, reference, shared_formulas)
+                        elif data_type == "inlineStr":
+                            inline = cell.find(_INLINE)
+                            value = _string_item(inline) if inline is not None else None
+                        else:
+                            value = cell.findtext(_VALUE) or None
+                            if value is not None:
+                                if data_type == "n":
+                                    value = _cast_number(value)
+                                    style = int(cell.get("s", 0))
+                                    if style in date_styles:
+                                        try:
+                                            value = from_excel(value, self.epoch, timedelta=style in self._timedelta_styles)
+                                        except (OverflowError, ValueError):
+                                            value = "#VALUE!"
+                                elif data_type == "s":
+                                    value = strings[int(value)]
+                                elif data_type == "b":
+                                    value = bool(int(value))
+                                elif data_type == "d":
+                                    value = from_ISO8601(value)
+                        # Every <c>, even an empty styled one, extends the used range as it does in openpyxl
+                        row_values[column] = value
+                        if column > max_column:
+                            max_column = column
+                    if row_values:
+                        cells[row_number] = row_values
+                        max_row = row_number
+                    element.clear()
+                elif tag == _COL and _is_true(element.get("hidden")):
+                    hidden_columns.update(range(int(element.get("min")), int(element.get("max")) + 1))
+
+        max_row, max_column = max(max_row, 1), max(max_column, 1)
+        empty_row = (None,) * max_column
+        rows = []
+        for number in range(1, max_row + 1):
+            row_values = cells.get(number)
+            if row_values is None:
+                rows.append(empty_row)
+            else:
+                rows.append(tuple(row_values.get(column) for column in range(1, max_column + 1)))
+        return SheetSnapshot(sheet_name, max_row, max_column, rows,
+                             hidden_rows=frozenset(hidden_rows), hidden_columns=frozenset(hidden_columns))
+
+    @staticmethod
+    def _formula(formula: Any, reference: str, shared_formulas: Dict[str, Translator]) -> Any:
+        value = "=" + (formula.text or "")
+        formula_type = formula.get("t")
+        if formula_type == "array":
+            return ArrayFormula(ref=formula.get("ref"), text=value)
+        if formula_type == "shared":
+            index = formula.get("si")
+            if index in shared_formulas:
+                return shared_formulas[index].translate_formula(reference)
+            if value != "=":
+                shared_formulas[index] = Translator(value, reference)
+        elif formula_type == "dataTable":
+            return DataTableFormula(**formula.attrib)
+        return value
+
+    def snapshot(self, sheet_name: str) -> SheetSnapshot:
+        with self.lock:
+            snapshot = self.snapshots.get(sheet_name)
+            if snapshot is None:
+                if sheet_name not in self._paths:
+                    raise KeyError("Worksheet {0} does not exist.".format(sheet_name))
+                snapshot = self._read_sheet(sheet_name)
+                self.snapshots[sheet_name] = snapshot
+            return snapshot
+
+
+def _column_letters(column: int) -> str:
+    letters = ""
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+register_snapshot_backend("streaming", StreamingWorkbook)
+
+
+def _comparable(value: Any) -> Any:
+    if isinstance(value, (ArrayFormula, DataTableFormula)):
+        return (type(value).__name__, getattr(value, "ref", None), getattr(value, "text", None))
+    return value
+
+
+def write_synthetic_workbook(file_path: str, rows: int, columns: int, sheets: int = 3) -> str:
+    """Write a large workbook of labels, numbers, dates and formulas for benchmarking."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for sheet_index in range(sheets):
+        sheet = workbook.create_sheet("Sheet %d" % (sheet_index + 1))
+        sheet.append(["Line item"] + [datetime(2020, 1, 1) + timedelta(days=31 * column) for column in range(columns - 1)])
+        for row in range(2, rows + 1):
+            values = ["Account %d" % (row % 500)] + [row * column * 1.25 for column in range(1, columns - 1)]
+            values.append("=SUM(B%d:%s%d)" % (row, _column_letters(columns - 1), row))
+            sheet.append(values)
+    workbook.save(file_path)
+    return file_path
+
+
+def benchmark(file_path: str) -> Dict[str, Any]:
+    """Time both backends on one workbook: first sheet only (the usual tool call) and every sheet, and compare the snapshots."""
+    results: Dict[str, Any] = {"file": file_path, "size_mb": round(os.path.getsize(file_path) / 1e6, 2)}
+    snapshots = {}
+    for name in ("openpyxl", "streaming"):
+        start = time.perf_counter()
+        workbook = SNAPSHOT_BACKENDS[name](file_path)
+        workbook.snapshot(workbook.sheet_names[0])
+        first = time.perf_counter() - start
+        snapshots[name] = [workbook.snapshot(sheet_name) for sheet_name in workbook.sheet_names]
+        results[name] = {"first_sheet_s": round(first, 3), "all_sheets_s": round(time.perf_counter() - start, 3)}
+    results["identical"] = all(
+        old.max_row == new.max_row and old.max_column == new.max_column and old.hidden_rows == new.hidden_rows
+        and old.hidden_columns == new.hidden_columns
+        and all(list(map(_comparable, a)) == list(map(_comparable, b)) for a, b in zip(old.rows, new.rows))
+        for old, new in zip(snapshots["openpyxl"], snapshots["streaming"]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the streaming xlsx reader against openpyxl.")
+    parser.add_argument("files", nargs="*", help="Workbooks to benchmark")
+    parser.add_argument("--synthetic", nargs="*", default=[], metavar="ROWSxCOLUMNS",
+                        help="Also generate and benchmark synthetic workbooks of this size (3 sheets each), e.g. 20000x40")
+    args = parser.parse_args()
+
+    files = list(args.files)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.synthetic:
+            rows, columns = (int(part) for part in size.lower().split("x"))
+            files.append(write_synthetic_workbook(os.path.join(directory, "synthetic_%s.xlsx" % size), rows, columns))
+        for file_path in files:
+            print(benchmark(file_path))